@@ -3,7 +3,17 @@ from django.urls import path
 from rest_framework.routers import DefaultRouter
 from rest_framework.routers import SimpleRouter
 
-from rag_qa.core.api.views import DocumentIngestView, DocumentSelectionView, QuestionAnswerView
+from rag_qa.core.api.async_views import AsyncDocumentIngestView, AsyncDocumentSelectionView, AsyncQuestionAnswerView
+from rag_qa.core.api.views import (
+    DocumentIngestView,
+    DocumentSelectionView,
+    QuestionAnswerDetailView,
+    QuestionAnswerStreamView,
+    QuestionAnswerView,
+    QuestionBatchDetailView,
+    QuestionBatchStreamView,
+    QuestionBatchView,
+)
 from rag_qa.users.api.views import UserViewSet
 
 router = DefaultRouter() if settings.DEBUG else SimpleRouter()
@@ -11,9 +21,21 @@ router = DefaultRouter() if settings.DEBUG else SimpleRouter()
 router.register("users", UserViewSet)
 
 
+if settings.ASYNC_API:
+    ingest_view, selection_view, question_answer_view = AsyncDocumentIngestView, AsyncDocumentSelectionView, AsyncQuestionAnswerView
+else:
+    ingest_view, selection_view, question_answer_view = DocumentIngestView, DocumentSelectionView, QuestionAnswerView
+
+
 app_name = "api"
 urlpatterns = router.urls + [
-    path("document/", DocumentIngestView.as_view(), name="document-ingest"),
-    path("document/selection/", DocumentSelectionView.as_view(), name="document-selection"),
-    path("question-answer/", QuestionAnswerView.as_view(), name="question-answer"),
+    path("document/", ingest_view.as_view(), name="document-ingest"),
+    path("document/selection/", selection_view.as_view(), name="document-selection"),
+    path("question-answer/", question_answer_view.as_view(), name="question-answer"),
+    path("question-answer/batch/", QuestionBatchView.as_view(), name="question-batch"),
+    path("question-answer/batch/<str:batch_id>/", QuestionBatchDetailView.as_view(), name="question-batch-detail"),
+    path("question-answer/batch/<str:batch_id>/stream/", QuestionBatchStreamView.as_view(), name="question-batch-stream"),
+    # After the batch routes, which it would otherwise shadow
+    path("question-answer/<str:question_id>/", QuestionAnswerDetailView.as_view(), name="question-answer-detail"),
+    path("question-answer/<str:question_id>/stream/", QuestionAnswerStreamView.as_view(), name="question-answer-stream"),
 ]
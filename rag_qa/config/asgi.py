@@ -0,0 +1,26 @@
+# ruff: noqa
+"""
+ASGI config for Rag Qa project.
+
+This module contains the ASGI application used by production ASGI deployments,
+such as gunicorn with uvicorn workers. It exposes a module-level variable named
+``application``. With ``DJANGO_ASGI`` set, the API is served by the async views,
+so a worker process can hold many open polling and streaming connections.
+
+"""
+
+import os
+import sys
+from pathlib import Path
+
+from django.core.asgi import get_asgi_application
+
+# This allows easy placement of apps within the interior
+# rag_qa directory.
+BASE_DIR = Path(__file__).resolve(strict=True).parent.parent
+sys.path.append(str(BASE_DIR / "rag_qa"))
+# We defer to a DJANGO_SETTINGS_MODULE already in the environment.
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings.production")
+
+# This application object is used by any ASGI server configured to use this file.
+application = get_asgi_application()
@@ -57,6 +57,8 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 ROOT_URLCONF = "config.urls"
 # https://docs.djangoproject.com/en/dev/ref/settings/#wsgi-application
 WSGI_APPLICATION = "config.wsgi.application"
+# https://docs.djangoproject.com/en/dev/howto/deployment/asgi/
+ASGI_APPLICATION = "config.asgi.application"
 
 # APPS
 # ------------------------------------------------------------------------------
@@ -304,6 +306,27 @@ CELERY_BEAT_SCHEDULER = "django_celery_beat.schedulers:DatabaseScheduler"
 CELERY_WORKER_SEND_TASK_EVENTS = True
 # https://docs.celeryq.dev/en/stable/userguide/configuration.html#std-setting-task_send_sent_event
 CELERY_TASK_SEND_SENT_EVENT = True
+# https://docs.celeryq.dev/en/stable/userguide/routing.html
+# Ingestion runs on its own workers, so that a burst of large documents does not hold up
+# questions. Tasks without a route, such as the scheduled purge, go to the ingest queue too.
+CELERY_TASK_DEFAULT_QUEUE = "ingest"
+# With Redis, a lower number is a higher priority, 0 being the default. Batches of questions
+# wait for the questions asked interactively on the qa queue.
+CELERY_TASK_ROUTES = {
+    "rag_qa.core.tasks.build_index": {"queue": "ingest"},
+    "rag_qa.core.tasks.index_pages": {"queue": "ingest"},
+    "rag_qa.core.tasks.finish_index": {"queue": "ingest"},
+    "rag_qa.core.tasks.get_rag_response": {"queue": "qa", "priority": 0},
+    "rag_qa.core.tasks.answer_question_batch": {"queue": "qa", "priority": 9},
+}
+# Each worker service sets these for the queues it consumes, see the compose files.
+# https://docs.celeryq.dev/en/stable/userguide/configuration.html#worker-prefetch-multiplier
+# A worker reserves no more tasks than it runs, so that a waiting question is not stuck
+# behind tasks that a busy process has reserved
+CELERY_WORKER_PREFETCH_MULTIPLIER = env.int("CELERY_WORKER_PREFETCH_MULTIPLIER", default=1)
+# https://docs.celeryq.dev/en/stable/userguide/configuration.html#worker-concurrency
+# The number of CPUs if unset
+CELERY_WORKER_CONCURRENCY = env.int("CELERY_WORKER_CONCURRENCY", default=None)
 # django-allauth
 # ------------------------------------------------------------------------------
 ACCOUNT_ALLOW_REGISTRATION = env.bool("DJANGO_ACCOUNT_ALLOW_REGISTRATION", True)
@@ -349,3 +372,147 @@ SPECTACULAR_SETTINGS = {
 # Your stuff...
 # ------------------------------------------------------------------------------
 OPENAI_API_KEY = env.str("OPENAI_API_KEY")
+# API base URL, for example of a proxy. The default is OpenAI's.
+OPENAI_BASE_URL = env.str("OPENAI_BASE_URL", default=None)
+# Every process sends its OpenAI requests through one HTTP client, which keeps up to
+# OPENAI_MAX_CONNECTIONS connections alive. Keep it at least the number of requests
+# a task runs at once, such as QUESTION_BATCH_LLM_CONCURRENCY and
+# EMBEDDING_MAX_CONCURRENCY.
+OPENAI_MAX_CONNECTIONS = env.int("OPENAI_MAX_CONNECTIONS", default=20)
+OPENAI_TIMEOUT = env.float("OPENAI_TIMEOUT", default=60)
+
+# Vector store
+# ------------------------------------------------------------------------------
+# Number of chunks embedded and written to the vector store per round trip while
+# ingesting a document. Worker memory grows with this value, not with page count.
+VECTOR_DB_INGEST_WINDOW_SIZE = env.int("VECTOR_DB_INGEST_WINDOW_SIZE", default=64)
+# Number of pages of a document parsed and embedded by one task. Longer documents are
+# split into shards of this many pages, indexed in parallel by the ingest workers.
+# 0 indexes every document in a single task.
+INGEST_SHARD_PAGES = env.int("INGEST_SHARD_PAGES", default=50)
+# "shared" keeps the chunks of every document in one collection, tagged with their
+# document_id, so a question is one filtered nearest-neighbour query. "per_document"
+# is the older one-collection-per-document layout; move it with migrate_collections,
+# then set "shared". It stays the default so that existing deployments keep finding
+# their chunks until they are migrated.
+VECTOR_DB_COLLECTION_LAYOUT = env.str("VECTOR_DB_COLLECTION_LAYOUT", default="per_document")
+VECTOR_DB_SHARED_COLLECTION = env.str("VECTOR_DB_SHARED_COLLECTION", default="documents")
+# Approximate nearest-neighbour index on the pgvector embeddings table, managed with
+# the vector_index command. PGVECTOR_INDEX_METHOD is "hnsw" or "ivfflat"; the build
+# parameters apply when the index is created, the search parameters to every query.
+PGVECTOR_INDEX_METHOD = env.str("PGVECTOR_INDEX_METHOD", default="hnsw")
+PGVECTOR_DIMENSIONS = env.int("PGVECTOR_DIMENSIONS", default=1536)
+PGVECTOR_HNSW_M = env.int("PGVECTOR_HNSW_M", default=16)
+PGVECTOR_HNSW_EF_CONSTRUCTION = env.int("PGVECTOR_HNSW_EF_CONSTRUCTION", default=64)
+PGVECTOR_IVFFLAT_LISTS = env.int("PGVECTOR_IVFFLAT_LISTS", default=100)
+PGVECTOR_HNSW_EF_SEARCH = env.int("PGVECTOR_HNSW_EF_SEARCH", default=40)
+PGVECTOR_IVFFLAT_PROBES = env.int("PGVECTOR_IVFFLAT_PROBES", default=1)
+# Create the index, if it does not exist yet, after each document is indexed.
+PGVECTOR_INDEX_AFTER_INGEST = env.bool("PGVECTOR_INDEX_AFTER_INGEST", default=False)
+# Each worker process keeps one pgvector engine with a bounded connection pool, and
+# reuses vector store objects for up to VECTOR_DB_STORE_CACHE_SIZE collections.
+VECTOR_DB_POOL_SIZE = env.int("VECTOR_DB_POOL_SIZE", default=5)
+VECTOR_DB_POOL_MAX_OVERFLOW = env.int("VECTOR_DB_POOL_MAX_OVERFLOW", default=5)
+VECTOR_DB_STORE_CACHE_SIZE = env.int("VECTOR_DB_STORE_CACHE_SIZE", default=64)
+# "pgvector" stores the chunks in the pgvector database. "numpy" keeps them in
+# memory-mapped NumPy shards under VECTOR_DB_NUMPY_DIR, one directory per collection,
+# and searches them in the worker process, which avoids the database round trip for
+# small and medium corpora. Search scores VECTOR_DB_NUMPY_BLOCK_SIZE rows at a time,
+# and a collection is compacted once it has more than VECTOR_DB_NUMPY_MAX_SHARDS shards.
+VECTOR_DB_BACKEND = env.str("VECTOR_DB_BACKEND", default="pgvector")
+VECTOR_DB_NUMPY_DIR = env.str("VECTOR_DB_NUMPY_DIR", default=str(APPS_DIR / "vectors"))
+VECTOR_DB_NUMPY_BLOCK_SIZE = env.int("VECTOR_DB_NUMPY_BLOCK_SIZE", default=65536)
+VECTOR_DB_NUMPY_MAX_SHARDS = env.int("VECTOR_DB_NUMPY_MAX_SHARDS", default=64)
+# Number of chunks retrieved for a question, the best by relevance score across
+# all selected documents.
+RETRIEVAL_TOP_K = env.int("RETRIEVAL_TOP_K", default=4)
+# At most this many of the chunks may come from one document. Unset for no cap. With
+# the shared layout and a cap, RETRIEVAL_FETCH_K chunks are fetched before capping.
+RETRIEVAL_PER_DOCUMENT_CAP = env.int("RETRIEVAL_PER_DOCUMENT_CAP", default=None)
+RETRIEVAL_FETCH_K = env.int("RETRIEVAL_FETCH_K", default=20)
+# Number of per-document collections queried at once. Each query holds a pgvector
+# connection, so keep it within VECTOR_DB_POOL_SIZE + VECTOR_DB_POOL_MAX_OVERFLOW.
+RETRIEVAL_MAX_CONCURRENCY = env.int("RETRIEVAL_MAX_CONCURRENCY", default=4)
+# Maximum number of tokens of retrieved chunks stuffed into the question answering
+# prompt. The default leaves room for the question and the answer in a 4k context.
+CONTEXT_TOKEN_BUDGET = env.int("CONTEXT_TOKEN_BUDGET", default=3000)
+# tiktoken encoding of the LLM, used to count the tokens of chunks and prompts, and
+# of the chunks batched for embedding
+CONTEXT_TOKEN_ENCODING = env.str("CONTEXT_TOKEN_ENCODING", default="cl100k_base")
+
+# Embeddings
+# ------------------------------------------------------------------------------
+# Chunks are sent to the embedding provider in batches of at most this many tokens
+# and texts, with up to EMBEDDING_MAX_CONCURRENCY batches in flight at once.
+EMBEDDING_BATCH_MAX_TOKENS = env.int("EMBEDDING_BATCH_MAX_TOKENS", default=16000)
+EMBEDDING_BATCH_MAX_SIZE = env.int("EMBEDDING_BATCH_MAX_SIZE", default=256)
+EMBEDDING_MAX_CONCURRENCY = env.int("EMBEDDING_MAX_CONCURRENCY", default=4)
+# Vectors are cached in the database by embedding model and chunk text, so
+# re-ingested or duplicated chunks are not sent to the provider again. Celery beat
+# evicts the least recently used entries beyond EMBEDDING_CACHE_MAX_ENTRIES every
+# EMBEDDING_CACHE_EVICT_INTERVAL seconds, deleting EMBEDDING_CACHE_EVICT_BATCH_SIZE
+# entries per statement.
+EMBEDDING_CACHE_MAX_ENTRIES = env.int("EMBEDDING_CACHE_MAX_ENTRIES", default=200000)
+EMBEDDING_CACHE_EVICT_INTERVAL = env.int("EMBEDDING_CACHE_EVICT_INTERVAL", default=60 * 60)
+EMBEDDING_CACHE_EVICT_BATCH_SIZE = env.int("EMBEDDING_CACHE_EVICT_BATCH_SIZE", default=1000)
+# Question vectors are cached in Redis by embedding model and normalized question
+# text, so a repeated question costs no embedding call. Entries expire this many
+# seconds after their last use, and the least recently used are evicted beyond
+# QUERY_EMBEDDING_CACHE_MAX_ENTRIES.
+QUERY_EMBEDDING_CACHE_TTL = env.int("QUERY_EMBEDDING_CACHE_TTL", default=7 * 24 * 60 * 60)
+QUERY_EMBEDDING_CACHE_MAX_ENTRIES = env.int("QUERY_EMBEDDING_CACHE_MAX_ENTRIES", default=50000)
+
+# Answers
+# ------------------------------------------------------------------------------
+# Serve the API with the async views. Set it when running under ASGI (the start
+# scripts then use uvicorn workers), where a worker process can hold thousands of
+# open polling and streaming connections.
+ASYNC_API = env.bool("DJANGO_ASGI", default=False)
+# A question whose embedding has at least this cosine similarity with an answered
+# question over the same documents gets that answer back, without running the
+# chain. Only the most recent SEMANTIC_CACHE_MAX_CANDIDATES answered questions of
+# the document set are compared. A threshold above 1 disables the cache.
+SEMANTIC_CACHE_THRESHOLD = env.float("SEMANTIC_CACHE_THRESHOLD", default=0.95)
+SEMANTIC_CACHE_MAX_CANDIDATES = env.int("SEMANTIC_CACHE_MAX_CANDIDATES", default=1000)
+# The worker publishes answer tokens through Redis for the streaming endpoint, and
+# keeps a backlog of them for ANSWER_STREAM_TTL seconds for clients that connect
+# late. A stream gives up after ANSWER_STREAM_TIMEOUT seconds, and sends a comment
+# after ANSWER_STREAM_KEEPALIVE idle seconds so proxies keep the connection open.
+ANSWER_STREAM_TTL = env.int("ANSWER_STREAM_TTL", default=600)
+ANSWER_STREAM_TIMEOUT = env.int("ANSWER_STREAM_TIMEOUT", default=300)
+ANSWER_STREAM_KEEPALIVE = env.int("ANSWER_STREAM_KEEPALIVE", default=15)
+# Number of seconds that clients polling a question being answered are asked to wait
+# between polls, in the Retry-After header
+ANSWER_POLL_INTERVAL = env.int("ANSWER_POLL_INTERVAL", default=2)
+# Number of seconds after which a question still in progress is considered lost, such as
+# when its worker died, and can be claimed by the next request for it. Keep it above
+# CELERY_TASK_TIME_LIMIT plus the time a question may wait on the qa queue.
+ANSWER_CLAIM_TIMEOUT = env.int("ANSWER_CLAIM_TIMEOUT", default=10 * 60)
+# Answers are deleted ANSWER_CACHE_TTL seconds after they were given, and questions
+# without an answer that long after they were asked. Celery beat runs the purge every
+# ANSWER_PURGE_INTERVAL seconds, deleting ANSWER_PURGE_BATCH_SIZE rows per statement.
+ANSWER_CACHE_TTL = env.int("ANSWER_CACHE_TTL", default=7 * 24 * 60 * 60)
+ANSWER_PURGE_INTERVAL = env.int("ANSWER_PURGE_INTERVAL", default=60 * 60)
+ANSWER_PURGE_BATCH_SIZE = env.int("ANSWER_PURGE_BATCH_SIZE", default=1000)
+CELERY_BEAT_SCHEDULE = {
+    "purge-expired-answers": {
+        "task": "rag_qa.core.tasks.purge_expired_answers",
+        "schedule": ANSWER_PURGE_INTERVAL,
+    },
+    "evict-embedding-cache": {
+        "task": "rag_qa.core.tasks.evict_embedding_cache",
+        "schedule": EMBEDDING_CACHE_EVICT_INTERVAL,
+    },
+}
+# Maximum number of seconds a process keeps the selected documents without reading
+# them again, in case their invalidation in Redis was missed. 0 disables the cache.
+SELECTED_DOCUMENTS_CACHE_TTL = env.int("SELECTED_DOCUMENTS_CACHE_TTL", default=300)
+# Number of documents on a page of the document listing by default, and at most
+DOCUMENT_PAGE_SIZE = env.int("DOCUMENT_PAGE_SIZE", default=100)
+DOCUMENT_PAGE_MAX_SIZE = env.int("DOCUMENT_PAGE_MAX_SIZE", default=1000)
+# Maximum number of questions in a batch
+QUESTION_BATCH_MAX_SIZE = env.int("QUESTION_BATCH_MAX_SIZE", default=500)
+# Number of prompts of a batch sent to the LLM in one completion request
+QUESTION_BATCH_PROMPTS_PER_CALL = env.int("QUESTION_BATCH_PROMPTS_PER_CALL", default=20)
+# Number of completion requests of a batch in flight at once
+QUESTION_BATCH_LLM_CONCURRENCY = env.int("QUESTION_BATCH_LLM_CONCURRENCY", default=4)
@@ -36,3 +36,7 @@ TEMPLATES[0]["OPTIONS"]["debug"] = True  # type: ignore[index]
 MEDIA_URL = "http://media.testserver"
 # Your stuff...
 # ------------------------------------------------------------------------------
+# Tests roll back the selection changes that would invalidate the selected documents
+SELECTED_DOCUMENTS_CACHE_TTL = 0
+# Tests index placeholder documents whose files do not exist, which cannot be split into shards
+INGEST_SHARD_PAGES = 0
@@ -0,0 +1,200 @@
+"""
+Lookup of past answers to questions similar to a new one, over the same documents, and
+coalescing of concurrent requests for the same question.
+
+Answers are keyed by the index versions of the documents, so that re-indexing a document makes
+the answers over its previous chunks unreachable, and expire after ``ANSWER_CACHE_TTL`` seconds.
+"""
+import hashlib
+from array import array
+from datetime import timedelta
+
+import numpy as np
+from django.db.models import Q
+from django.utils import timezone
+
+from rag_qa.core.models import Document, Question
+
+
+def get_question_key(documents, versions, question):
+    """
+    Builds the ID of a question over a set of documents.
+
+    Args:
+        documents (tuple[int]): The sorted IDs of the selected documents.
+        versions (tuple[int]): The index versions of the documents, in the same order.
+        question (str): The question.
+
+    Returns:
+        str: The hex MD5 digest of the documents, their index versions and the question.
+    """
+    return hashlib.md5(f"{tuple(documents)}_{tuple(versions)}_{question}".encode()).hexdigest()
+
+
+def get_document_set_key(documents, versions):
+    """
+    Builds the key that identifies a set of selected documents as they are indexed.
+
+    Args:
+        documents (tuple[int]): The sorted IDs of the documents.
+        versions (tuple[int]): The index versions of the documents, in the same order.
+
+    Returns:
+        str: The hex MD5 digest of the document IDs and their index versions.
+    """
+    return hashlib.md5(f"{tuple(documents)}_{tuple(versions)}".encode()).hexdigest()
+
+
+def get_index_versions(documents):
+    """
+    Retrieves the current index versions of documents.
+
+    Args:
+        documents (tuple[int]): The IDs of the documents.
+
+    Returns:
+        tuple[int]: The index versions, in the order of ``documents``. Deleted documents have None.
+    """
+    versions = dict(Document.objects.filter(id__in=documents).values_list("id", "index_version"))
+    return tuple(versions.get(document_id) for document_id in documents)
+
+
+def encode_vector(vector):
+    """
+    Encodes a vector for a ``BinaryField``.
+
+    Args:
+        vector (list[float]): The vector.
+
+    Returns:
+        bytes: The vector as packed float32 values.
+    """
+    return array("f", vector).tobytes()
+
+
+def get_candidates(document_set, ttl):
+    """
+    Retrieves the answered questions over a set of documents that have an embedding.
+
+    Args:
+        document_set (str): The key of the document set.
+        ttl (int): The number of seconds answers are kept. Expired answers are not reused, even
+            before they are purged.
+
+    Returns:
+        QuerySet: The questions, most recent first.
+    """
+    return (
+        Question.objects.filter(document_set=document_set, status="success", embedding__isnull=False)
+        .exclude(answer="")
+        .exclude(_expired(ttl))
+        .order_by("-id")
+    )
+
+
+def copy_answer(question, match):
+    """
+    Gives a question the answer of a similar question, with its sources and size.
+
+    The answer keeps the time it was given, so that it expires with the answer it was copied from.
+
+    Args:
+        question (Question): The new question.
+        match (Question): The answered question.
+    """
+    question.answer = match.answer
+    question.sources = match.sources
+    question.prompt_tokens = match.prompt_tokens
+    question.answered_at = match.answered_at
+    question.status = "success"
+
+
+def get_claimable(question_id, timeout):
+    """
+    Retrieves a question unless it is being answered or has an answer.
+
+    Claiming a question is a conditional update of this queryset to ``in_progress``, setting
+    ``claimed_at``. The update locks the row and re-checks the condition after any concurrent update,
+    so of concurrent requests for the same question exactly one claims it and the others attach to
+    its task. A claim expires after ``timeout`` seconds, so that a question whose task was lost
+    without storing an outcome can be claimed again.
+
+    Args:
+        question_id (str): The ID of the question.
+        timeout (int): The number of seconds a claim lasts.
+
+    Returns:
+        QuerySet: The question, or nothing if it cannot be claimed.
+    """
+    claimed = Q(status="in_progress") & Q(claimed_at__gte=timezone.now() - timedelta(seconds=timeout))
+    return Question.objects.filter(question_id=question_id).exclude(
+        claimed | (Q(status="success") & ~Q(answer=""))
+    )
+
+
+def is_being_answered(question, timeout):
+    """
+    Checks whether a question is claimed by a task that may still store its answer.
+
+    Args:
+        question (Question): The question.
+        timeout (int): The number of seconds a claim lasts.
+
+    Returns:
+        bool: Whether the question is in progress and its claim has not expired.
+    """
+    return (
+        question.status == "in_progress"
+        and question.claimed_at is not None
+        and question.claimed_at >= timezone.now() - timedelta(seconds=timeout)
+    )
+
+
+def find_similar_answer(document_set, vector, threshold, max_candidates, ttl):
+    """
+    Finds the answered question over the same documents that is most similar to a new question.
+
+    Args:
+        document_set (str): The key of the document set.
+        vector (list[float]): The embedding of the new question.
+        threshold (float): The minimum cosine similarity of a match.
+        max_candidates (int): The number of most recent answered questions compared.
+        ttl (int): The number of seconds answers are kept.
+
+    Returns:
+        Question: The most similar question, or ``None`` if none is similar enough.
+    """
+    candidates = list(get_candidates(document_set, ttl).values_list("id", "embedding")[:max_candidates])
+    if not candidates:
+        return None
+
+    matrix = np.vstack([np.frombuffer(bytes(embedding), dtype=np.float32) for _, embedding in candidates])
+    query = np.asarray(vector, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+    similarities = matrix @ query / np.where(norms == 0, 1, norms)
+
+    best = int(np.argmax(similarities))
+    if similarities[best] < threshold:
+        return None
+    return Question.objects.get(id=candidates[best][0])
+
+
+def get_expired(ttl):
+    """
+    Retrieves the questions older than a time to live.
+
+    Answers expire ``ttl`` seconds after they were given. Questions without an answer, which failed
+    or whose task was lost, expire ``ttl`` seconds after they were first asked.
+
+    Args:
+        ttl (int): The number of seconds questions are kept.
+
+    Returns:
+        QuerySet: The expired questions.
+    """
+    return Question.objects.filter(_expired(ttl))
+
+
+def _expired(ttl):
+    cutoff = timezone.now() - timedelta(seconds=ttl)
+    return Q(answered_at__lt=cutoff) | Q(answered_at__isnull=True, created_at__lt=cutoff)
@@ -0,0 +1,188 @@
+"""
+This module contains async versions of the API views, served when the project runs under ASGI.
+
+They share their logic with the views in ``views.py`` through ``rag_qa.core.questions`` and
+``rag_qa.core.selection``, and only differ in how they read requests and reach the database, so that
+one worker process can hold many open polling connections. Calls that only exist as blocking APIs,
+such as sending a Celery task, run in a thread.
+"""
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.http import JsonResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import status
+
+from rag_qa.core.api.serializers import (
+    DocumentListSerializer,
+    DocumentSelectAllSerializer,
+    DocumentSelectionSerializer,
+    DocumentSerializer,
+    QuestionSerializer,
+)
+from rag_qa.core.api.views import paginate
+from rag_qa.core.helper import get_redis_client
+from rag_qa.core.models import Document
+from rag_qa.core.questions import ask_question
+from rag_qa.core.selection import (
+    get_document_page,
+    get_selected_documents,
+    invalidate_selected_documents,
+    select_matching,
+    update_selection,
+)
+from rag_qa.core.tasks import build_index, get_rag_response
+
+
+def _parse_json(request):
+    """
+    Parses the JSON body of a request.
+
+    :param request: The request.
+    :return: The parsed body, or None if it is not valid JSON.
+    """
+    try:
+        return json.loads(request.body)
+    except ValueError:
+        return None
+
+
+# ATOMIC_REQUESTS cannot wrap async views
+@method_decorator(transaction.non_atomic_requests, name="dispatch")
+@method_decorator(csrf_exempt, name="dispatch")
+class AsyncAPIView(View):
+    """
+    Base class of the async API views. Like the DRF views, they are open to anonymous clients.
+    """
+
+
+class AsyncDocumentIngestView(AsyncAPIView):
+    """
+    Handles the ingestion of documents into the system.
+    """
+
+    async def post(self, request):
+        """
+        Ingests a document into the system.
+
+        :param request: The request containing the document details.
+        :return: A response indicating the success or failure of the ingestion.
+        """
+        serializer = DocumentSerializer(data=_parse_json(request))
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        file_path = serializer.validated_data["file_path"]
+        document = await Document.objects.acreate(file_path=file_path, name=serializer.validated_data["name"])
+        # The document is committed by acreate, as there is no request transaction, so the task can
+        # be sent at once and finds it
+        await sync_to_async(build_index.apply_async, thread_sensitive=False)(args=[document.id])
+        await sync_to_async(invalidate_selected_documents)(get_redis_client())
+
+        return JsonResponse(
+            {"message": "Document ingested successfully", "file_path": file_path},
+            status=status.HTTP_201_CREATED,
+        )
+
+
+class AsyncDocumentSelectionView(AsyncAPIView):
+    """
+    Handles the selection of documents for processing.
+    """
+
+    async def get(self, request):
+        """
+        Retrieves a page of the documents in the system, as for ``DocumentSelectionView.get``.
+
+        :param request: The request for the list of documents.
+        :return: A response containing the list of documents.
+        """
+        serializer = DocumentListSerializer(data=request.GET.dict())
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        filters = dict(serializer.validated_data)
+        after = filters.pop("after", None)
+        limit = filters.pop("limit", settings.DOCUMENT_PAGE_SIZE)
+        rows = [row async for row in get_document_page(filters, limit, after)]
+        documents, link = paginate(request, rows, limit)
+        response = JsonResponse(documents, safe=False, status=status.HTTP_200_OK)
+        if link:
+            response["Link"] = link
+        return response
+
+    async def put(self, request):
+        """
+        Updates the selection status of documents.
+
+        The body is a list of documents or, to update all documents matching a filter, an object,
+        as for ``DocumentSelectionView.put``.
+
+        :param request: The request containing the document selection details.
+        :return: A response indicating the success or failure of the update.
+        """
+        data = _parse_json(request)
+        if isinstance(data, dict):
+            return await self._select_all(data)
+        serializer = DocumentSelectionSerializer(data=data, many=True)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, safe=False, status=status.HTTP_400_BAD_REQUEST)
+        await sync_to_async(update_selection)(get_redis_client(), serializer.validated_data)
+        return JsonResponse(serializer.data, safe=False, status=status.HTTP_200_OK)
+
+    async def _select_all(self, data):
+        """
+        Updates the selection status of all documents matching a filter.
+
+        :param data: The parsed body, with the selection status and the filter.
+        :return: A response containing the number of documents whose selection changed.
+        """
+        serializer = DocumentSelectAllSerializer(data=data)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        updated = await sync_to_async(select_matching)(
+            get_redis_client(), serializer.validated_data["selected"], serializer.validated_data.get("filter", {})
+        )
+        return JsonResponse({"updated": updated}, status=status.HTTP_200_OK)
+
+
+class AsyncQuestionAnswerView(AsyncAPIView):
+    """
+    Handles the processing of questions and retrieval of answers.
+    """
+
+    async def post(self, request):
+        """
+        Processes a question and retrieves an answer.
+
+        :param request: The request containing the question.
+        :return: A response containing the answer, the status of the processing, whether the answer was cached
+            and the question ID, which the answer can be streamed with.
+        """
+        serializer = QuestionSerializer(data=_parse_json(request))
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        selected = await self._get_documents()
+        # There is no request transaction, so the claim is made in one of its own
+        model_object, answer, cached, task = await sync_to_async(transaction.atomic(ask_question))(
+            serializer.validated_data["question"], selected
+        )
+        if task is not None:
+            await sync_to_async(get_rag_response.apply_async, thread_sensitive=False)(**task)
+
+        return JsonResponse(
+            {"answer": answer, "status": model_object.status, "cached": cached, "question_id": model_object.question_id},
+            status=status.HTTP_200_OK,
+        )
+
+    async def _get_documents(self):
+        """
+        Retrieves the documents that are selected for processing, without a query while they are unchanged.
+
+        :return: The selected documents, with their IDs, index versions and fingerprint.
+        """
+        # On the thread of the async ORM calls, as the documents may be read from the database
+        return await sync_to_async(get_selected_documents)(get_redis_client())
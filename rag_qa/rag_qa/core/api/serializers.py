@@ -1,3 +1,4 @@
+from django.conf import settings
 from rest_framework import serializers
 
 
@@ -9,5 +10,27 @@ class DocumentSelectionSerializer(serializers.Serializer):
     id = serializers.IntegerField()
     selected = serializers.BooleanField()
 
+class DocumentFilterSerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=512, required=False)
+    file_path = serializers.CharField(max_length=1024, required=False)
+    indexed = serializers.BooleanField(required=False)
+
+class DocumentListSerializer(DocumentFilterSerializer):
+    selected = serializers.BooleanField(required=False)
+    # The ID of the last document of the previous page
+    after = serializers.IntegerField(min_value=0, required=False)
+    limit = serializers.IntegerField(min_value=1, max_value=settings.DOCUMENT_PAGE_MAX_SIZE, required=False)
+
+class DocumentSelectAllSerializer(serializers.Serializer):
+    selected = serializers.BooleanField()
+    filter = DocumentFilterSerializer(required=False)
+
 class QuestionSerializer(serializers.Serializer):
-    question = serializers.CharField(max_length=2048)
\ No newline at end of file
+    question = serializers.CharField(max_length=2048)
+
+class QuestionBatchSerializer(serializers.Serializer):
+    questions = serializers.ListField(
+        child=serializers.CharField(max_length=2048),
+        min_length=1,
+        max_length=settings.QUESTION_BATCH_MAX_SIZE,
+    )
@@ -1,12 +1,19 @@
-import hashlib
-from django.test import TestCase
+import asyncio
+import json
+import threading
+from datetime import timedelta
+from django.db import connection
+from django.test import AsyncRequestFactory, TestCase, TransactionTestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
+from rag_qa.core.api.async_views import AsyncDocumentIngestView, AsyncDocumentSelectionView, AsyncQuestionAnswerView
 from rag_qa.core.api.views import QuestionAnswerView
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
 from unittest.mock import patch, MagicMock
 
-from rag_qa.core.models import Document, Question
+from rag_qa.core.answer_cache import encode_vector, get_document_set_key, get_question_key
+from rag_qa.core.models import Document, Question, QuestionBatch
 from rag_qa.core.api.serializers import DocumentSerializer, DocumentSelectionSerializer, QuestionSerializer
 
 class DocumentIngestViewTests(APITestCase):
@@ -54,6 +61,37 @@ class DocumentSelectionViewTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data), 2)
 
+    def test_documents_are_paginated_by_id(self):
+        """Test that pages follow each other through the Link header, with the same filters"""
+        Document.objects.bulk_create(
+            Document(file_path=f'/path/to/page{index}.pdf', name=f'Page {index}', selected=True) for index in range(4)
+        )
+        response = self.client.get(self.url, {'selected': 'true', 'limit': 2})
+        ids = [document['id'] for document in response.data]
+        self.assertEqual(response.data[0], {'id': self.doc1.id, 'selected': True})
+        self.assertIn('selected=true', response['Link'])
+        pages = 1
+        while 'Link' in response:
+            response = self.client.get(response['Link'].split(';')[0].strip('<>'))
+            ids += [document['id'] for document in response.data]
+            pages += 1
+        self.assertEqual(pages, 3)
+        self.assertEqual(ids, list(Document.objects.filter(selected=True).order_by('id').values_list('id', flat=True)))
+
+    def test_documents_are_filtered(self):
+        """Test filtering on the indexed status and a name prefix"""
+        Document.objects.create(file_path='/path/to/doc3.pdf', name='Report', indexed=True)
+        response = self.client.get(self.url, {'indexed': 'true'})
+        self.assertEqual(len(response.data), 1)
+        response = self.client.get(self.url, {'name': 'Doc'})
+        self.assertEqual([document['id'] for document in response.data], [self.doc1.id, self.doc2.id])
+        self.assertNotIn('Link', response)
+
+    def test_invalid_page_size(self):
+        """Test that a page size above the maximum is rejected"""
+        response = self.client.get(self.url, {'limit': 100000})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_update_document_selection(self):
         """Test updating document selection status"""
         payload = [
@@ -67,6 +105,38 @@ class DocumentSelectionViewTests(APITestCase):
         self.assertFalse(self.doc1.selected)
         self.assertTrue(self.doc2.selected)
 
+    def test_update_is_grouped_by_selection(self):
+        """Test that any number of documents is updated in one query per selection value"""
+        documents = Document.objects.bulk_create(
+            Document(file_path=f'/path/to/bulk{index}.pdf', name=f'Bulk {index}') for index in range(50)
+        )
+        payload = [{'id': document.id, 'selected': index % 2 == 0} for index, document in enumerate(documents)]
+        # The two updates, in the savepoint of the request transaction
+        with self.assertNumQueries(4):
+            response = self.client.put(self.url, payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Document.objects.filter(id__in=[document.id for document in documents], selected=True).count(), 25)
+
+    def test_select_all_matching_filter(self):
+        """Test that all documents matching the filter are updated, and only those that change are counted"""
+        Document.objects.create(file_path='/other/doc3.pdf', name='Doc 3', selected=False)
+        payload = {'selected': True, 'filter': {'file_path': '/path/to/'}}
+        response = self.client.put(self.url, payload, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'updated': 1})
+        self.assertEqual(set(Document.objects.filter(selected=True).values_list('name', flat=True)), {'Doc 1', 'Doc 2'})
+
+    def test_select_all_without_filter(self):
+        """Test that all documents are updated when no filter is given"""
+        response = self.client.put(self.url, {'selected': False}, format='json')
+        self.assertEqual(response.data, {'updated': 1})
+        self.assertFalse(Document.objects.filter(selected=True).exists())
+
+    def test_select_all_invalid_data(self):
+        """Test that an unknown selection value is rejected"""
+        response = self.client.put(self.url, {'selected': 'maybe'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
 class QuestionAnswerViewTests(APITestCase):
     def setUp(self):
         self.client = APIClient()
@@ -82,16 +152,47 @@ class QuestionAnswerViewTests(APITestCase):
 
     @patch('rag_qa.core.tasks.get_rag_response.apply_async')
     def test_ask_new_question(self, mock_get_response):
-        """Test asking a new question"""
-        mock_task = MagicMock()
-        mock_task.id = 'test-task-id'
-        mock_get_response.return_value = mock_task
-
-        response = self.client.post(self.url, self.valid_payload, format='json')
+        """Test asking a new question, whose task is sent after the claim is committed"""
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(self.url, self.valid_payload, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data['answer'], 'thinking...')
         self.assertEqual(response.data['status'], 'in_progress')
+        self.assertFalse(mock_get_response.called)
+
+        for callback in callbacks:
+            callback()
+        question = Question.objects.get(question_id=response.data['question_id'])
+        self.assertEqual(mock_get_response.call_args.kwargs['task_id'], question.answer_id)
+        self.assertEqual(mock_get_response.call_args.kwargs['kwargs'], {'question_id': question.question_id})
+
+    @patch('rag_qa.core.tasks.get_rag_response.apply_async')
+    def test_lost_question_is_claimed_again(self, mock_get_response):
+        """Test that a question whose claim expired without an outcome is answered again"""
+        question_id = get_question_key((self.doc.id,), (0,), self.valid_payload['question'])
+        Question.objects.create(
+            question_id=question_id, answer_id='lost-task-id', status='in_progress',
+            claimed_at=timezone.now() - timedelta(hours=1),
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.url, self.valid_payload, format='json')
+        self.assertEqual(response.data['answer'], 'thinking...')
         self.assertTrue(mock_get_response.called)
+        question = Question.objects.get(question_id=question_id)
+        self.assertNotEqual(question.answer_id, 'lost-task-id')
+        self.assertGreater(question.claimed_at, timezone.now() - timedelta(minutes=1))
+
+    @patch('rag_qa.core.tasks.get_rag_response.apply_async')
+    def test_claimed_question_is_not_answered_again(self, mock_get_response):
+        """Test that a question claimed recently attaches to its task"""
+        question_id = get_question_key((self.doc.id,), (0,), self.valid_payload['question'])
+        Question.objects.create(
+            question_id=question_id, answer_id='test-task-id', status='in_progress', claimed_at=timezone.now()
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.url, self.valid_payload, format='json')
+        self.assertEqual(response.data['answer'], 'thinking...')
+        self.assertFalse(mock_get_response.called)
 
     def test_ask_question_invalid_data(self):
         """Test asking question with invalid data"""
@@ -99,35 +200,499 @@ class QuestionAnswerViewTests(APITestCase):
         response = self.client.post(self.url, invalid_payload, format='json')
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
-    @patch('celery.result.AsyncResult')
-    @patch.object(QuestionAnswerView, '_check_task_status')
-    def test_check_existing_question_completed(self, mock_check_task_status, mock_async_result):
+    def test_check_existing_question_completed(self):
         """Test checking status of completed question"""
-        # Create a question with existing task
+        # Create a question whose task has stored its answer
         question = self.valid_payload.get('question')
         documents = tuple(Document.objects.filter(selected=True).order_by("id").values_list("id", flat=True))
-        print(f"Documents in test: {documents}")
-        question_id = hashlib.md5(f"{documents}_{question}".encode()).hexdigest()
-        print(f"Question ID in test: {question_id}")
+        question_id = get_question_key(documents, (0,), question)
         question = Question.objects.create(
             question_id=question_id,
             answer_id='test-task-id',
-            status='in_progress'
+            status='success',
+            answer='42'
         )
-        
-        # Mock the task result
-        mock_task = MagicMock()
-        mock_task.ready.return_value = True
-        mock_task.successful.return_value = True
-        mock_task.status = 'SUCCESS'
-        mock_task.get.return_value = '42'
-        mock_async_result.return_value = mock_task
-
-        mock_check_task_status.return_value = '42'
 
         # Ask the same question again
         response = self.client.post(self.url, self.valid_payload, format='json')
 
-        # mock_async_result.assert_called()
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data['answer'], '42')
\ No newline at end of file
+        self.assertEqual(response.data['answer'], '42')
+
+class SemanticAnswerCacheTests(APITestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.url = reverse('api:question-answer')
+        self.doc = Document.objects.create(
+            file_path='/path/to/doc.pdf',
+            name='Test Doc',
+            selected=True
+        )
+        self.answered = Question.objects.create(
+            question_id='answered',
+            status='success',
+            question_text='What is the refund policy?',
+            document_set=get_document_set_key((self.doc.id,), (0,)),
+            answer='30 days',
+            embedding=encode_vector([1.0, 0.0, 0.0]),
+            sources=[{'id': 'chunk', 'document_id': self.doc.id, 'page': 2, 'score': 0.9}],
+            prompt_tokens=120,
+            answered_at=timezone.now() - timedelta(hours=1),
+        )
+
+    @patch('rag_qa.core.tasks.get_rag_response.apply_async')
+    @patch('rag_qa.core.questions.embed_question')
+    def test_similar_question_returns_cached_answer(self, mock_embed_question, mock_get_response):
+        """Test that a rephrased question gets the stored answer without running the chain"""
+        mock_embed_question.return_value = [0.99, 0.05, 0.0]
+        response = self.client.post(self.url, {'question': "what's the refund policy"}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['answer'], '30 days')
+        self.assertEqual(response.data['status'], 'success')
+        self.assertTrue(response.data['cached'])
+        self.assertFalse(mock_get_response.called)
+        # The copy keeps the sources of the answer and expires with it
+        copy = Question.objects.get(question_id=response.data['question_id'])
+        self.assertEqual(
+            (copy.sources, copy.prompt_tokens, copy.answered_at),
+            (self.answered.sources, self.answered.prompt_tokens, self.answered.answered_at),
+        )
+
+    @override_settings(ANSWER_CACHE_TTL=60)
+    @patch('rag_qa.core.tasks.get_rag_response.apply_async')
+    @patch('rag_qa.core.questions.embed_question')
+    def test_expired_answer_is_not_reused(self, mock_embed_question, mock_get_response):
+        """Test that an answer older than the TTL is not reused before it is purged"""
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.url, {'question': "what's the refund policy"}, format='json')
+        self.assertFalse(response.data['cached'])
+        self.assertFalse(mock_embed_question.called)
+        self.assertTrue(mock_get_response.called)
+
+    @patch('rag_qa.core.tasks.get_rag_response.apply_async')
+    @patch('rag_qa.core.questions.embed_question')
+    def test_different_question_runs_chain(self, mock_embed_question, mock_get_response):
+        """Test that a question below the similarity threshold is answered by the chain"""
+        mock_embed_question.return_value = [0.0, 1.0, 0.0]
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.url, {'question': 'Who wrote the policy?'}, format='json')
+        self.assertEqual(response.data['status'], 'in_progress')
+        self.assertFalse(response.data['cached'])
+        self.assertTrue(mock_get_response.called)
+
+    @patch('rag_qa.core.tasks.get_rag_response.apply_async')
+    @patch('rag_qa.core.questions.embed_question')
+    def test_other_documents_are_not_reused(self, mock_embed_question, mock_get_response):
+        """Test that answers over other documents are not compared, so the question is not embedded"""
+        Document.objects.create(file_path='/path/to/other.pdf', name='Other Doc', selected=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.url, {'question': 'What is the refund policy?'}, format='json')
+        self.assertFalse(response.data['cached'])
+        self.assertFalse(mock_embed_question.called)
+        self.assertTrue(mock_get_response.called)
+
+    @patch('rag_qa.core.tasks.get_rag_response.apply_async')
+    def test_repeated_question_returns_stored_answer(self, mock_get_response):
+        """Test that the exact same question over the same documents is not answered again"""
+        question = 'What is the refund policy?'
+        documents = (self.doc.id,)
+        question_id = get_question_key(documents, (0,), question)
+        Question.objects.create(question_id=question_id, status='success', answer='30 days')
+        response = self.client.post(self.url, {'question': question}, format='json')
+        self.assertEqual(response.data['answer'], '30 days')
+        self.assertEqual(response.data['status'], 'success')
+        self.assertTrue(response.data['cached'])
+        self.assertFalse(mock_get_response.called)
+
+    @patch('rag_qa.core.tasks.get_rag_response.apply_async')
+    def test_reindexed_document_is_answered_again(self, mock_get_response):
+        """Test that answers over a previous index of the documents are not reused"""
+        question = 'What is the refund policy?'
+        Question.objects.create(question_id=get_question_key((self.doc.id,), (0,), question), status='success', answer='30 days')
+        Document.objects.filter(id=self.doc.id).update(index_version=1)
+        mock_get_response.return_value = MagicMock(id='test-task-id')
+        response = self.client.post(self.url, {'question': question}, format='json')
+        self.assertEqual(response.data['status'], 'in_progress')
+        self.assertFalse(response.data['cached'])
+        self.assertEqual(response.data['question_id'], get_question_key((self.doc.id,), (1,), question))
+
+
+class FakeAsyncRedis:
+    """An asyncio Redis stand-in with a backlog list and the messages its pub/sub receives."""
+
+    def __init__(self, backlog=(), messages=()):
+        self.backlog = [json.dumps(event) for event in backlog]
+        self.messages = [{"data": json.dumps(event)} for event in messages]
+        self.closed = False
+
+    async def lrange(self, key, start, end):
+        return self.backlog
+
+    def pubsub(self):
+        return self
+
+    async def subscribe(self, channel):
+        pass
+
+    async def unsubscribe(self, channel):
+        pass
+
+    async def get_message(self, ignore_subscribe_messages=True, timeout=None):
+        return self.messages.pop(0) if self.messages else None
+
+    async def aclose(self):
+        self.closed = True
+
+
+class QuestionAnswerStreamViewTests(TestCase):
+    async def _read(self, question_id):
+        response = await self.async_client.get(reverse('api:question-answer-stream', args=[question_id]))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        return b"".join([chunk async for chunk in response.streaming_content]).decode()
+
+    async def test_answered_question_is_sent_at_once(self):
+        """Test that a known answer is streamed as a single done event"""
+        await Question.objects.acreate(question_id='answered', status='success', answer='42')
+        body = await self._read('answered')
+        self.assertEqual(body, 'id: 1\nevent: done\ndata: {"answer": "42"}\n\n')
+
+    @override_settings(ASYNC_API=True)
+    async def test_tokens_are_streamed_without_duplicates(self):
+        """Test that a late client gets the backlog, then only newer events from the channel"""
+        await Question.objects.acreate(question_id='streaming', status='in_progress')
+        client = FakeAsyncRedis(
+            backlog=[{"seq": 1, "event": "token", "token": "Forty"}],
+            messages=[
+                {"seq": 1, "event": "token", "token": "Forty"},
+                {"seq": 2, "event": "token", "token": " two"},
+                {"seq": 3, "event": "done", "answer": "Forty two"},
+            ],
+        )
+        with patch('rag_qa.core.api.views.get_async_redis_client', return_value=client):
+            body = await self._read('streaming')
+        self.assertEqual(
+            [frame.split("\n")[0] for frame in body.strip().split("\n\n")],
+            ['id: 1', 'id: 2', 'id: 3'],
+        )
+        self.assertIn('event: done\ndata: {"answer": "Forty two"}', body)
+        self.assertTrue(client.closed)
+
+    async def test_unknown_question(self):
+        """Test that streaming an unknown question is a 404"""
+        response = await self.async_client.get(reverse('api:question-answer-stream', args=['unknown']))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(ASYNC_API=False)
+    def test_running_answer_is_not_streamed_under_wsgi(self):
+        """Test that under WSGI a running answer is refused and the client is sent to the poll endpoint"""
+        Question.objects.create(question_id='streaming', status='in_progress')
+        poll_url = reverse('api:question-answer-detail', args=['streaming'])
+        with patch('rag_qa.core.api.views.get_async_redis_client') as mock_client:
+            response = self.client.get(reverse('api:question-answer-stream', args=['streaming']))
+        self.assertEqual(response.status_code, status.HTTP_501_NOT_IMPLEMENTED)
+        self.assertEqual(response.json()['poll'], poll_url)
+        self.assertEqual(response['Link'], f'<{poll_url}>; rel="alternate"')
+        mock_client.assert_not_called()
+
+
+class QuestionAnswerDetailViewTests(TestCase):
+    def _poll(self, question_id, **headers):
+        return self.client.get(reverse('api:question-answer-detail', args=[question_id]), headers=headers)
+
+    def test_answered_question(self):
+        """Test that the answer, sources and timings stored by the task are returned"""
+        sources = [{'chunk_id': 'vector-1', 'document_id': 1, 'page': 3, 'relevance_score': 0.9}]
+        Question.objects.create(
+            question_id='answered', status='success', answer='42', sources=sources,
+            prompt_tokens=120, retrieval_seconds=0.1, generation_seconds=1.5,
+        )
+        response = self._poll('answered')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual((data['status'], data['answer'], data['sources']), ('success', '42', sources))
+        self.assertEqual((data['prompt_tokens'], data['generation_seconds']), (120, 1.5))
+        self.assertNotIn('Retry-After', response)
+
+    def test_unchanged_question_is_not_sent_again(self):
+        """Test that a poll with the ETag of the current state gets a 304, and a changed state a 200"""
+        Question.objects.create(question_id='pending', status='in_progress')
+        etag = self._poll('pending')['ETag']
+        response = self._poll('pending', if_none_match=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+
+        Question.objects.filter(question_id='pending').update(status='success', answer='42')
+        response = self._poll('pending', if_none_match=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    @override_settings(ANSWER_POLL_INTERVAL=5)
+    def test_pending_question_asks_to_retry_later(self):
+        """Test that polls of a question being answered are told when to poll again"""
+        Question.objects.create(question_id='pending', status='in_progress')
+        response = self._poll('pending')
+        self.assertEqual(response.json()['status'], 'in_progress')
+        self.assertEqual(response['Retry-After'], '5')
+
+    def test_unknown_question(self):
+        """Test that polling an unknown question is a 404"""
+        self.assertEqual(self._poll('unknown').status_code, status.HTTP_404_NOT_FOUND)
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+        self.doc = Document.objects.create(file_path='/path/to/doc.pdf', name='Test Doc', selected=True)
+        self.question_id = get_question_key((self.doc.id,), (0,), 'What is the meaning of life?')
+
+    async def _ask(self):
+        request = self.factory.post(
+            '/api/question-answer/', {'question': 'What is the meaning of life?'}, content_type='application/json'
+        )
+        response = await AsyncQuestionAnswerView.as_view()(request)
+        return response.status_code, json.loads(response.content)
+
+    @patch('rag_qa.core.tasks.get_rag_response.apply_async')
+    async def test_ask_new_question(self, mock_get_response):
+        """Test that a new question starts the task"""
+        status_code, data = await self._ask()
+        self.assertEqual(status_code, status.HTTP_200_OK)
+        self.assertEqual(data['answer'], 'thinking...')
+        self.assertEqual(data['question_id'], self.question_id)
+        question = await Question.objects.aget(question_id=self.question_id)
+        self.assertEqual(question.answer_id, mock_get_response.call_args.kwargs['task_id'])
+        self.assertEqual(question.status, 'in_progress')
+
+    async def test_poll_pending_question(self):
+        """Test that polling a running task does not start another"""
+        await Question.objects.acreate(
+            question_id=self.question_id, answer_id='test-task-id', status='in_progress', claimed_at=timezone.now()
+        )
+        with patch('rag_qa.core.tasks.get_rag_response.apply_async') as mock_get_response:
+            status_code, data = await self._ask()
+        self.assertEqual(data['answer'], 'thinking...')
+        self.assertEqual(data['status'], 'in_progress')
+        self.assertFalse(mock_get_response.called)
+
+    async def test_poll_completed_question(self):
+        """Test that the answer stored on the question by the task is returned"""
+        await Question.objects.acreate(
+            question_id=self.question_id, answer_id='test-task-id', status='success', answer='42'
+        )
+        status_code, data = await self._ask()
+        self.assertEqual(data['answer'], '42')
+        self.assertEqual(data['status'], 'success')
+        self.assertTrue(data['cached'])
+
+    async def test_failed_lookup_releases_the_claim(self):
+        """Test that a claim made by the async view is rolled back if looking up an answer fails"""
+        await Question.objects.acreate(
+            question_id='similar',
+            status='success',
+            document_set=get_document_set_key((self.doc.id,), (0,)),
+            answer='42',
+            embedding=encode_vector([1.0, 0.0]),
+        )
+        with patch('rag_qa.core.questions.embed_question', side_effect=RuntimeError('Embedding failed')):
+            with self.assertRaises(RuntimeError):
+                await self._ask()
+        self.assertFalse(await Question.objects.filter(question_id=self.question_id).aexists())
+
+    async def test_update_document_selection(self):
+        """Test updating document selection status"""
+        request = self.factory.put(
+            '/api/document/selection/', [{'id': self.doc.id, 'selected': False}], content_type='application/json'
+        )
+        response = await AsyncDocumentSelectionView.as_view()(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse((await Document.objects.aget(id=self.doc.id)).selected)
+
+    async def test_list_documents(self):
+        """Test that the async view pages through the documents"""
+        await Document.objects.acreate(file_path='/path/to/other.pdf', name='Other Doc')
+        response = await AsyncDocumentSelectionView.as_view()(self.factory.get('/api/document/selection/', {'limit': 1}))
+        self.assertEqual(json.loads(response.content), [{'id': self.doc.id, 'selected': True}])
+        self.assertIn(f'after={self.doc.id}', response['Link'])
+
+    async def test_select_all_matching_filter(self):
+        """Test that the async view updates all documents matching the filter"""
+        await Document.objects.acreate(file_path='/other/doc.pdf', name='Other Doc', selected=True)
+        request = self.factory.put(
+            '/api/document/selection/', {'selected': False, 'filter': {'name': 'Test'}}, content_type='application/json'
+        )
+        response = await AsyncDocumentSelectionView.as_view()(request)
+        self.assertEqual(json.loads(response.content), {'updated': 1})
+        self.assertTrue((await Document.objects.aget(name='Other Doc')).selected)
+
+
+class SingleFlightTests(TransactionTestCase):
+    """Concurrent requests for the same question must start a single task."""
+
+    clients = 8
+
+    def setUp(self):
+        Document.objects.create(file_path='/path/to/doc.pdf', name='Test Doc', selected=True)
+        self.url = reverse('api:question-answer')
+        self.payload = {'question': 'What is the meaning of life?'}
+
+    def _ask_concurrently(self):
+        barrier = threading.Barrier(self.clients)
+        responses = []
+
+        def ask():
+            try:
+                barrier.wait()
+                responses.append(APIClient().post(self.url, self.payload, format='json'))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=ask) for _ in range(self.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return responses
+
+    @patch('rag_qa.core.tasks.get_rag_response.apply_async')
+    def test_concurrent_requests_share_one_task(self, mock_get_response):
+        """Test that concurrent requests for a new question, each in its own transaction, attach to one task"""
+        responses = self._ask_concurrently()
+
+        self.assertEqual(mock_get_response.call_count, 1)
+        self.assertEqual([response.status_code for response in responses], [status.HTTP_200_OK] * self.clients)
+        self.assertEqual({response.data['answer'] for response in responses}, {'thinking...'})
+        question = Question.objects.get()
+        self.assertEqual((question.status, question.answer_id), ('in_progress', mock_get_response.call_args.kwargs['task_id']))
+
+    @patch('rag_qa.core.tasks.get_rag_response.apply_async')
+    def test_concurrent_retries_share_one_task(self, mock_get_response):
+        """Test that concurrent requests for a failed question start a single new task"""
+        question_id = get_question_key((Document.objects.get().id,), (0,), self.payload['question'])
+        Question.objects.create(question_id=question_id, answer_id='failed-task-id', status='failed')
+        responses = self._ask_concurrently()
+
+        self.assertEqual(mock_get_response.call_count, 1)
+        self.assertEqual({response.data['answer'] for response in responses}, {'thinking...'})
+        self.assertEqual(Question.objects.get().answer_id, mock_get_response.call_args.kwargs['task_id'])
+
+    @patch('rag_qa.core.tasks.get_rag_response.apply_async')
+    def test_concurrent_async_requests_share_one_task(self, mock_get_response):
+        """Test that concurrent requests to the async view attach to one task"""
+        mock_get_response.return_value = MagicMock(id='test-task-id')
+        factory = AsyncRequestFactory()
+
+        async def ask_all():
+            requests = [factory.post(self.url, self.payload, content_type='application/json') for _ in range(self.clients)]
+            return await asyncio.gather(*[AsyncQuestionAnswerView.as_view()(request) for request in requests])
+
+        responses = asyncio.run(ask_all())
+        self.assertEqual(mock_get_response.call_count, 1)
+        self.assertEqual({json.loads(response.content)['answer'] for response in responses}, {'thinking...'})
+
+    def test_fast_task_answer_is_kept_by_async_view(self):
+        """Test that an answer stored by the task before the async view resumes is not overwritten"""
+
+        def answer_at_once(args, kwargs, task_id):
+            try:
+                Question.objects.filter(question_id=kwargs['question_id'], answer_id=task_id).update(
+                    status='success', answer='42'
+                )
+            finally:
+                connection.close()
+
+        request = AsyncRequestFactory().post(self.url, self.payload, content_type='application/json')
+        with patch('rag_qa.core.tasks.get_rag_response.apply_async', side_effect=answer_at_once):
+            asyncio.run(AsyncQuestionAnswerView.as_view()(request))
+        question = Question.objects.get()
+        self.assertEqual((question.status, question.answer), ('success', '42'))
+        self.assertEqual(question.question_text, self.payload['question'])
+
+
+class AsyncIngestTests(TransactionTestCase):
+    def test_task_finds_the_ingested_document(self):
+        """Test that the async view sends build_index once the document is visible to other connections"""
+        seen = []
+
+        def build_index(args):
+            try:
+                seen.append(Document.objects.filter(id=args[0]).exists())
+            finally:
+                connection.close()
+
+        request = AsyncRequestFactory().post(
+            reverse('api:document-ingest'), {'file_path': '/path/to/doc.pdf', 'name': 'Doc'}, content_type='application/json'
+        )
+        with patch('rag_qa.core.tasks.build_index.apply_async', side_effect=build_index):
+            response = asyncio.run(AsyncDocumentIngestView.as_view()(request))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(seen, [True])
+
+
+class QuestionBatchViewTests(APITestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.url = reverse('api:question-batch')
+        self.doc = Document.objects.create(file_path='/path/to/doc.pdf', name='Test Doc', selected=True)
+
+    @patch('rag_qa.core.tasks.answer_question_batch.apply_async')
+    def test_submit_batch(self, mock_answer_batch):
+        """Test that a batch is stored with the selected documents and its task is sent after commit"""
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.url, {'questions': ['One?', 'Two?']}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['total'], 2)
+        batch = QuestionBatch.objects.get(batch_id=response.data['batch_id'])
+        self.assertEqual((batch.documents, batch.questions, batch.results), ([self.doc.id], ['One?', 'Two?'], [None, None]))
+        mock_answer_batch.assert_called_once_with(args=[batch.batch_id], task_id=batch.answer_id)
+
+    def test_submit_invalid_batch(self):
+        """Test that empty and oversized batches are rejected"""
+        self.assertEqual(self.client.post(self.url, {'questions': []}, format='json').status_code, status.HTTP_400_BAD_REQUEST)
+        oversized = {'questions': ['Why?'] * 501}
+        self.assertEqual(self.client.post(self.url, oversized, format='json').status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_poll_batch(self):
+        """Test polling the progress of a batch"""
+        QuestionBatch.objects.create(
+            batch_id='batch', status='in_progress', questions=['One?', 'Two?'],
+            results=[{'question': 'One?', 'answer': '1'}, None], completed=1,
+        )
+        response = self.client.get(reverse('api:question-batch-detail', args=['batch']))
+        self.assertEqual(response.data['completed'], 1)
+        self.assertEqual(response.data['total'], 2)
+        self.assertEqual(response.data['results'][1], None)
+        self.assertEqual(self.client.get(reverse('api:question-batch-detail', args=['unknown'])).status_code, status.HTTP_404_NOT_FOUND)
+
+
+class QuestionBatchStreamViewTests(TestCase):
+    async def test_finished_batch_is_sent_at_once(self):
+        """Test that the results of a finished batch are streamed as a single done event"""
+        results = [{'question': 'One?', 'answer': '1'}]
+        await QuestionBatch.objects.acreate(batch_id='done', status='success', questions=['One?'], results=results)
+        response = await self.async_client.get(reverse('api:question-batch-stream', args=['done']))
+        body = b"".join([chunk async for chunk in response.streaming_content]).decode()
+        self.assertTrue(body.startswith('id: 1\nevent: done\ndata: '))
+        self.assertEqual(json.loads(body.split('data: ')[1]), {'results': results})
+
+    @override_settings(ASYNC_API=True)
+    async def test_answers_are_streamed_until_done(self):
+        """Test that answer events do not end the stream of a running batch"""
+        await QuestionBatch.objects.acreate(batch_id='running', status='in_progress', questions=['One?', 'Two?'])
+        client = FakeAsyncRedis(messages=[
+            {"seq": 1, "event": "answer", "index": 1, "question": "Two?", "answer": "2"},
+            {"seq": 2, "event": "answer", "index": 0, "question": "One?", "answer": "1"},
+            {"seq": 3, "event": "done", "results": []},
+        ])
+        with patch('rag_qa.core.api.views.get_async_redis_client', return_value=client):
+            response = await self.async_client.get(reverse('api:question-batch-stream', args=['running']))
+            body = b"".join([chunk async for chunk in response.streaming_content]).decode()
+        self.assertEqual(body.count('event: answer'), 2)
+        self.assertTrue(body.endswith('event: done\ndata: {"results": []}\n\n'))
+
+    @override_settings(ASYNC_API=False)
+    def test_running_batch_is_not_streamed_under_wsgi(self):
+        """Test that under WSGI a running batch is refused and the client is sent to the poll endpoint"""
+        QuestionBatch.objects.create(batch_id='running', status='in_progress', questions=['One?'])
+        response = self.client.get(reverse('api:question-batch-stream', args=['running']))
+        self.assertEqual(response.status_code, status.HTTP_501_NOT_IMPLEMENTED)
+        self.assertEqual(response.json()['poll'], reverse('api:question-batch-detail', args=['running']))
@@ -1,26 +1,49 @@
 """
 This module contains API views for handling document ingestion and selection.
 """
+import hashlib
 import time
+import uuid
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import transaction
 
 from rest_framework import status
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from rest_framework.views import APIView
-import hashlib
 import json
 from django.http import HttpResponse
 from rag_qa.core.models import Question
 from django.views.decorators.csrf import csrf_exempt
 
-from rag_qa.core.tasks import get_rag_response
-from rag_qa.core.models import Document, Question
-from rag_qa.core.api.serializers import DocumentSelectionSerializer, DocumentSerializer, QuestionSerializer
+from rag_qa.core.tasks import answer_question_batch, get_rag_response
+from rag_qa.core.helper import get_async_redis_client, get_redis_client
+from rag_qa.core.questions import ask_question
+from rag_qa.core.selection import (
+    get_document_page,
+    get_selected_documents,
+    invalidate_selected_documents,
+    select_matching,
+    update_selection,
+)
+from rag_qa.core.streaming import get_batch_stream_id, single_event, stream_events
+from rag_qa.core.models import Document, Question, QuestionBatch
+from rag_qa.core.api.serializers import (
+    DocumentListSerializer,
+    DocumentSelectAllSerializer,
+    DocumentSelectionSerializer,
+    DocumentSerializer,
+    QuestionBatchSerializer,
+    QuestionSerializer,
+)
 from rag_qa.core.tasks import build_index
 
-from django.http import JsonResponse
-from celery.result import AsyncResult
+from django.http import HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.utils.http import parse_etags, quote_etag
+from django.views import View
+from django.urls import reverse
 
 class DocumentIngestView(APIView):
     """
@@ -69,6 +92,7 @@ class DocumentIngestView(APIView):
         """
         document_id = document.id
         transaction.on_commit(func=lambda: build_index.apply_async(args=[document_id]))
+        invalidate_selected_documents(get_redis_client())
 
     
 class DocumentSelectionView(APIView):
@@ -79,29 +103,63 @@ class DocumentSelectionView(APIView):
 
     def get(self, request):
         """
-        Retrieves a list of all documents in the system.
+        Retrieves a page of the documents in the system, in the order of their IDs.
+
+        The documents can be filtered with the ``indexed`` and ``selected`` query parameters and
+        the ``name`` and ``file_path`` prefixes. A page has up to ``limit`` documents,
+        ``DOCUMENT_PAGE_SIZE`` by default, and the link to the next page is in the Link header.
         
         :param request: The request for the list of documents.
         :return: A response containing the list of documents.
         """
-        documents = Document.objects.all() # TODO: Filter by indexed documents
-        serializer = DocumentSelectionSerializer(documents, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        # Unlike form data, a boolean left out of the query is not taken for false
+        serializer = DocumentListSerializer(data=request.query_params.dict())
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        filters = dict(serializer.validated_data)
+        after = filters.pop("after", None)
+        limit = filters.pop("limit", settings.DOCUMENT_PAGE_SIZE)
+        documents, link = paginate(request, list(get_document_page(filters, limit, after)), limit)
+        response = Response(documents, status=status.HTTP_200_OK)
+        if link:
+            response["Link"] = link
+        return response
 
     def put(self, request):
         """
         Updates the selection status of documents.
+
+        The body is either a list of documents, each with its ``id`` and whether it is ``selected``,
+        or an object with the ``selected`` value to set on all documents matching an optional
+        ``filter`` on ``name``, ``file_path`` and ``indexed``. Either takes at most two queries.
         
         :param request: The request containing the document selection details.
-        :return: A response indicating the success or failure of the update.
+        :return: A response indicating the success or failure of the update: the list of documents,
+            or the number of ``updated`` documents matching the filter.
         """
+        if isinstance(request.data, dict):
+            return self._select_all(request)
         serializer = DocumentSelectionSerializer(data=request.data, many=True)
         if serializer.is_valid():
-            for details in serializer.validated_data:
-                document = Document.objects.filter(id=details["id"]).update(selected=details["selected"])
+            update_selection(get_redis_client(), serializer.validated_data)
             return Response(serializer.data, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    def _select_all(self, request):
+        """
+        Updates the selection status of all documents matching a filter.
+
+        :param request: The request containing the selection status and the filter.
+        :return: A response containing the number of documents whose selection changed.
+        """
+        serializer = DocumentSelectAllSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        updated = select_matching(
+            get_redis_client(), serializer.validated_data["selected"], serializer.validated_data.get("filter", {})
+        )
+        return Response({"updated": updated}, status=status.HTTP_200_OK)
+
 class QuestionAnswerView(APIView):
     """
     Handles the processing of questions and retrieval of answers.
@@ -111,65 +169,270 @@ class QuestionAnswerView(APIView):
     def post(self, request):
         """
         Processes a question and retrieves an answer.
+
+        An answer already given to the same question, or to a similar question over the same
+        documents, is returned immediately and flagged as ``cached``. Concurrent requests for the
+        same question share a single task.
         
         :param request: The request containing the question.
-        :return: A response containing the answer and the status of the processing.
+        :return: A response containing the answer, the status of the processing, whether the answer was cached
+            and the question ID, which the answer can be streamed with.
         """
         serializer = QuestionSerializer(data=request.data)
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         
-        question = serializer.validated_data["question"]
-        documents = self._get_documents()
-        question_id = hashlib.md5(f"{documents}_{question}".encode()).hexdigest()
-        model_object, created = Question.objects.get_or_create(question_id=question_id)
-
-        if model_object.status == 'in_progress':
-            answer = self._check_progress(model_object)
-        else:
-            answer = self._initiate_task(model_object, documents, question)
+        model_object, answer, cached, task = ask_question(serializer.validated_data["question"], self._get_documents())
+        if task is not None:
+            # Sent once the claim is committed, so that the task finds the question to store its outcome on
+            transaction.on_commit(func=lambda: get_rag_response.apply_async(**task))
 
-        return Response({"answer": answer, "status": model_object.status}, status=status.HTTP_200_OK)
+        return Response(
+            {"answer": answer, "status": model_object.status, "cached": cached, "question_id": model_object.question_id},
+            status=status.HTTP_200_OK,
+        )
 
     def _get_documents(self):
         """
-        Retrieves a tuple of IDs of documents that are selected for processing.
+        Retrieves the documents that are selected for processing, without a query while they are unchanged.
         
-        :return: A tuple of document IDs.
+        :return: The selected documents, with their IDs, index versions and fingerprint.
         """
-        return tuple(Document.objects.filter(selected=True).order_by("id").values_list("id", flat=True))
+        return get_selected_documents(get_redis_client())
 
-    def _check_progress(self, model_object):
+
+# The fields of a question returned to polls
+POLL_FIELDS = (
+    "question_id",
+    "status",
+    "answer",
+    "sources",
+    "prompt_tokens",
+    "retrieval_seconds",
+    "generation_seconds",
+    "answered_at",
+)
+
+
+# ATOMIC_REQUESTS cannot wrap async views, and the poll only reads
+@method_decorator(transaction.non_atomic_requests, name="dispatch")
+class QuestionAnswerDetailView(View):
+    """
+    Handles the polling of questions.
+    """
+
+    async def get(self, request, question_id):
         """
-        Checks the progress of a question processing task.
-        
-        :param model_object: The model object representing the question.
-        :return: The answer to the question or a status message.
-        """
-        task = AsyncResult(model_object.answer_id)
-        if task.ready():
-            if task.status == 'SUCCESS':
-                answer = task.get()
-                model_object.status = 'success'
-            else:
-                answer = ""
-                model_object.status = 'failed'
-            model_object.save()
+        Retrieves the state of a question, as stored by the task answering it.
+
+        The response carries an ETag, so a poll with an unchanged state is answered with a 304, and
+        while the question is being answered a Retry-After header with the poll interval.
+
+        :param request: The request for the question.
+        :param question_id: The ID of the question, as returned by the question-answer endpoint.
+        :return: A response containing the status, the answer, its sources, the prompt size and the
+            timings of the answer, which are null until it is answered.
+        """
+        question = await Question.objects.filter(question_id=question_id).values(*POLL_FIELDS).afirst()
+        if question is None:
+            return JsonResponse({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        response = JsonResponse(question, encoder=DjangoJSONEncoder, status=status.HTTP_200_OK)
+        etag = quote_etag(hashlib.md5(response.content).hexdigest())
+        if etag in parse_etags(request.headers.get("If-None-Match", "")):
+            response = HttpResponseNotModified()
+        response["ETag"] = etag
+        # Clients must revalidate, the state changes when the answer is stored
+        response["Cache-Control"] = "no-cache"
+        if question["status"] == 'in_progress':
+            response["Retry-After"] = str(settings.ANSWER_POLL_INTERVAL)
+        return response
+
+
+# ATOMIC_REQUESTS cannot wrap async views, and the stream only reads
+@method_decorator(transaction.non_atomic_requests, name="dispatch")
+class QuestionAnswerStreamView(View):
+    """
+    Streams the answer to a question as Server-Sent Events while it is generated.
+    """
+
+    async def get(self, request, question_id):
+        """
+        Streams the events of an answer: ``token`` events, then ``done`` with the full answer, or
+        ``error``. An answer that is already known is sent as a single ``done`` event.
+        Running answers are only streamed under ASGI, otherwise the client is sent to the poll endpoint.
+
+        :param request: The request for the answer.
+        :param question_id: The ID of the question, as returned by the question-answer endpoint.
+        :return: A text/event-stream response.
+        """
+        question = await Question.objects.filter(question_id=question_id).afirst()
+        if question is None:
+            return JsonResponse({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        if question.status == 'success' and question.answer:
+            events = single_event({"seq": 1, "event": "done", "answer": question.answer})
+        elif question.status == 'in_progress':
+            if not settings.ASYNC_API:
+                return _stream_unavailable(reverse("api:question-answer-detail", args=[question_id]))
+            events = stream_events(
+                get_async_redis_client(),
+                question_id,
+                timeout=settings.ANSWER_STREAM_TIMEOUT,
+                keepalive=settings.ANSWER_STREAM_KEEPALIVE,
+            )
         else:
-            answer = "thinking..."
-        return answer
+            events = single_event({"seq": 1, "event": "error", "message": "The question could not be answered"})
+        return _event_stream_response(events)
+
 
-    def _initiate_task(self, model_object, documents, question):
+class QuestionBatchView(APIView):
+    """
+    Handles the submission of batches of questions answered together.
+    """
+    permission_classes = [AllowAny]
+
+    def post(self, request):
         """
-        Initiates the processing of a question.
-        
-        :param model_object: The model object representing the question.
-        :param documents: A tuple of document IDs.
-        :param question: The question to be processed.
-        :return: A status message indicating the initiation of processing.
-        """
-        task = get_rag_response.apply_async(args=[documents, question])
-        model_object.answer_id = task.id
-        model_object.status = 'in_progress'
-        model_object.save()
-        return "thinking..."
+        Submits a batch of questions over the selected documents.
+
+        :param request: The request containing the questions.
+        :return: A response containing the batch ID, which the batch can be polled and streamed with.
+        """
+        serializer = QuestionBatchSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        questions = serializer.validated_data["questions"]
+        documents = list(get_selected_documents(get_redis_client()).documents)
+        batch = QuestionBatch.objects.create(
+            batch_id=uuid.uuid4().hex,
+            status='in_progress',
+            answer_id=str(uuid.uuid4()),
+            documents=documents,
+            questions=questions,
+            results=[None] * len(questions),
+        )
+        batch_id, task_id = batch.batch_id, batch.answer_id
+        transaction.on_commit(func=lambda: answer_question_batch.apply_async(args=[batch_id], task_id=task_id))
+        return Response(
+            {"batch_id": batch_id, "status": batch.status, "total": len(questions)},
+            status=status.HTTP_202_ACCEPTED,
+        )
+
+
+class QuestionBatchDetailView(APIView):
+    """
+    Handles the polling of batches of questions.
+    """
+    permission_classes = [AllowAny]
+
+    def get(self, request, batch_id):
+        """
+        Retrieves the progress and results of a batch.
+
+        :param request: The request for the batch.
+        :param batch_id: The ID of the batch.
+        :return: A response containing the status of the batch, the number of answered questions and
+            the results, one per question, which are None until it is answered.
+        """
+        batch = QuestionBatch.objects.filter(batch_id=batch_id).first()
+        if batch is None:
+            return Response({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+        return Response(
+            {
+                "batch_id": batch_id,
+                "status": batch.status,
+                "completed": batch.completed,
+                "total": len(batch.questions),
+                "results": batch.results,
+            },
+            status=status.HTTP_200_OK,
+        )
+
+
+# ATOMIC_REQUESTS cannot wrap async views, and the stream only reads
+@method_decorator(transaction.non_atomic_requests, name="dispatch")
+class QuestionBatchStreamView(View):
+    """
+    Streams the answers of a batch of questions as Server-Sent Events as they arrive.
+    """
+
+    async def get(self, request, batch_id):
+        """
+        Streams the events of a batch: an ``answer`` event with the ``index`` of the question and its
+        ``answer`` or ``error``, then ``done`` with all results, or ``error``. A finished batch is sent
+        as a single ``done`` event.
+        Running answers are only streamed under ASGI, otherwise the client is sent to the poll endpoint.
+
+        :param request: The request for the answers.
+        :param batch_id: The ID of the batch.
+        :return: A text/event-stream response.
+        """
+        batch = await QuestionBatch.objects.filter(batch_id=batch_id).afirst()
+        if batch is None:
+            return JsonResponse({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        if batch.status == 'success':
+            events = single_event({"seq": 1, "event": "done", "results": batch.results})
+        elif batch.status == 'in_progress':
+            if not settings.ASYNC_API:
+                return _stream_unavailable(reverse("api:question-batch-detail", args=[batch_id]))
+            events = stream_events(
+                get_async_redis_client(),
+                get_batch_stream_id(batch_id),
+                timeout=settings.ANSWER_STREAM_TIMEOUT,
+                keepalive=settings.ANSWER_STREAM_KEEPALIVE,
+            )
+        else:
+            events = single_event({"seq": 1, "event": "error", "message": "The batch could not be answered"})
+        return _event_stream_response(events)
+
+
+def _stream_unavailable(poll_url):
+    """
+    Refuses to stream a running answer when the API is not served under ASGI.
+
+    Under WSGI, Django reads an async stream to its end before sending any of it, so the client would
+    get nothing until the answer is done while the stream holds a worker.
+
+    :param poll_url: The URL the answer can be polled at instead.
+    :return: A 501 response pointing to the poll URL.
+    """
+    response = JsonResponse(
+        {"detail": "Streaming needs the API to be served under ASGI, poll the answer instead.", "poll": poll_url},
+        status=status.HTTP_501_NOT_IMPLEMENTED,
+    )
+    response["Link"] = f'<{poll_url}>; rel="alternate"'
+    return response
+
+
+def _event_stream_response(events):
+    """
+    Wraps Server-Sent Events in a streaming response.
+
+    :param events: An async iterator of SSE frames.
+    :return: A text/event-stream response.
+    """
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Stop nginx from buffering the stream
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def paginate(request, rows, limit):
+    """
+    Splits the page of a keyset-paginated listing from the first row of the next page.
+
+    :param request: The request for the page.
+    :param rows: The rows of the page, and the first row of the next page if there is one.
+    :param limit: The number of rows on a page.
+    :return: The rows of the page, and the Link header to the next page, or None on the last page.
+    """
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    query = request.GET.copy()
+    query["after"] = rows[-1]["id"]
+    return rows, f'<{request.build_absolute_uri("?" + query.urlencode())}>; rel="next"'
@@ -0,0 +1,144 @@
+"""
+Helpers shared by the benchmark management commands.
+"""
+import math
+import multiprocessing
+import resource
+
+from langchain_community.embeddings import FakeEmbeddings
+
+SYNTHETIC_LINE = "The quick brown fox jumps over the lazy dog while the vector store keeps count"
+
+
+def write_synthetic_pdf(file_path, pages, lines_per_page=50, edited_pages=()):
+    """
+    Writes a text-only PDF with the given number of pages.
+
+    The file is written object by object, so generating very large documents does
+    not need much memory.
+
+    Args:
+        file_path (str): The path the PDF is written to.
+        pages (int): The number of pages.
+        lines_per_page (int): The number of text lines on each page.
+        edited_pages (tuple[int]): The 1-based numbers of pages whose text is marked as edited.
+    """
+    page_ids = [4 + 2 * index for index in range(pages)]
+    offsets = []
+
+    with open(file_path, "wb") as pdf:
+
+        def write_object(object_id, body):
+            offsets.append(pdf.tell())
+            pdf.write(b"%d 0 obj\n%s\nendobj\n" % (object_id, body))
+
+        pdf.write(b"%PDF-1.4\n")
+        write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        kids = b" ".join(b"%d 0 R" % page_id for page_id in page_ids)
+        write_object(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, pages))
+        write_object(3, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+        for number, page_id in enumerate(page_ids, start=1):
+            marker = " (edited)" if number in edited_pages else ""
+            lines = " ".join(
+                f"({SYNTHETIC_LINE} on page {number} line {line}{marker}) Tj T*"
+                for line in range(lines_per_page)
+            )
+            content = f"BT /F1 10 Tf 12 TL 36 760 Td {lines} ET".encode()
+            write_object(
+                page_id,
+                b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (page_id + 1),
+            )
+            write_object(
+                page_id + 1,
+                b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content),
+            )
+
+        xref_offset = pdf.tell()
+        pdf.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(offsets) + 1))
+        for offset in offsets:
+            pdf.write(b"%010d 00000 n \n" % offset)
+        pdf.write(
+            b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+            % (len(offsets) + 1, xref_offset),
+        )
+
+
+def fake_embeddings(size=1536):
+    """
+    Returns an embedder that produces random vectors without calling a provider.
+
+    Args:
+        size (int): The dimension of the vectors.
+
+    Returns:
+        FakeEmbeddings: The fake embedder.
+    """
+    return FakeEmbeddings(size=size)
+
+
+class DiscardingVectorStore:
+    """
+    A vector store stand-in that embeds what it receives and then throws it away.
+
+    Only the chunk count is kept, so the memory measured by a benchmark is the memory
+    used by the ingestion pipeline itself.
+    """
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        self.count = 0
+
+    def add_documents(self, documents, ids=None, **kwargs):
+        self.embeddings.embed_documents([document.page_content for document in documents])
+        self.count += len(documents)
+        return ids or [None] * len(documents)
+
+    def delete(self, ids=None, **kwargs):
+        self.count -= len(ids or [])
+
+
+def peak_rss_kib():
+    """
+    Returns the peak resident set size of the current process.
+
+    Returns:
+        int: The peak RSS in KiB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_in_child(func, *args):
+    """
+    Runs a function in a forked child process and returns its result.
+
+    Peak RSS can only grow within a process, so each measurement gets its own child.
+
+    Args:
+        func (callable): The function to run. Its return value must be picklable.
+        *args: The positional arguments passed to ``func``.
+
+    Returns:
+        object: The value returned by ``func``.
+    """
+    context = multiprocessing.get_context("fork")
+    with context.Pool(processes=1, maxtasksperchild=1) as pool:
+        return pool.apply(func, args)
+
+
+def percentile(values, fraction):
+    """
+    Returns a percentile of a list of measurements by the nearest-rank method.
+
+    Args:
+        values (list[float]): The measurements.
+        fraction (float): The percentile as a fraction, such as 0.95.
+
+    Returns:
+        float: The measurement at that rank, or 0.0 if there are none.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
@@ -0,0 +1,71 @@
+"""
+OpenAI clients shared by everything a process does, over one pooled HTTP client.
+
+Each LangChain OpenAI object otherwise opens its own HTTP client, so every task paid for new
+TCP and TLS handshakes. The clients are created once per process: Celery worker processes create
+them at ``worker_process_init``, and other processes on first use.
+"""
+import functools
+
+import httpx
+from django.conf import settings
+from langchain_openai import OpenAI, OpenAIEmbeddings
+
+
+@functools.cache
+def get_http_client():
+    """
+    Creates the HTTP client that the OpenAI clients of this process send their requests through.
+
+    Returns:
+        httpx.Client: A client keeping up to ``OPENAI_MAX_CONNECTIONS`` connections alive.
+    """
+    return httpx.Client(
+        limits=httpx.Limits(
+            max_connections=settings.OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.OPENAI_MAX_CONNECTIONS,
+        ),
+        timeout=settings.OPENAI_TIMEOUT,
+    )
+
+
+@functools.cache
+def get_llm():
+    """
+    Creates the LLM that answers questions.
+
+    Returns:
+        OpenAI: The LLM.
+    """
+    return OpenAI(temperature=1, base_url=settings.OPENAI_BASE_URL, http_client=get_http_client())
+
+
+@functools.cache
+def get_embeddings():
+    """
+    Creates the embedding model client.
+
+    Returns:
+        OpenAIEmbeddings: The embeddings, without any cache.
+    """
+    return OpenAIEmbeddings(base_url=settings.OPENAI_BASE_URL, http_client=get_http_client())
+
+
+def reset_clients():
+    """
+    Forgets the clients of this process, so that the next use creates new ones.
+
+    A forked process must not use the connections it inherited, which its parent still uses.
+    They are left open for the parent.
+    """
+    for factory in (get_embeddings, get_llm, get_http_client):
+        factory.cache_clear()
+
+
+def init_clients():
+    """
+    Creates the clients of a new process.
+    """
+    reset_clients()
+    get_llm()
+    get_embeddings()
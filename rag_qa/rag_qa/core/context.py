@@ -0,0 +1,114 @@
+"""
+Assembly of the retrieved chunks into a context that fits a token budget.
+"""
+import functools
+import logging
+
+import tiktoken
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# The chunk_overlap of the default text splitter, the most neighbouring chunks can share
+MAX_OVERLAP = 200
+# Shorter matches, such as a shared full stop, are coincidences
+MIN_OVERLAP = 20
+SEPARATOR = "\n\n"
+
+
+@functools.cache
+def _get_encoding():
+    """
+    Loads the tiktoken encoding that tokens are counted with.
+
+    Returns:
+        Encoding: The encoding, or None if it cannot be loaded, such as when its file cannot be downloaded.
+    """
+    try:
+        return tiktoken.get_encoding(settings.CONTEXT_TOKEN_ENCODING)
+    except Exception:
+        logger.warning("Cannot load the %s encoding, estimating token counts", settings.CONTEXT_TOKEN_ENCODING)
+        return None
+
+
+def count_tokens(text):
+    """
+    Counts the tokens of a text.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        int: The number of tokens, estimated as one per four characters if the encoding is unavailable.
+    """
+    encoding = _get_encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+# Chunks are retrieved again and again, so their counts are kept
+count_chunk_tokens = functools.lru_cache(maxsize=8192)(count_tokens)
+
+
+def _trim_overlap(text, kept_text):
+    """
+    Removes the part of a chunk that a neighbouring chunk of the same page already contains.
+
+    Args:
+        text (str): The text of the chunk.
+        kept_text (str): The text of a chunk already in the context.
+
+    Returns:
+        str: The text without the overlap, which is empty if the chunk is contained in ``kept_text``.
+    """
+    if text in kept_text:
+        return ""
+    for size in range(min(MAX_OVERLAP, len(text), len(kept_text)), MIN_OVERLAP - 1, -1):
+        if kept_text.endswith(text[:size]):
+            return text[size:].lstrip()
+        if kept_text.startswith(text[-size:]):
+            return text[:-size].rstrip()
+    return text
+
+
+def assemble_context(chunks, budget, count=count_chunk_tokens):
+    """
+    Fills a token budget with chunks, most relevant first.
+
+    Chunks contained in a chunk already added are dropped, and the text that a chunk shares with a
+    neighbouring chunk of the same page is added once. A chunk that does not fit the remaining
+    budget is skipped, so that a smaller, less relevant chunk can still use it.
+
+    Args:
+        chunks (list[Document]): The retrieved chunks, most relevant first.
+        budget (int): The maximum number of tokens of the context.
+        count (callable): Counts the tokens of a text.
+
+    Returns:
+        tuple[str, int, list[Document]]: The context, its number of tokens and the chunks it contains.
+    """
+    kept = []
+    sources = []
+    used = 0
+    separator_tokens = count(SEPARATOR)
+    for chunk in chunks:
+        page = (chunk.metadata.get("document_id"), chunk.metadata.get("page"))
+        text = chunk.page_content.strip()
+        for kept_page, kept_text in kept:
+            if kept_page == page:
+                text = _trim_overlap(text, kept_text)
+            elif text in kept_text:
+                text = ""
+            if not text:
+                break
+        if not text:
+            continue
+
+        tokens = count(text) + (separator_tokens if kept else 0)
+        if used + tokens > budget:
+            continue
+        kept.append((page, text))
+        sources.append(chunk)
+        used += tokens
+    return SEPARATOR.join(text for _, text in kept), used, sources
@@ -0,0 +1,401 @@
+"""
+Embedding wrappers used by the ingestion and query paths.
+"""
+import hashlib
+import threading
+import time
+import unicodedata
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import redis
+from django.utils import timezone
+from langchain_core.embeddings import Embeddings
+
+from rag_qa.core.context import count_tokens
+from rag_qa.core.models import EmbeddingCache
+
+# Cache entries are marked as used at most this often, so that most hits do not write
+TOUCH_INTERVAL = timedelta(minutes=1)
+
+
+def hash_text(text):
+    """
+    Hashes a text after normalizing its unicode form and whitespace.
+
+    Args:
+        text (str): The text to hash.
+
+    Returns:
+        str: The hex SHA-256 digest of the normalized text.
+    """
+    normalized = " ".join(unicodedata.normalize("NFKC", text).split())
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+class BatchedEmbeddings(Embeddings):
+    """
+    Embeds documents in token-sized batches, several batches at a time.
+
+    Texts are grouped in order into batches of at most ``max_batch_tokens`` tokens and
+    ``max_batch_size`` texts. Up to ``max_concurrency`` batches are sent to the wrapped
+    embedder at once and the vectors are returned in the order of the input texts.
+    """
+
+    def __init__(self, embeddings, max_batch_tokens, max_batch_size, max_concurrency, length_function=count_tokens):
+        """
+        Args:
+            embeddings (Embeddings): The embedder that does the actual work.
+            max_batch_tokens (int): The maximum number of tokens in one batch.
+            max_batch_size (int): The maximum number of texts in one batch.
+            max_concurrency (int): The maximum number of batches in flight at once.
+            length_function (callable): Returns the token count of a text.
+        """
+        self.embeddings = embeddings
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_concurrency = max_concurrency
+        self.length_function = length_function
+
+    def embed_documents(self, texts):
+        """
+        Embeds a list of texts.
+
+        Args:
+            texts (list[str]): The texts to embed.
+
+        Returns:
+            list[list[float]]: One vector per text, in the order of ``texts``.
+        """
+        batches = self._make_batches(texts)
+        if len(batches) <= 1 or self.max_concurrency <= 1:
+            return [vector for batch in batches for vector in self.embeddings.embed_documents(batch)]
+
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as executor:
+            results = executor.map(self.embeddings.embed_documents, batches)
+            return [vector for batch_vectors in results for vector in batch_vectors]
+
+    def embed_query(self, text):
+        """
+        Embeds a single query text.
+
+        Args:
+            text (str): The text to embed.
+
+        Returns:
+            list[float]: The vector for the text.
+        """
+        return self.embeddings.embed_query(text)
+
+    def _make_batches(self, texts):
+        """
+        Groups consecutive texts into batches bounded by token count and size.
+
+        A text that is longer than ``max_batch_tokens`` on its own gets a batch of its own.
+
+        Args:
+            texts (list[str]): The texts to group.
+
+        Returns:
+            list[list[str]]: The batches, in input order.
+        """
+        batches = []
+        batch = []
+        batch_tokens = 0
+        for text in texts:
+            tokens = self.length_function(text)
+            if batch and (batch_tokens + tokens > self.max_batch_tokens or len(batch) >= self.max_batch_size):
+                batches.append(batch)
+                batch = []
+                batch_tokens = 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Looks vectors up in the ``EmbeddingCache`` table before calling the wrapped embedder.
+
+    Entries are keyed by the embedding model and the hash of the normalized text, so the
+    same chunk is embedded once no matter which document or collection it belongs to.
+    The least recently used entries are evicted periodically by ``evict_embeddings``.
+    """
+
+    def __init__(self, embeddings, model_name):
+        """
+        Args:
+            embeddings (Embeddings): The embedder called on cache misses.
+            model_name (str): The name of the embedding model, part of the cache key.
+        """
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        """
+        Embeds a list of texts, calling the wrapped embedder only for texts not in the cache.
+
+        Args:
+            texts (list[str]): The texts to embed.
+
+        Returns:
+            list[list[float]]: One vector per text, in the order of ``texts``.
+        """
+        keys = [hash_text(text) for text in texts]
+        vectors = self._load(set(keys))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        if missing:
+            new_vectors = self.embeddings.embed_documents(list(missing.values()))
+            vectors.update(zip(missing.keys(), new_vectors))
+            self._store(dict(zip(missing.keys(), new_vectors)))
+
+        self._count(hits=len(texts) - len(missing), misses=len(missing))
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text):
+        """
+        Embeds a single query text, calling the wrapped embedder only on a cache miss.
+
+        Args:
+            text (str): The text to embed.
+
+        Returns:
+            list[float]: The vector for the text.
+        """
+        key = hash_text(text)
+        vector = self._load({key}).get(key)
+        if vector is not None:
+            self._count(hits=1, misses=0)
+            return vector
+
+        vector = self.embeddings.embed_query(text)
+        self._store({key: vector})
+        self._count(hits=0, misses=1)
+        return vector
+
+    def stats(self):
+        """
+        Returns the number of cache hits and misses seen by this object.
+
+        Returns:
+            dict: The ``hits`` and ``misses`` counts.
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+    def _count(self, hits, misses):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def _load(self, keys):
+        """
+        Loads the cached vectors for the given keys and marks them as recently used.
+
+        Entries already marked as used within ``TOUCH_INTERVAL`` are not written again.
+
+        Args:
+            keys (set[str]): The text hashes to look up.
+
+        Returns:
+            dict: The vectors found, keyed by text hash.
+        """
+        entries = EmbeddingCache.objects.filter(model_name=self.model_name, text_hash__in=keys)
+        now = timezone.now()
+        found = {}
+        stale = []
+        for entry_id, key, vector, last_used_at in entries.values_list("id", "text_hash", "vector", "last_used_at"):
+            found[key] = vector
+            if last_used_at < now - TOUCH_INTERVAL:
+                stale.append(entry_id)
+        if stale:
+            EmbeddingCache.objects.filter(id__in=stale).update(last_used_at=now)
+        return {key: array("f", bytes(vector)).tolist() for key, vector in found.items()}
+
+    def _store(self, vectors):
+        """
+        Stores new vectors.
+
+        Args:
+            vectors (dict): The vectors to store, keyed by text hash.
+        """
+        now = timezone.now()
+        EmbeddingCache.objects.bulk_create(
+            [
+                EmbeddingCache(
+                    model_name=self.model_name,
+                    text_hash=key,
+                    vector=array("f", vector).tobytes(),
+                    last_used_at=now,
+                )
+                for key, vector in vectors.items()
+            ],
+            ignore_conflicts=True,
+        )
+
+
+def evict_embeddings(max_entries, batch_size):
+    """
+    Deletes the least recently used entries of the ``EmbeddingCache`` table beyond ``max_entries``.
+
+    The table is counted once, and entries are deleted in batches of ``batch_size``, so that no
+    single statement holds locks on many rows.
+
+    Args:
+        max_entries (int): The number of entries kept in the cache.
+        batch_size (int): The number of entries deleted per statement.
+
+    Returns:
+        int: The number of deleted entries.
+    """
+    excess = EmbeddingCache.objects.count() - max_entries
+    deleted = 0
+    while excess > 0:
+        ids = list(EmbeddingCache.objects.order_by("last_used_at").values_list("id", flat=True)[:min(excess, batch_size)])
+        if not ids:
+            break
+        count = EmbeddingCache.objects.filter(id__in=ids).delete()[0]
+        deleted += count
+        excess -= len(ids)
+    return deleted
+
+
+class QueryEmbeddingCache(Embeddings):
+    """
+    Looks query vectors up in Redis before calling the wrapped embedder.
+
+    Entries are keyed by the embedding model and the hash of the normalized query text, and
+    expire ``ttl`` seconds after they were last used. A sorted set records when each entry was
+    last used, and the least recently used entries are evicted beyond ``max_entries``. When
+    Redis is unavailable the query is embedded directly.
+    """
+
+    KEY_PREFIX = "query-embedding"
+
+    def __init__(self, embeddings, model_name, client, ttl, max_entries):
+        """
+        Args:
+            embeddings (Embeddings): The embedder called on cache misses.
+            model_name (str): The name of the embedding model, part of the cache key.
+            client (Redis): The Redis client.
+            ttl (int): The number of seconds an unused entry is kept.
+            max_entries (int): The number of entries kept in the cache.
+        """
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.client = client
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lru_key = f"{self.KEY_PREFIX}:{model_name}:lru"
+
+    def embed_documents(self, texts):
+        """
+        Embeds a list of texts with the wrapped embedder, without caching them.
+
+        Args:
+            texts (list[str]): The texts to embed.
+
+        Returns:
+            list[list[float]]: One vector per text, in the order of ``texts``.
+        """
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        """
+        Embeds a query, calling the wrapped embedder only on a cache miss.
+
+        Args:
+            text (str): The query to embed.
+
+        Returns:
+            list[float]: The vector for the query.
+        """
+        key = f"{self.KEY_PREFIX}:{self.model_name}:{hash_text(text)}"
+        try:
+            cached = self.client.get(key)
+            if cached is not None:
+                self._touch(key)
+                return array("f", cached).tolist()
+        except redis.RedisError:
+            return self.embeddings.embed_query(text)
+
+        vector = self.embeddings.embed_query(text)
+        try:
+            self.client.set(key, array("f", vector).tobytes(), ex=self.ttl)
+            self._touch(key)
+            self._evict()
+        except redis.RedisError:
+            pass
+        return vector
+
+    def embed_queries(self, texts):
+        """
+        Embeds many queries, calling the wrapped embedder once for all cache misses.
+
+        Args:
+            texts (list[str]): The queries to embed.
+
+        Returns:
+            list[list[float]]: One vector per query, in the order of ``texts``.
+        """
+        if not texts:
+            return []
+        keys = [f"{self.KEY_PREFIX}:{self.model_name}:{hash_text(text)}" for text in texts]
+        try:
+            cached = self.client.mget(keys)
+        except redis.RedisError:
+            return self.embeddings.embed_documents(texts)
+
+        vectors = [None if value is None else array("f", value).tolist() for value in cached]
+        missing = {}
+        for index, vector in enumerate(vectors):
+            if vector is None:
+                missing.setdefault(keys[index], []).append(index)
+        if missing:
+            embedded = self.embeddings.embed_documents([texts[indexes[0]] for indexes in missing.values()])
+            for indexes, vector in zip(missing.values(), embedded):
+                for index in indexes:
+                    vectors[index] = vector
+        try:
+            if missing:
+                pipeline = self.client.pipeline()
+                for key, vector in zip(missing, embedded):
+                    pipeline.set(key, array("f", vector).tobytes(), ex=self.ttl)
+                pipeline.execute()
+            self._touch(*dict.fromkeys(keys))
+            if missing:
+                self._evict()
+        except redis.RedisError:
+            pass
+        return vectors
+
+    def _touch(self, *keys):
+        """
+        Marks entries as used now and restarts their TTL.
+        """
+        now = time.time()
+        pipeline = self.client.pipeline()
+        for key in keys:
+            pipeline.expire(key, self.ttl)
+        pipeline.zadd(self.lru_key, {key: now for key in keys})
+        pipeline.expire(self.lru_key, self.ttl)
+        pipeline.execute()
+
+    def _evict(self):
+        """
+        Deletes the least recently used entries beyond ``max_entries``.
+        """
+        excess = self.client.zcard(self.lru_key) - self.max_entries
+        if excess > 0:
+            stale = [key for key, _ in self.client.zpopmin(self.lru_key, excess)]
+            self.client.delete(*stale)
@@ -1,35 +1,514 @@
+import functools
 import os
+import threading
+import time
+import urllib.parse
+import uuid
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db.models import Max, Q
 
-from langchain.chains import RetrievalQA
-from langchain_community.document_loaders import PyPDFLoader
+from langchain.chains.retrieval_qa.prompt import PROMPT as QA_PROMPT
 from langchain_community.vectorstores import PGVector
-from langchain_openai import OpenAI, OpenAIEmbeddings
-from langchain.retrievers import MergerRetriever
+from langchain_core.documents import Document as LangchainDocument
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+import pypdf
+import redis
+import redis.asyncio
+import sqlalchemy
+from sqlalchemy.orm import Session
 
-from rag_qa.core.models import Document
+from rag_qa.core.clients import get_embeddings, get_llm
+from rag_qa.core.context import assemble_context, count_tokens
+from rag_qa.core.embeddings import BatchedEmbeddings, CachedEmbeddings, QueryEmbeddingCache, hash_text
+from rag_qa.core.models import Document, DocumentChunk
+from rag_qa.core.numpy_store import NumpyVectorStore
+from rag_qa.core.retrieval import ScoredMergeRetriever
+from rag_qa.core.selection import get_selected_documents
+from rag_qa.core import vector_index
 
-def update_vector_db(document_id):
+def update_vector_db(document_id, incremental=False, pages=None):
     """
     Updates the vector database with the embeddings of the specified document.
 
+    Pages are read lazily and written to the vector store in windows of
+    ``VECTOR_DB_INGEST_WINDOW_SIZE`` chunks, so peak memory depends on the
+    window size and not on the length of the document.
+
     Args:
         document_id (int): The ID of the document to be updated.
+        incremental (bool): Only write the chunks that changed since the document was last
+            indexed, instead of replacing all of them.
+        pages (range, optional): Only index these pages, for one shard of the document. A full
+            build of a shard adds its chunks without deleting the previous ones, which
+            ``delete_stale_chunks`` deletes once every shard is written.
+
+    Returns:
+        dict: The number of chunks ``added``, ``deleted`` and ``kept``, and the embedding
+            cache ``hits`` and ``misses`` seen while indexing the document.
+    """
+    document = Document.objects.get(id=document_id)
+
+    embeddings = _get_embeddings()
+
+    collection_name = _get_collection_name(document)
+
+    db = _create_database_object(embeddings, collection_name, _get_backend_engine())
+    backfill_chunks(document, db)
+    if incremental:
+        stats = _reindex_document(document, db, pages=pages)
+    elif pages is not None:
+        added = _ingest_document(document.file_path, db, document=document, pages=pages)
+        stats = {"added": added, "deleted": 0, "kept": 0}
+    else:
+        stats = _index_document(document, db)
+    stats.update(embeddings.stats())
+    return stats
+
+def count_pages(file_path):
+    """
+    Counts the pages of a PDF without extracting their text.
+
+    Args:
+        file_path (str): The path to the PDF file.
+
+    Returns:
+        int: The number of pages.
+    """
+    return len(pypdf.PdfReader(file_path).pages)
+
+def delete_stale_chunks(document_id, page_count, last_stale_id=None):
+    """
+    Deletes the chunks that a sharded build of a document left behind.
+
+    Args:
+        document_id (int): The ID of the document.
+        page_count (int): The number of pages of the file, beyond which chunks are stale.
+        last_stale_id (int, optional): After a full build, the ID of the last chunk written
+            before it, up to which every chunk is stale.
+
+    Returns:
+        int: The number of chunks deleted.
     """
     document = Document.objects.get(id=document_id)
+    chunks = _get_stale_chunks(document, last_stale_id, page_count)
+    if chunks:
+        db = _create_database_object(_get_embeddings(), _get_collection_name(document), _get_backend_engine())
+        _delete_chunks(db, chunks)
+    return len(chunks)
+
+def delete_new_chunks(document_id, last_stale_id=None):
+    """
+    Deletes the chunks that a failed sharded full build of a document wrote, so that it keeps
+    only the chunks it had before the build.
+
+    Args:
+        document_id (int): The ID of the document.
+        last_stale_id (int, optional): The ID of the last chunk written before the build, or None
+            if the document had no chunks.
+
+    Returns:
+        int: The number of chunks deleted.
+    """
+    document = Document.objects.get(id=document_id)
+    chunks = document.chunks.all()
+    if last_stale_id is not None:
+        chunks = chunks.filter(id__gt=last_stale_id)
+    chunks = list(chunks)
+    if chunks:
+        db = _create_database_object(_get_embeddings(), _get_collection_name(document), _get_backend_engine())
+        _delete_chunks(db, chunks)
+    return len(chunks)
+
+def backfill_chunks(document, db=None):
+    """
+    Records the chunks of a document indexed before chunks were recorded, so that a rebuild
+    replaces them instead of writing duplicates next to them.
+
+    Only per-document collections can hold such chunks: the shared collection is written with
+    records, and ``migrate_collection`` backfills the chunks it copies.
+
+    Args:
+        document (Document): The document.
+        db (VectorStore, optional): The vector store of the document. Created if not given.
+
+    Returns:
+        int: The number of chunks recorded.
+    """
+    if settings.VECTOR_DB_COLLECTION_LAYOUT == "shared" or document.chunks.exists():
+        return 0
+    if db is None:
+        db = _create_database_object(_get_embeddings(), _get_collection_name(document), _get_backend_engine())
+    records = [
+        DocumentChunk(
+            document=document,
+            page=metadata.get("page", 0),
+            # Unknown, so an incremental rebuild splits the page again and matches its chunks
+            page_fingerprint="",
+            fingerprint=hash_text(text),
+            vector_id=vector_id,
+        )
+        for vector_id, text, metadata in _iter_collection_chunks(db)
+    ]
+    DocumentChunk.objects.bulk_create(records, batch_size=settings.VECTOR_DB_INGEST_WINDOW_SIZE)
+    return len(records)
+
+def _iter_collection_chunks(db):
+    """
+    Reads the chunks stored in the collection of a vector store.
+
+    Args:
+        db (VectorStore): The vector store.
+
+    Yields:
+        tuple: The ``(vector_id, text, metadata)`` of each chunk. Nothing for stores other than
+            Pgvector, which have always been written with records.
+    """
+    if not isinstance(db, PGVector):
+        return
+    with Session(db._bind) as session:
+        collection = db.get_collection(session)
+        if collection is None:
+            return
+        rows = (
+            session.query(db.EmbeddingStore.custom_id, db.EmbeddingStore.document, db.EmbeddingStore.cmetadata)
+            .filter(db.EmbeddingStore.collection_id == collection.uuid)
+            .filter(db.EmbeddingStore.custom_id.isnot(None))
+            .yield_per(settings.VECTOR_DB_INGEST_WINDOW_SIZE)
+        )
+        for vector_id, text, metadata in rows:
+            yield vector_id, text, metadata or {}
+
+def get_last_chunk_id(document):
+    """
+    Retrieves the ID of the last chunk written for a document, before a full build replaces its chunks.
+
+    Args:
+        document (Document): The document.
+
+    Returns:
+        int: The ID, or None if the document has no chunks.
+    """
+    return document.chunks.aggregate(Max("id"))["id__max"]
+
+def _get_stale_chunks(document, last_stale_id=None, page_count=None):
+    """
+    Retrieves the chunks of a document that a build replaced.
+
+    Args:
+        document (Document): The document.
+        last_stale_id (int, optional): After a full build, the ID of the last chunk written before it.
+        page_count (int, optional): The number of pages of the file, beyond which chunks are stale.
+
+    Returns:
+        list[DocumentChunk]: The stale chunks.
+    """
+    stale = Q(id__lte=last_stale_id) if last_stale_id is not None else Q(pk__in=[])
+    if page_count is not None:
+        stale |= Q(page__gte=page_count)
+    return list(document.chunks.filter(stale))
+
+def _index_document(document, db):
+    """
+    Replaces all chunks of a document in the vector store.
+
+    The new chunks are written before the previous ones are deleted, so that the document keeps
+    its previous chunks if the build fails.
+
+    Args:
+        document (Document): The document to index.
+        db (VectorStore): The vector store the chunks are written to.
+
+    Returns:
+        dict: The number of chunks ``added``, ``deleted`` and ``kept``.
+    """
+    last_stale_id = get_last_chunk_id(document)
+    added = _ingest_document(document.file_path, db, document=document)
+    stale = _get_stale_chunks(document, last_stale_id)
+    _delete_chunks(db, stale)
+    return {"added": added, "deleted": len(stale), "kept": 0}
+
+def _reindex_document(document, db, window_size=None, pages=None):
+    """
+    Brings the chunks of a document in the vector store up to date with its file.
 
-    loader = PyPDFLoader(document.file_path)
-    pages = loader.load_and_split()
+    Pages whose fingerprint is unchanged are skipped without being split. Changed pages are
+    split again and only the chunks whose fingerprint is not already stored for that page are
+    embedded and written. Stored chunks that no longer appear are deleted.
 
-    embeddings = OpenAIEmbeddings()
+    Args:
+        document (Document): The document to re-index.
+        db (VectorStore): The vector store the chunks are written to.
+        window_size (int, optional): The number of chunks per window. Defaults to
+            the ``VECTOR_DB_INGEST_WINDOW_SIZE`` setting.
+        pages (range, optional): Only re-index these pages. Defaults to every page of the file.
+
+    Returns:
+        dict: The number of chunks ``added``, ``deleted`` and ``kept``.
+    """
+    if window_size is None:
+        window_size = settings.VECTOR_DB_INGEST_WINDOW_SIZE
+
+    stored_chunks = document.chunks.all()
+    if pages is not None:
+        stored_chunks = stored_chunks.filter(page__gte=pages.start, page__lt=pages.stop)
+    stored_pages = defaultdict(list)
+    for chunk in stored_chunks:
+        stored_pages[chunk.page].append(chunk)
+
+    stats = {"added": 0, "deleted": 0, "kept": 0}
+    window = []
+    kept = []
+    stale = []
+    for page_number, page_fingerprint, chunks in _iter_pages(document.file_path, pages):
+        stored = stored_pages.pop(page_number, [])
+        if stored and all(chunk.page_fingerprint == page_fingerprint for chunk in stored):
+            stats["kept"] += len(stored)
+            continue
+
+        stored_by_fingerprint = defaultdict(list)
+        for chunk in stored:
+            stored_by_fingerprint[chunk.fingerprint].append(chunk)
+        for chunk in chunks:
+            matches = stored_by_fingerprint.get(hash_text(chunk.page_content))
+            if matches:
+                match = matches.pop()
+                match.page_fingerprint = page_fingerprint
+                kept.append(match)
+                continue
+            window.append((page_fingerprint, chunk))
+            if len(window) >= window_size:
+                _write_window(db, window, document)
+                stats["added"] += len(window)
+                window = []
+        stale.extend(chunk for matches in stored_by_fingerprint.values() for chunk in matches)
+
+    if window:
+        _write_window(db, window, document)
+        stats["added"] += len(window)
+    # Pages that are no longer in the file
+    stale.extend(chunk for stored in stored_pages.values() for chunk in stored)
+
+    DocumentChunk.objects.bulk_update(kept, ["page_fingerprint"])
+    _delete_chunks(db, stale)
+    stats["kept"] += len(kept)
+    stats["deleted"] = len(stale)
+    return stats
+
+def _ingest_document(file_path, db, window_size=None, document=None, pages=None):
+    """
+    Streams a PDF into the vector store one window of chunks at a time.
+
+    Args:
+        file_path (str): The path to the PDF file.
+        db (VectorStore): The vector store the chunks are written to.
+        window_size (int, optional): The number of chunks per window. Defaults to
+            the ``VECTOR_DB_INGEST_WINDOW_SIZE`` setting.
+        document (Document, optional): The document the chunks are recorded for.
+        pages (range, optional): Only ingest these pages. Defaults to every page of the file.
+
+    Returns:
+        int: The number of chunks written.
+    """
+    if window_size is None:
+        window_size = settings.VECTOR_DB_INGEST_WINDOW_SIZE
+
+    chunk_count = 0
+    for window in _iter_chunk_windows(file_path, window_size, pages):
+        _write_window(db, window, document)
+        chunk_count += len(window)
+    return chunk_count
+
+def _write_window(db, window, document=None):
+    """
+    Embeds and writes a window of chunks to the vector store and records them for the document.
+
+    Args:
+        db (VectorStore): The vector store the chunks are written to.
+        window (list[tuple]): ``(page_fingerprint, chunk)`` pairs.
+        document (Document, optional): The document the chunks are recorded for.
+    """
+    vector_ids = [str(uuid.uuid4()) for _ in window]
+    if document is not None:
+        for _, chunk in window:
+            chunk.metadata["document_id"] = document.id
+    db.add_documents([chunk for _, chunk in window], ids=vector_ids)
+    if document is None:
+        return
+    DocumentChunk.objects.bulk_create(
+        DocumentChunk(
+            document=document,
+            page=chunk.metadata["page"],
+            page_fingerprint=page_fingerprint,
+            fingerprint=hash_text(chunk.page_content),
+            vector_id=vector_id,
+        )
+        for (page_fingerprint, chunk), vector_id in zip(window, vector_ids)
+    )
+
+def _delete_chunks(db, chunks):
+    """
+    Deletes chunks from the vector store and their records.
+
+    Args:
+        db (VectorStore): The vector store the chunks are deleted from.
+        chunks (list[DocumentChunk]): The chunks to delete.
+    """
+    if not chunks:
+        return
+    db.delete(ids=[chunk.vector_id for chunk in chunks])
+    DocumentChunk.objects.filter(id__in=[chunk.id for chunk in chunks]).delete()
+
+def _iter_chunk_windows(file_path, window_size, pages=None):
+    """
+    Lazily reads the pages of a PDF, splits them into chunks and groups the chunks into windows.
+
+    Args:
+        file_path (str): The path to the PDF file.
+        window_size (int): The maximum number of chunks per window.
+        pages (range, optional): The pages to read. Defaults to every page.
+
+    Yields:
+        list[tuple]: At most ``window_size`` ``(page_fingerprint, chunk)`` pairs.
+    """
+    window = []
+    for _, page_fingerprint, chunks in _iter_pages(file_path, pages):
+        for chunk in chunks:
+            window.append((page_fingerprint, chunk))
+            if len(window) >= window_size:
+                yield window
+                window = []
+    if window:
+        yield window
 
-    collection_name = document.name
+def _iter_pages(file_path, pages=None):
+    """
+    Lazily reads the pages of a PDF and splits each one into chunks.
+
+    The text of a page is only extracted when the page is reached, so that a shard of a long
+    document does not parse the pages of the other shards. Pages carry the same metadata as
+    those of ``PyPDFLoader``.
+
+    Args:
+        file_path (str): The path to the PDF file.
+        pages (range, optional): The pages to read. Defaults to every page.
+
+    Yields:
+        tuple: The page number, the fingerprint of the page text and the chunks of the page.
+    """
+    text_splitter = RecursiveCharacterTextSplitter()
+    reader = pypdf.PdfReader(file_path)
+    page_count = len(reader.pages)
+    if pages is None:
+        pages = range(page_count)
+    # The file may have lost pages since they were counted
+    for page_number in range(pages.start, min(pages.stop, page_count)):
+        page = LangchainDocument(
+            page_content=reader.pages[page_number].extract_text(),
+            metadata={"source": file_path, "page": page_number},
+        )
+        yield page_number, hash_text(page.page_content), text_splitter.split_documents([page])
+
+def _get_collection_name(document):
+    """
+    Retrieves the name of the vector store collection that holds the chunks of a document.
+
+    Args:
+        document (Document): The document.
+
+    Returns:
+        str: The shared collection name, or the document name when collections are per document.
+    """
+    if settings.VECTOR_DB_COLLECTION_LAYOUT == "shared":
+        return settings.VECTOR_DB_SHARED_COLLECTION
+    return document.name
+
+def _get_embeddings():
+    """
+    Creates the embeddings object used for documents and queries.
+
+    Returns:
+        CachedEmbeddings: OpenAI embeddings behind the embedding cache, sending cache misses
+            in token-sized batches concurrently.
+    """
+    embeddings = get_embeddings()
+    batched = BatchedEmbeddings(
+        embeddings,
+        max_batch_tokens=settings.EMBEDDING_BATCH_MAX_TOKENS,
+        max_batch_size=settings.EMBEDDING_BATCH_MAX_SIZE,
+        max_concurrency=settings.EMBEDDING_MAX_CONCURRENCY,
+    )
+    return CachedEmbeddings(batched, model_name=embeddings.model)
 
-    DATABASE_URL = _get_database_url()
+def embed_question(question):
+    """
+    Embeds a question through the query embedding cache, as retrieval does.
+
+    Args:
+        question (str): The question.
 
-    _create_database_object(pages, embeddings, collection_name, DATABASE_URL)
+    Returns:
+        list[float]: The vector of the question.
+    """
+    return _get_query_embeddings().embed_query(question)
+
+def embed_questions(questions):
+    """
+    Embeds many questions through the query embedding cache, with one call for all cache misses.
 
+    Args:
+        questions (list[str]): The questions.
+
+    Returns:
+        list[list[float]]: One vector per question, in order.
+    """
+    return _get_query_embeddings().embed_queries(questions)
+
+def _get_query_embeddings():
+    """
+    Creates the embeddings object used for questions.
+
+    Returns:
+        QueryEmbeddingCache: OpenAI embeddings behind the Redis query embedding cache.
+    """
+    embeddings = get_embeddings()
+    return QueryEmbeddingCache(
+        embeddings,
+        model_name=embeddings.model,
+        client=get_redis_client(),
+        ttl=settings.QUERY_EMBEDDING_CACHE_TTL,
+        max_entries=settings.QUERY_EMBEDDING_CACHE_MAX_ENTRIES,
+    )
+
+@functools.cache
+def get_redis_client():
+    """
+    Retrieves the process-wide client of the Redis server also used by Celery.
+
+    Returns:
+        Redis: The client. Its connection pool is recreated after a fork.
+    """
+    if settings.REDIS_SSL:
+        return redis.Redis.from_url(settings.REDIS_URL, ssl_cert_reqs=None)
+    return redis.Redis.from_url(settings.REDIS_URL)
+
+def get_async_redis_client():
+    """
+    Creates an asyncio client of the Redis server also used by Celery.
+
+    Asyncio clients are bound to their event loop, so each caller gets its own and closes it.
+
+    Returns:
+        redis.asyncio.Redis: The client.
+    """
+    if settings.REDIS_SSL:
+        return redis.asyncio.Redis.from_url(settings.REDIS_URL, ssl_cert_reqs=None)
+    return redis.asyncio.Redis.from_url(settings.REDIS_URL)
+
+@functools.cache
 def _get_database_url():
     """
     Retrieves the database URL for the Pgvector database.
@@ -42,63 +521,483 @@ def _get_database_url():
         os.getenv("DATABASE_URL") \
         .replace("postgres://", "postgresql://") \
         .replace("@postgres", "@pgvector")
-        
+
     return DATABASE_URL
 
-def _create_database_object(pages, embeddings, collection_name, DATABASE_URL):
+def _get_engine_args():
+    """
+    Retrieves the SQLAlchemy engine arguments for the Pgvector database.
+
+    Every connection sets the per-query ANN search parameters, ``hnsw.ef_search`` and
+    ``ivfflat.probes``, from settings.
+
+    Returns:
+        dict: The keyword arguments for ``sqlalchemy.create_engine``.
+    """
+    options = vector_index.get_search_options(settings.PGVECTOR_HNSW_EF_SEARCH, settings.PGVECTOR_IVFFLAT_PROBES)
+    return {
+        "connect_args": {"options": options},
+        "pool_size": settings.VECTOR_DB_POOL_SIZE,
+        "max_overflow": settings.VECTOR_DB_POOL_MAX_OVERFLOW,
+        "pool_pre_ping": True,
+    }
+
+class _VectorStoreRegistry:
+    """
+    Holds the Pgvector engine and the vector store objects of a process.
+
+    The engine, and with it a bounded connection pool, is created once per process. Vector store
+    objects are created once per collection and the least recently used ones are dropped beyond
+    ``VECTOR_DB_STORE_CACHE_SIZE``. Everything is created again in a forked child, since
+    connections cannot be shared across processes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._engine = None
+        self._stores = OrderedDict()
+
+    def get_engine(self):
+        """
+        Returns the engine of the current process, creating it on first use.
+
+        Returns:
+            Engine: The engine.
+        """
+        with self._lock:
+            self._check_process()
+            if self._engine is None:
+                self._engine = sqlalchemy.create_engine(_get_database_url(), **_get_engine_args())
+            return self._engine
+
+    def get_store(self, collection_name):
+        """
+        Returns the vector store object of a collection, creating it on first use.
+
+        Args:
+            collection_name (str): The name of the collection.
+
+        Returns:
+            VectorStore: The database object for the collection.
+        """
+        engine = self.get_engine() if settings.VECTOR_DB_BACKEND == "pgvector" else None
+        with self._lock:
+            db = self._stores.get(collection_name)
+            if db is not None:
+                self._stores.move_to_end(collection_name)
+                return db
+
+        db = _create_database_object(_get_embeddings(), collection_name, engine)
+        with self._lock:
+            self._stores[collection_name] = db
+            self._stores.move_to_end(collection_name)
+            while len(self._stores) > settings.VECTOR_DB_STORE_CACHE_SIZE:
+                self._stores.popitem(last=False)
+        return db
+
+    def clear(self):
+        """
+        Drops the vector store objects and disposes of the engine.
+        """
+        with self._lock:
+            if self._engine is not None:
+                self._engine.dispose()
+            self._engine = None
+            self._stores.clear()
+
+    def _check_process(self):
+        if self._pid == os.getpid():
+            return
+        if self._engine is not None:
+            # Leave the parent's connections open for the parent
+            self._engine.dispose(close=False)
+        self._pid = os.getpid()
+        self._engine = None
+        self._stores.clear()
+
+_registry = _VectorStoreRegistry()
+
+def _get_engine():
+    """
+    Retrieves the process-wide SQLAlchemy engine for the Pgvector database.
+
+    Returns:
+        Engine: The engine.
+    """
+    return _registry.get_engine()
+
+def _get_backend_engine():
+    """
+    Retrieves the engine needed by the configured vector store backend.
+
+    Returns:
+        Engine: The Pgvector engine, or ``None`` for backends that do not use a database.
+    """
+    if settings.VECTOR_DB_BACKEND == "pgvector":
+        return _get_engine()
+    return None
+
+def ensure_vector_index():
+    """
+    Creates the ANN index on the embeddings table with the settings' parameters, unless it exists.
+
+    Returns:
+        float: The time it took to build the index in seconds, or ``None`` if it already existed.
+    """
+    engine = _get_engine()
+    if vector_index.get_index_definition(engine) is not None:
+        return None
+    return vector_index.create_index(
+        engine,
+        method=settings.PGVECTOR_INDEX_METHOD,
+        dimensions=settings.PGVECTOR_DIMENSIONS,
+        m=settings.PGVECTOR_HNSW_M,
+        ef_construction=settings.PGVECTOR_HNSW_EF_CONSTRUCTION,
+        lists=settings.PGVECTOR_IVFFLAT_LISTS,
+    )
+
+def _create_database_object(embeddings, collection_name, engine):
     """
-    Creates a database object in the vector store using the provided documents and embeddings.
+    Creates a database object in the vector store for the given collection, creating the collection if needed.
+
+    The ``VECTOR_DB_BACKEND`` setting selects between the Pgvector database and the in-process
+    NumPy store.
 
     Args:
-        pages (list): The list of document pages to be stored.
-        embeddings (OpenAIEmbeddings): The embeddings to be used for the documents.
+        embeddings (Embeddings): The embeddings to be used for the documents.
         collection_name (str): The name of the collection in the database.
-        DATABASE_URL (str): The connection string for the database.
+        engine (Engine): The engine of the Pgvector database, unused by the NumPy store.
+
+    Returns:
+        VectorStore: The database object for the collection.
+
+    Raises:
+        ValueError: If the backend is not supported.
     """
-    db = PGVector.from_documents(
-        embedding=embeddings,
-        documents=pages,
+    if settings.VECTOR_DB_BACKEND == "numpy":
+        return NumpyVectorStore(
+            embeddings,
+            # Document names may contain path separators
+            os.path.join(settings.VECTOR_DB_NUMPY_DIR, urllib.parse.quote(collection_name, safe="")),
+            block_size=settings.VECTOR_DB_NUMPY_BLOCK_SIZE,
+            max_shards=settings.VECTOR_DB_NUMPY_MAX_SHARDS,
+        )
+    if settings.VECTOR_DB_BACKEND != "pgvector":
+        raise ValueError(f"Unsupported vector store backend: {settings.VECTOR_DB_BACKEND}")
+
+    db = PGVector(
+        embedding_function=embeddings,
         collection_name=collection_name,
-        connection_string=DATABASE_URL,
+        connection_string=_get_database_url(),
+        connection=engine,
     )
+    return db
 
-def query_vector_db(collection_names, query):
+def query_vector_db(document_ids, query, on_token=None):
     """
-    Queries the vector database for the specified query across the given collection names.
+    Queries the vector database for the specified query across the given documents.
 
     Args:
-        collection_names (list): A list of collection names to query.
+        document_ids (list[int]): The IDs of the documents to query.
         query (str): The query string to search for.
+        on_token (callable, optional): Called with every token of the answer.
 
     Returns:
         str: The result of the query.
     """
-    retriever = _get_retriever_object(collection_names)
-    # create retrieval qa chain for answering questions
-    qa = RetrievalQA.from_chain_type(llm=OpenAI(temperature=1), chain_type="stuff", retriever=retriever)
+    return answer_query(document_ids, query, on_token=on_token)["answer"]
+
+def answer_query(document_ids, query, on_token=None):
+    """
+    Answers a query across the given documents and describes how the answer was made.
 
-    result = qa.invoke(query).get("result")
-    return result
+    The retrieved chunks are stuffed into the question answering prompt, up to the context token
+    budget, and the answer is streamed from the LLM, so that its tokens can be passed on as they
+    are generated.
 
-def _get_retriever_object(collection_names):
+    Args:
+        document_ids (list[int]): The IDs of the documents to query.
+        query (str): The query string to search for.
+        on_token (callable, optional): Called with every token of the answer.
+
+    Returns:
+        dict: The ``answer``, the ``sources`` it was generated from (see ``_get_sources``), the
+            number of ``prompt_tokens``, and the ``retrieval_seconds`` and ``generation_seconds``.
     """
-    Creates a retriever object that merges retrievers from the specified collection names.
+    started = time.perf_counter()
+    retriever = _get_retriever_object(document_ids)
+    chunks = retriever.invoke(query)
+    prompt, used = _build_prompt(chunks, query)
+    retrieved = time.perf_counter()
+
+    tokens = []
+    for token in _get_llm().stream(prompt):
+        tokens.append(token)
+        if on_token is not None:
+            on_token(token)
+    return {
+        "answer": "".join(tokens),
+        "sources": _get_sources(used),
+        "prompt_tokens": count_tokens(prompt),
+        "retrieval_seconds": retrieved - started,
+        "generation_seconds": time.perf_counter() - retrieved,
+    }
+
+def _get_sources(chunks):
+    """
+    Describes the chunks an answer was generated from.
+
+    Stores that do not return the IDs of their chunks, such as pgvector, have them looked up in the
+    chunk records by document, page and fingerprint.
 
     Args:
-        collection_names (list): A list of collection names to create retrievers for.
+        chunks (list[Document]): The chunks in the prompt, most relevant first.
 
     Returns:
-        MergerRetriever: A merged retriever object.
+        list[dict]: The ``chunk_id``, ``document_id``, ``page`` and ``relevance_score`` of each chunk.
     """
-    retrievers = []
-    for collection_name in collection_names:
-        # get the langchain db object from the database using the collection name
-        db = _get_db_by_name(collection_name)
-        # create a retriever object by calling the vectorstore.as_retriever() method
-        retriever = db.as_retriever()
-        retrievers.append(retriever)
-    retriever = MergerRetriever(retrievers=retrievers)
-    return retriever
+    # Chunks are identified by document, page and fingerprint in the chunk records
+    keys = []
+    for chunk in chunks:
+        document_id = chunk.metadata.get("document_id")
+        document_id = None if document_id is None else int(document_id)
+        keys.append((document_id, chunk.metadata.get("page"), hash_text(chunk.page_content)))
+    missing = [key for chunk, key in zip(chunks, keys) if chunk.id is None and key[0] is not None]
+    vector_ids = {}
+    if missing:
+        records = DocumentChunk.objects.filter(
+            document_id__in={document_id for document_id, _, _ in missing},
+            fingerprint__in={fingerprint for _, _, fingerprint in missing},
+        ).values_list("document_id", "page", "fingerprint", "vector_id")
+        vector_ids = {tuple(record[:3]): record[3] for record in records}
+
+    return [
+        {
+            "chunk_id": chunk.id or vector_ids.get(key),
+            "document_id": key[0],
+            "page": key[1],
+            "relevance_score": chunk.metadata.get("relevance_score"),
+        }
+        for chunk, key in zip(chunks, keys)
+    ]
+
+def query_vector_db_batch(document_ids, queries, vectors, on_answers=None):
+    """
+    Answers many queries across the given documents.
+
+    Retrieval for all queries is one multi-query step over the query vectors. The prompts are sent
+    to the LLM in groups of ``QUESTION_BATCH_PROMPTS_PER_CALL``, one completion request per group,
+    with up to ``QUESTION_BATCH_LLM_CONCURRENCY`` requests in flight.
+
+    Args:
+        document_ids (list[int]): The IDs of the documents to query.
+        queries (list[str]): The query strings.
+        vectors (list[list[float]]): The vectors of the queries, see ``embed_questions``.
+        on_answers (callable, optional): Called with the ``(index, answer)`` pairs of every group
+            as it completes.
+
+    Returns:
+        list: For each query, its answer, or the exception that failed it.
+    """
+    retriever = _get_retriever_object(document_ids)
+    prompts = [
+        _build_prompt(chunks, query)[0]
+        for chunks, query in zip(retriever.retrieve_by_vectors(vectors), queries)
+    ]
+
+    llm = _get_llm()
+    size = settings.QUESTION_BATCH_PROMPTS_PER_CALL
+    groups = [range(start, min(start + size, len(prompts))) for start in range(0, len(prompts), size)]
+    answers = [None] * len(prompts)
+    with ThreadPoolExecutor(max_workers=settings.QUESTION_BATCH_LLM_CONCURRENCY) as executor:
+        futures = {
+            executor.submit(llm.batch, [prompts[index] for index in group], return_exceptions=True): group
+            for group in groups
+        }
+        for future in as_completed(futures):
+            pairs = list(zip(futures[future], future.result()))
+            for index, answer in pairs:
+                answers[index] = answer
+            if on_answers is not None:
+                on_answers(pairs)
+    return answers
+
+def _build_prompt(chunks, query):
+    """
+    Builds the question answering prompt of the "stuff" chain from the retrieved chunks.
+
+    Args:
+        chunks (list[Document]): The retrieved chunks, most relevant first.
+        query (str): The question.
+
+    Returns:
+        tuple[str, list[Document]]: The prompt and the chunks it contains.
+    """
+    context, _, used = assemble_context(chunks, settings.CONTEXT_TOKEN_BUDGET)
+    return QA_PROMPT.format(context=context, question=query), used
+
+def _get_llm():
+    """
+    Returns the LLM that answers questions, shared by the tasks of the process.
+
+    Returns:
+        OpenAI: The LLM.
+    """
+    return get_llm()
+
+def _get_retriever_object(document_ids):
+    """
+    Creates a retriever object over the chunks of the specified documents.
+
+    The question is embedded once, through the query embedding cache, and every collection is
+    searched by that vector. With the shared collection layout this is a single nearest-neighbour
+    query filtered on ``document_id``. With one collection per document, the collections are
+    queried concurrently and their scored results merged. Either way the results are the global
+    top ``RETRIEVAL_TOP_K`` chunks, with at most ``RETRIEVAL_PER_DOCUMENT_CAP`` chunks per document
+    when it is set.
+
+    Args:
+        document_ids (list[int]): The IDs of the documents to create the retriever for.
+
+    Returns:
+        BaseRetriever: The retriever object.
+    """
+    top_k = settings.RETRIEVAL_TOP_K
+    cap = settings.RETRIEVAL_PER_DOCUMENT_CAP
+    embeddings = _get_query_embeddings()
+    if settings.VECTOR_DB_COLLECTION_LAYOUT == "shared":
+        db = _get_db_by_name(settings.VECTOR_DB_SHARED_COLLECTION)
+        return ScoredMergeRetriever(
+            stores=[db],
+            embeddings=embeddings,
+            k=top_k,
+            # Fetch more than k, so that k chunks are left once the cap has skipped some
+            fetch_k=top_k if cap is None else max(top_k, settings.RETRIEVAL_FETCH_K),
+            per_document_cap=cap,
+            search_kwargs={"filter": _get_document_filter(document_ids)},
+        )
+
+    # get the langchain db object of each document from the database using the collection name
+    stores = [_get_db_by_name(collection_name) for collection_name in _get_collection_names(document_ids)]
+    return ScoredMergeRetriever(
+        stores=stores,
+        embeddings=embeddings,
+        k=top_k,
+        # A collection holds one document, so it never needs to return more than the cap
+        fetch_k=min(top_k, cap) if cap is not None else top_k,
+        per_document_cap=cap,
+        max_concurrency=settings.RETRIEVAL_MAX_CONCURRENCY,
+    )
+
+def _get_document_filter(document_ids):
+    """
+    Creates a metadata filter that matches the chunks of the given documents.
+
+    Args:
+        document_ids (list[int]): The IDs of the documents.
+
+    Returns:
+        dict: The filter, in the JSON metadata syntax of PGVector.
+    """
+    # Metadata values are compared as text
+    return {"document_id": {"in": [str(document_id) for document_id in document_ids]}}
+
+def _get_collection_names(document_ids):
+    """
+    Retrieves the collection names of documents based on their IDs.
+
+    The names of selected documents, which questions are asked over, are taken from the selected
+    documents cached in this process.
+
+    Args:
+        document_ids (list[int]): The IDs of the documents.
+
+    Returns:
+        list[str]: The collection names of the documents.
+    """
+    names = get_selected_documents(get_redis_client()).names
+    if all(document_id in names for document_id in document_ids):
+        return [names[document_id] for document_id in document_ids]
+    return list(Document.objects.filter(id__in=document_ids).values_list("name", flat=True))
+
+def migrate_collection(document, shared_db, batch_size, delete_source=False):
+    """
+    Copies the chunks of a per-document collection into the shared collection, tagged with the document ID.
+
+    Vectors are copied as they are, so nothing is embedded again. Chunks keep their IDs, and a copy
+    already in the shared collection is replaced, so the migration can be re-run. Documents indexed
+    before chunks were recorded get their ``DocumentChunk`` rows backfilled, so that full and
+    incremental rebuilds can find the migrated chunks.
+
+    Args:
+        document (Document): The document whose collection is migrated.
+        shared_db (PGVector): The database object of the shared collection.
+        batch_size (int): The number of chunks copied per round trip.
+        delete_source (bool): Delete the per-document collection once it has been copied.
+
+    Returns:
+        int: The number of chunks copied, or ``None`` if the document has no collection.
+    """
+    backfill = not document.chunks.exists()
+    copied = 0
+    with Session(shared_db._bind) as session:
+        collection = shared_db.CollectionStore.get_by_name(session, document.name)
+        if collection is None:
+            return None
+
+        rows = (
+            session.query(shared_db.EmbeddingStore)
+            .filter(shared_db.EmbeddingStore.collection_id == collection.uuid)
+            .yield_per(batch_size)
+        )
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                _copy_chunks(shared_db, document, batch, backfill)
+                copied += len(batch)
+                batch = []
+        if batch:
+            _copy_chunks(shared_db, document, batch, backfill)
+            copied += len(batch)
+
+        if delete_source:
+            session.delete(collection)
+            session.commit()
+    return copied
+
+def _copy_chunks(shared_db, document, rows, backfill):
+    """
+    Writes rows of a per-document collection to the shared collection.
+
+    Args:
+        shared_db (PGVector): The database object of the shared collection.
+        document (Document): The document the rows belong to.
+        rows (list): The ``EmbeddingStore`` rows to copy.
+        backfill (bool): Also record the rows as ``DocumentChunk`` rows of the document.
+    """
+    ids = [row.custom_id or str(uuid.uuid4()) for row in rows]
+    metadatas = [{**(row.cmetadata or {}), "document_id": document.id} for row in rows]
+    shared_db.delete(ids=ids, collection_only=True)
+    shared_db.add_embeddings(
+        texts=[row.document for row in rows],
+        embeddings=[list(row.embedding) for row in rows],
+        metadatas=metadatas,
+        ids=ids,
+    )
+    if backfill:
+        DocumentChunk.objects.bulk_create(
+            DocumentChunk(
+                document=document,
+                page=metadata.get("page", 0),
+                # Unknown, so an incremental rebuild splits the page again and matches its chunks
+                page_fingerprint="",
+                fingerprint=hash_text(row.document),
+                vector_id=vector_id,
+            )
+            for row, metadata, vector_id in zip(rows, metadatas, ids)
+        )
 
 def _get_db_by_name(collection_name):
     """
@@ -108,12 +1007,6 @@ def _get_db_by_name(collection_name):
         collection_name (str): The name of the collection.
 
     Returns:
-        PGVector: The database object for the specified collection.
+        VectorStore: The process-wide database object for the specified collection.
     """
-    db = PGVector(
-        collection_name=collection_name,
-        connection_string=_get_database_url(),
-        embedding_function=OpenAIEmbeddings(),
-    )        
-
-    return db
\ No newline at end of file
+    return _registry.get_store(collection_name)
@@ -0,0 +1,94 @@
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from langchain_openai import OpenAI
+
+from rag_qa.core.clients import get_llm, reset_clients
+
+COMPLETION = {
+    "id": "stub",
+    "object": "text_completion",
+    "created": 0,
+    "model": "stub",
+    "choices": [{"text": "stub answer", "index": 0, "finish_reason": "stop", "logprobs": None}],
+    "usage": {"prompt_tokens": 1, "completion_tokens": 2, "total_tokens": 3},
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers every request with a completion, keeping connections alive, and counts connections."""
+
+    protocol_version = "HTTP/1.1"
+    # Send each response in one segment, so small writes do not wait for delayed ACKs
+    disable_nagle_algorithm = True
+    wbufsize = 65536
+
+    def setup(self):
+        super().setup()
+        self.requests = 0
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.requests == 0:
+            # Stands in for the TCP and TLS handshakes of a remote API on a new connection
+            time.sleep(self.server.latency)
+        self.requests += 1
+        body = json.dumps(COMPLETION).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _measure(make_llm, server, requests):
+    server.connections = 0
+    started = time.perf_counter()
+    for _ in range(requests):
+        make_llm().invoke("What is this document about?")
+    return time.perf_counter() - started, server.connections
+
+
+class Command(BaseCommand):
+    help = "Compares a new OpenAI client per call with the shared per-process client against a local stub server"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='The number of completion requests of each mode')
+        parser.add_argument('--handshake-ms', type=float, default=0, help='Delay added to the first request of each connection, to stand in for a remote handshake')
+
+    def handle(self, *args, **kwargs):
+        # httpx logs every request at INFO
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        server.daemon_threads = True
+        server.lock = threading.Lock()
+        server.connections = 0
+        server.latency = kwargs['handshake_ms'] / 1000
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+        with override_settings(OPENAI_BASE_URL=base_url, OPENAI_API_KEY="stub"):
+            reset_clients()
+            modes = [
+                ("new client per call", lambda: OpenAI(temperature=1, base_url=base_url, api_key="stub")),
+                ("shared client", get_llm),
+            ]
+            self.stdout.write(f"{'mode':<20} {'requests':>9} {'connections':>12} {'seconds':>8} {'ms/request':>11}")
+            for mode, make_llm in modes:
+                seconds, connections = _measure(make_llm, server, kwargs['requests'])
+                self.stdout.write(
+                    f"{mode:<20} {kwargs['requests']:>9} {connections:>12} {seconds:>8.2f} "
+                    f"{seconds * 1000 / kwargs['requests']:>11.2f}"
+                )
+            reset_clients()
+        server.shutdown()
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from langchain_community.document_loaders import PyPDFLoader
+
+from rag_qa.core.benchmarks import DiscardingVectorStore
+from rag_qa.core.benchmarks import fake_embeddings
+from rag_qa.core.benchmarks import peak_rss_kib
+from rag_qa.core.benchmarks import run_in_child
+from rag_qa.core.benchmarks import write_synthetic_pdf
+from rag_qa.core.helper import _ingest_document
+
+
+def _measure_streaming(file_path, window_size):
+    baseline = peak_rss_kib()
+    store = DiscardingVectorStore(fake_embeddings())
+    started = time.perf_counter()
+    _ingest_document(file_path, store, window_size=window_size)
+    return store.count, time.perf_counter() - started, baseline, peak_rss_kib()
+
+
+def _measure_eager(file_path, window_size):
+    baseline = peak_rss_kib()
+    store = DiscardingVectorStore(fake_embeddings())
+    started = time.perf_counter()
+    store.add_documents(PyPDFLoader(file_path).load_and_split())
+    return store.count, time.perf_counter() - started, baseline, peak_rss_kib()
+
+
+class Command(BaseCommand):
+    help = "Records peak RSS of document ingestion against page count using a synthetic PDF and a fake embedder"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', type=int, nargs='+', default=[10, 100, 500, 2000], help='The page counts to measure')
+        parser.add_argument('--window-size', type=int, default=64, help='The number of chunks per ingestion window')
+        parser.add_argument('--eager', action='store_true', help='Also measure the load-everything-first approach')
+
+    def handle(self, *args, **kwargs):
+        modes = [("streaming", _measure_streaming)]
+        if kwargs['eager']:
+            modes.append(("eager", _measure_eager))
+
+        self.stdout.write(f"{'mode':<10} {'pages':>6} {'chunks':>7} {'seconds':>8} {'peak RSS KiB':>13} {'growth KiB':>11}")
+        with tempfile.TemporaryDirectory() as directory:
+            for pages in kwargs['pages']:
+                file_path = os.path.join(directory, f"synthetic-{pages}.pdf")
+                write_synthetic_pdf(file_path, pages)
+                for mode, measure in modes:
+                    chunks, seconds, baseline, peak = run_in_child(measure, file_path, kwargs['window_size'])
+                    self.stdout.write(
+                        f"{mode:<10} {pages:>6} {chunks:>7} {seconds:>8.2f} {peak:>13} {peak - baseline:>11}"
+                    )
@@ -0,0 +1,52 @@
+import asyncio
+import logging
+import time
+
+import httpx
+from django.core.management.base import BaseCommand
+
+from rag_qa.core.benchmarks import percentile
+
+
+async def _poll(client, url, question, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            response = await client.post(url, json={"question": question})
+            response.raise_for_status()
+        except httpx.HTTPError:
+            errors.append(time.perf_counter() - started)
+        else:
+            latencies.append(time.perf_counter() - started)
+
+
+async def _measure(url, clients, duration, question):
+    latencies, errors = [], []
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*[_poll(client, url, question, deadline, latencies, errors) for _ in range(clients)])
+    return latencies, errors
+
+
+class Command(BaseCommand):
+    help = "Measures question-answer polling throughput and latency of running servers, such as a WSGI and an ASGI deployment"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', nargs='+', default=['http://localhost:8000/api/question-answer/'], help='The question-answer endpoints to measure')
+        parser.add_argument('--clients', type=int, nargs='+', default=[10, 100, 500], help='The numbers of concurrent polling clients')
+        parser.add_argument('--duration', type=float, default=10, help='The number of seconds each measurement runs')
+        parser.add_argument('--question', default='What is this document about?', help='The question that is polled')
+
+    def handle(self, *args, **kwargs):
+        # httpx logs every request at INFO
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        self.stdout.write(f"{'url':<45} {'clients':>7} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8}")
+        for url in kwargs['url']:
+            for clients in kwargs['clients']:
+                latencies, errors = asyncio.run(_measure(url, clients, kwargs['duration'], kwargs['question']))
+                self.stdout.write(
+                    f"{url:<45} {clients:>7} {len(latencies):>9} {len(errors):>7} "
+                    f"{len(latencies) / kwargs['duration']:>8.1f} "
+                    f"{percentile(latencies, 0.5) * 1000:>8.1f} {percentile(latencies, 0.95) * 1000:>8.1f}"
+                )
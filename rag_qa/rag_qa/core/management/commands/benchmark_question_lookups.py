@@ -0,0 +1,101 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from rest_framework.test import APIRequestFactory
+
+from rag_qa.core.answer_cache import get_question_key
+from rag_qa.core.api.views import POLL_FIELDS, QuestionAnswerView
+from rag_qa.core.benchmarks import percentile
+from rag_qa.core.models import Document, Question
+
+
+class Rollback(Exception):
+    pass
+
+
+def _insert_questions(rows, documents, versions):
+    # Keyed as get_question_key keys the question "Question <n>" over the documents
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            INSERT INTO {Question._meta.db_table}
+                (question_id, status, answer_id, question_text, document_set, answer, sources, created_at, answered_at)
+            SELECT md5(%s || n), 'success', '', 'Question ' || n, '', 'Stored answer', '[]', now(), now()
+            FROM generate_series(1, %s) AS n
+            """,
+            [f"{documents}_{versions}_Question ", rows],
+        )
+        cursor.execute(f"ANALYZE {Question._meta.db_table}")
+        cursor.execute(f"ANALYZE {Document._meta.db_table}")
+
+
+def _set_index_scans(enabled):
+    with connection.cursor() as cursor:
+        for name in ("enable_indexscan", "enable_indexonlyscan", "enable_bitmapscan"):
+            cursor.execute(f"SET LOCAL {name} = {'on' if enabled else 'off'}")
+
+
+def _post_question(number):
+    request = APIRequestFactory().post("/api/question-answer/", {"question": f"Question {number}"}, format="json")
+    # Like a request under ATOMIC_REQUESTS
+    with transaction.atomic():
+        response = QuestionAnswerView.as_view()(request)
+    assert response.data["cached"], response.data
+
+
+def _measure(lookup, numbers):
+    timings = []
+    for number in numbers:
+        started = time.perf_counter()
+        lookup(number)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+class Command(BaseCommand):
+    help = "Measures question-answer poll latency against the number of stored questions, in a transaction that is rolled back"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1_000_000, help='The number of stored questions')
+        parser.add_argument('--documents', type=int, default=10_000, help='The number of documents, 1 in 100 of them selected')
+        parser.add_argument('--lookups', type=int, default=200, help='The number of polls measured per plan')
+
+    def handle(self, *args, **kwargs):
+        try:
+            with transaction.atomic():
+                self._run(kwargs['rows'], kwargs['documents'], kwargs['lookups'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def _run(self, rows, documents, lookups):
+        Document.objects.bulk_create(
+            (
+                Document(name=f"Benchmark {index}", file_path=f"/benchmark/{index}.pdf", selected=index % 100 == 0)
+                for index in range(documents)
+            ),
+            batch_size=5000,
+        )
+        selected = list(Document.objects.filter(selected=True).order_by("id").values_list("id", "index_version"))
+        document_ids, versions = tuple(row[0] for row in selected), tuple(row[1] for row in selected)
+        started = time.perf_counter()
+        _insert_questions(rows, document_ids, versions)
+        self.stdout.write(f"Inserted {rows} questions in {time.perf_counter() - started:.1f}s")
+
+        def get_question(number):
+            # The query of the GET poll endpoint
+            question_id = get_question_key(document_ids, versions, f"Question {number}")
+            assert Question.objects.filter(question_id=question_id).values(*POLL_FIELDS).first()
+
+        polls = [("POST /api/question-answer/", _post_question), ("GET /api/question-answer/<id>/", get_question)]
+        self.stdout.write(f"{'poll':<32} {'plan':<16} {'p50 ms':>8} {'p95 ms':>8}")
+        for plan, index_scans in (("index scan", True), ("sequential scan", False)):
+            _set_index_scans(index_scans)
+            numbers = [random.randint(1, rows) for _ in range(lookups)]
+            for poll, lookup in polls:
+                timings = _measure(lookup, numbers)
+                self.stdout.write(
+                    f"{poll:<32} {plan:<16} {percentile(timings, 0.5) * 1000:>8.2f} {percentile(timings, 0.95) * 1000:>8.2f}"
+                )
@@ -0,0 +1,84 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from rest_framework.test import APIRequestFactory
+
+from rag_qa.core.api.views import DocumentSelectionView
+from rag_qa.core.models import Document
+
+
+class Rollback(Exception):
+    pass
+
+
+class QueryCounter:
+    # Unlike the query log, this keeps counting past 9000 queries
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def _update_one_by_one(payload, prefix):
+    # The per-document loop the view used to run
+    for details in payload:
+        Document.objects.filter(id=details["id"]).update(selected=details["selected"])
+
+
+def _update_through_view(payload, prefix):
+    request = APIRequestFactory().put("/api/document/selection/", payload, format="json")
+    response = DocumentSelectionView.as_view()(request)
+    assert response.status_code == 200, response.data
+
+
+def _select_all(payload, prefix):
+    body = {"selected": payload[0]["selected"], "filter": {"file_path": prefix}}
+    request = APIRequestFactory().put("/api/document/selection/", body, format="json")
+    response = DocumentSelectionView.as_view()(request)
+    assert response.status_code == 200, response.data
+
+
+def _measure(update, payload, prefix, repeats):
+    timings = []
+    for repeat in range(repeats):
+        # Toggle the selection, so that every request changes every listed document
+        payload = [{"id": item["id"], "selected": (index + repeat) % 2 == 0} for index, item in enumerate(payload)]
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            started = time.perf_counter()
+            # Like a request under ATOMIC_REQUESTS
+            with transaction.atomic():
+                update(payload, prefix)
+            timings.append(time.perf_counter() - started)
+    return counter.count, statistics.median(timings)
+
+
+class Command(BaseCommand):
+    help = "Measures the time of document selection updates against payload size, in a transaction that is rolled back"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 2000], help='The numbers of documents in the payload')
+        parser.add_argument('--repeats', type=int, default=5, help='The number of requests measured per payload size')
+
+    def handle(self, *args, **kwargs):
+        modes = [("one-by-one", _update_one_by_one), ("grouped", _update_through_view), ("select-all", _select_all)]
+        self.stdout.write(f"{'mode':<11} {'documents':>9} {'queries':>8} {'median ms':>10}")
+        try:
+            with transaction.atomic():
+                for size in kwargs['sizes']:
+                    prefix = f"/benchmark/{size}/"
+                    documents = Document.objects.bulk_create(
+                        Document(name=f"Benchmark {index}", file_path=f"{prefix}{index}.pdf") for index in range(size)
+                    )
+                    payload = [{"id": document.id, "selected": False} for document in documents]
+                    for mode, update in modes:
+                        queries, seconds = _measure(update, payload, prefix, kwargs['repeats'])
+                        self.stdout.write(f"{mode:<11} {size:>9} {queries:>8} {seconds * 1000:>10.1f}")
+                raise Rollback
+        except Rollback:
+            pass
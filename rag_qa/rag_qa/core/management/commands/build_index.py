@@ -1,11 +1,6 @@
-import os
-from django.conf import settings
 from django.core.management.base import BaseCommand
-from langchain.vectorstores.pgvector import PGVector
-from langchain.document_loaders import PyPDFLoader
-from langchain_openai import OpenAIEmbeddings
-from rag_qa.core.models import Document
 from rag_qa.core.helper import update_vector_db
+from rag_qa.core.tasks import complete_index
 
 
 
@@ -14,9 +9,14 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('document_id', type=int, help='The ID of the document to be indexed')
+        parser.add_argument('--incremental', action='store_true', help='Only re-embed the chunks that changed since the last build')
 
     def handle(self, *args, **kwargs):
         document_id = kwargs['document_id']
         self.stdout.write(f"The provided document ID is: {document_id}")
 
-        update_vector_db(document_id)
+        stats = update_vector_db(document_id, incremental=kwargs['incremental'])
+        # As the task does, so that answers over the previous chunks are no longer served
+        complete_index(document_id, stats)
+        self.stdout.write(f"Chunks added: {stats['added']}, deleted: {stats['deleted']}, kept: {stats['kept']}")
+        self.stdout.write(f"Embedding cache hits: {stats['hits']}, misses: {stats['misses']}")
@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from rag_qa.core.helper import _get_db_by_name, migrate_collection
+from rag_qa.core.models import Document
+
+
+class Command(BaseCommand):
+    help = "Moves per-document pgvector collections into the shared collection"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='The number of chunks copied per round trip')
+        parser.add_argument('--delete-source', action='store_true', help='Delete each per-document collection once it has been copied')
+
+    def handle(self, *args, **kwargs):
+        if settings.VECTOR_DB_BACKEND != "pgvector":
+            raise CommandError("Collections can only be migrated with the pgvector backend")
+        shared_collection = settings.VECTOR_DB_SHARED_COLLECTION
+        shared_db = _get_db_by_name(shared_collection)
+
+        for document in Document.objects.order_by("id"):
+            if document.name == shared_collection:
+                self.stderr.write(f"Skipping document {document.id}: its collection is the shared collection")
+                continue
+            copied = migrate_collection(document, shared_db, kwargs['batch_size'], delete_source=kwargs['delete_source'])
+            if copied is None:
+                self.stdout.write(f"Document {document.id} ({document.name}): no collection found")
+            else:
+                self.stdout.write(f"Document {document.id} ({document.name}): moved {copied} chunks")
+
+        if settings.VECTOR_DB_COLLECTION_LAYOUT != "shared":
+            self.stdout.write("Set VECTOR_DB_COLLECTION_LAYOUT=shared to query the shared collection")
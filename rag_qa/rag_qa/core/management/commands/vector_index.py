@@ -0,0 +1,89 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from rag_qa.core import vector_index
+from rag_qa.core.helper import _get_engine
+
+
+class Command(BaseCommand):
+    help = "Creates, rebuilds, drops or tunes the HNSW / IVFFlat index of the pgvector embeddings table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['create', 'rebuild', 'drop', 'status', 'tune'], help='What to do with the index')
+        parser.add_argument('--method', choices=['hnsw', 'ivfflat'], default=settings.PGVECTOR_INDEX_METHOD, help='The index method')
+        parser.add_argument('--m', type=int, default=settings.PGVECTOR_HNSW_M, help='HNSW: the maximum number of connections per layer')
+        parser.add_argument('--ef-construction', type=int, default=settings.PGVECTOR_HNSW_EF_CONSTRUCTION, help='HNSW: the candidate list size while building')
+        parser.add_argument('--lists', type=int, default=settings.PGVECTOR_IVFFLAT_LISTS, help='IVFFlat: the number of lists')
+        parser.add_argument('--ef-search', type=int, nargs='+', default=[settings.PGVECTOR_HNSW_EF_SEARCH], help='HNSW: the candidate list sizes to measure')
+        parser.add_argument('--probes', type=int, nargs='+', default=[settings.PGVECTOR_IVFFLAT_PROBES], help='IVFFlat: the numbers of lists to scan to measure')
+        parser.add_argument('--samples', type=int, default=20, help='The number of queries per latency measurement')
+
+    def handle(self, *args, **kwargs):
+        if settings.VECTOR_DB_BACKEND != "pgvector":
+            raise CommandError("The vector index is only used by the pgvector backend")
+        engine = _get_engine()
+        action = kwargs['action']
+        definition = vector_index.get_index_definition(engine)
+
+        if action == 'status':
+            self.stdout.write(definition or "There is no vector index")
+            return
+        if action == 'drop':
+            vector_index.drop_index(engine)
+            self.stdout.write("Dropped the vector index")
+            return
+        if action == 'tune':
+            if definition is None:
+                raise CommandError("There is no vector index to tune, create it first")
+            self._tune(engine, kwargs)
+            return
+        if action == 'create' and definition is not None:
+            raise CommandError(f"The vector index already exists, use rebuild to replace it: {definition}")
+
+        before = self._latency(engine, kwargs)
+        if action == 'rebuild':
+            vector_index.drop_index(engine)
+        seconds = vector_index.create_index(
+            engine,
+            method=kwargs['method'],
+            dimensions=settings.PGVECTOR_DIMENSIONS,
+            m=kwargs['m'],
+            ef_construction=kwargs['ef_construction'],
+            lists=kwargs['lists'],
+        )
+        after = self._latency(engine, kwargs)
+
+        self.stdout.write(f"Built the {kwargs['method']} index in {seconds:.2f}s")
+        self.stdout.write(f"Median query latency before: {before:.2f} ms, after: {after:.2f} ms")
+
+    def _latency(self, engine, kwargs):
+        latency, _ = vector_index.measure_latency(
+            engine,
+            settings.PGVECTOR_DIMENSIONS,
+            samples=kwargs['samples'],
+            k=settings.RETRIEVAL_TOP_K,
+            ef_search=kwargs['ef_search'][0],
+            probes=kwargs['probes'][0],
+        )
+        return latency
+
+    def _tune(self, engine, kwargs):
+        """
+        Reports latency and recall for each search parameter value, against an exact scan.
+        """
+        measure = {
+            "dimensions": settings.PGVECTOR_DIMENSIONS,
+            "samples": kwargs['samples'],
+            "k": settings.RETRIEVAL_TOP_K,
+        }
+        exact_latency, exact_results = vector_index.measure_latency(engine, exact=True, **measure)
+        self.stdout.write(f"{'exact scan':<16} {exact_latency:>8.2f} ms   recall 1.000")
+
+        if kwargs['method'] == 'hnsw':
+            values = [("ef_search", value, {"ef_search": value}) for value in kwargs['ef_search']]
+        else:
+            values = [("probes", value, {"probes": value}) for value in kwargs['probes']]
+        for name, value, search in values:
+            latency, results = vector_index.measure_latency(engine, **measure, **search)
+            found = vector_index.recall(results, exact_results)
+            self.stdout.write(f"{f'{name}={value}':<16} {latency:>8.2f} ms   recall {found:.3f}")
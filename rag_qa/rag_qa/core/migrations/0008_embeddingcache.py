@@ -0,0 +1,30 @@
+# Generated by Django 5.0.10 on 2026-10-18 16:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_question_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmbeddingCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model_name', models.CharField(max_length=128)),
+                ('text_hash', models.CharField(max_length=64)),
+                ('vector', models.BinaryField()),
+                ('last_used_at', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['last_used_at'], name='core_embedd_last_us_63eafd_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='embeddingcache',
+            constraint=models.UniqueConstraint(fields=('model_name', 'text_hash'), name='unique_embedding_cache_key'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.10 on 2026-10-18 16:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_embeddingcache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('page', models.PositiveIntegerField()),
+                ('page_fingerprint', models.CharField(max_length=64)),
+                ('fingerprint', models.CharField(max_length=64)),
+                ('vector_id', models.CharField(max_length=64)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='core.document')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['document', 'page'], name='core_docume_documen_bbc27c_idx')],
+            },
+        ),
+    ]
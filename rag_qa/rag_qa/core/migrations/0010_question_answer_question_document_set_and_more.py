@@ -0,0 +1,37 @@
+# Generated by Django 5.0.10 on 2026-10-18 16:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_documentchunk'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='answer',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='question',
+            name='document_set',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='question',
+            name='embedding',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='question',
+            name='question_text',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(fields=['document_set', 'status'], name='core_questi_documen_0ccaa1_idx'),
+        ),
+    ]
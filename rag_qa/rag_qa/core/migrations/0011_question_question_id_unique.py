@@ -0,0 +1,28 @@
+# Generated by Django 5.0.10 on 2026-10-18 17:14
+
+from django.db import migrations, models
+
+
+def remove_duplicate_questions(apps, schema_editor):
+    """
+    Keeps the latest row of each question ID, which holds the most recent task.
+    """
+    Question = apps.get_model("core", "Question")
+    latest_ids = Question.objects.values("question_id").annotate(latest_id=models.Max("id")).values("latest_id")
+    Question.objects.exclude(id__in=latest_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_question_answer_question_document_set_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_questions, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='question',
+            name='question_id',
+            field=models.CharField(max_length=2048, unique=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.10 on 2026-10-18 17:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_question_question_id_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='prompt_tokens',
+            field=models.PositiveIntegerField(null=True),
+        ),
+    ]
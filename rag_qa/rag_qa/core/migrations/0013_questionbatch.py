@@ -0,0 +1,26 @@
+# Generated by Django 5.0.10 on 2026-10-18 17:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_question_prompt_tokens'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuestionBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('batch_id', models.CharField(max_length=32, unique=True)),
+                ('status', models.CharField(choices=[('in_progress', 'in_progress'), ('success', 'success'), ('failed', 'failed')], max_length=20)),
+                ('answer_id', models.CharField(max_length=64)),
+                ('documents', models.JSONField(default=list)),
+                ('questions', models.JSONField(default=list)),
+                ('results', models.JSONField(default=list)),
+                ('completed', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+    ]
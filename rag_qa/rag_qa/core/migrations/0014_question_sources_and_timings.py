@@ -0,0 +1,38 @@
+# Generated by Django 5.0.10 on 2026-10-18 17:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_questionbatch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='answered_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='question',
+            name='generation_seconds',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='question',
+            name='retrieval_seconds',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='question',
+            name='sources',
+            field=models.JSONField(default=list),
+        ),
+        migrations.AlterField(
+            model_name='question',
+            name='status',
+            field=models.CharField(choices=[('in_progress', 'in_progress'), ('success', 'success'), ('failed', 'failed')], max_length=20),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.0.10 on 2026-10-18 17:31
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_question_sources_and_timings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='index_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='question',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(fields=['answered_at'], name='core_questi_answere_3d1223_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(fields=['created_at'], name='core_questi_created_700c69_idx'),
+        ),
+    ]
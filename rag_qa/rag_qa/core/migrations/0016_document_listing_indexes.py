@@ -0,0 +1,21 @@
+# Generated by Django 5.0.10 on 2026-10-18 17:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_answer_expiry_and_index_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(fields=['selected', 'indexed', 'id'], name='core_docume_selecte_8d328c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(fields=['name'], name='core_document_name_prefix_idx', opclasses=['varchar_pattern_ops']),
+        ),
+    ]
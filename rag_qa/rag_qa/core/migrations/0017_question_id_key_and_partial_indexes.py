@@ -0,0 +1,31 @@
+# Generated by Django 5.0.10 on 2026-10-18 17:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_document_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='question',
+            name='question_id',
+            field=models.CharField(db_collation='C', max_length=32, unique=True),
+        ),
+        # The pattern index Django added for the former varchar column, which nothing matches against
+        migrations.RunSQL(
+            'DROP INDEX IF EXISTS "core_question_question_id_334c2e7a_like"',
+            migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(condition=models.Q(('selected', True)), fields=['id'], include=('index_version',), name='core_document_selected_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(condition=models.Q(('indexed', True)), fields=['id'], name='core_document_indexed_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.10 on 2026-10-18 18:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_question_id_key_and_partial_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='claimed_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
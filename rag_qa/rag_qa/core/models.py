@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models import Q
 
 
 # Create your models here.
@@ -11,13 +12,100 @@ class Document(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     indexed = models.BooleanField(default=False)
     selected = models.BooleanField(default=False)
+    # Incremented whenever the chunks of the document change, it is part of the answer cache keys
+    index_version = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # The document listing filters on these and pages through the IDs
+            models.Index(fields=["selected", "indexed", "id"]),
+            # Prefix matches on the name
+            models.Index(fields=["name"], name="core_document_name_prefix_idx", opclasses=["varchar_pattern_ops"]),
+            # Every question reads the selected documents with their index versions from this alone
+            models.Index(
+                fields=["id"],
+                include=["index_version"],
+                condition=Q(selected=True),
+                name="core_document_selected_idx",
+            ),
+            models.Index(fields=["id"], condition=Q(indexed=True), name="core_document_indexed_idx"),
+        ]
 
 class Question(models.Model):
     """
     This model represents a question in the system.
     """
-    question_id = models.CharField(max_length=2048, null=False, blank=False)
+    # The hex MD5 digest of the question and its documents, compared byte by byte
+    question_id = models.CharField(max_length=32, null=False, blank=False, unique=True, db_collation="C")
+    status = models.CharField(
+        choices=[('in_progress', 'in_progress'), ('success', 'success'), ('failed', 'failed')], 
+        max_length=20)
+    answer_id = models.CharField(max_length=64)
+    question_text = models.TextField(blank=True, default="")
+    # Hash of the selected document IDs, the questions whose answers can be reused
+    document_set = models.CharField(max_length=32, blank=True, default="")
+    answer = models.TextField(blank=True, default="")
+    # Packed float32 embedding of the question text
+    embedding = models.BinaryField(null=True)
+    # Size of the prompt the answer was generated from
+    prompt_tokens = models.PositiveIntegerField(null=True)
+    # Chunks in the prompt, with their vector store ID, document, page and relevance score
+    sources = models.JSONField(default=list)
+    retrieval_seconds = models.FloatField(null=True)
+    generation_seconds = models.FloatField(null=True)
+    answered_at = models.DateTimeField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # When a request last claimed the question for answering, after which the claim expires
+    claimed_at = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["document_set", "status"]),
+            # Expired questions are purged by these
+            models.Index(fields=["answered_at"]),
+            models.Index(fields=["created_at"]),
+        ]
+
+class QuestionBatch(models.Model):
+    """
+    This model represents a batch of questions answered together over the same documents.
+    """
+    batch_id = models.CharField(max_length=32, unique=True)
     status = models.CharField(
-        choices=[('in_progress', 'in_progress'), ('sucess', 'success'), ('failed', 'failed')], 
+        choices=[('in_progress', 'in_progress'), ('success', 'success'), ('failed', 'failed')],
         max_length=20)
     answer_id = models.CharField(max_length=64)
+    # IDs of the documents selected when the batch was submitted
+    documents = models.JSONField(default=list)
+    questions = models.JSONField(default=list)
+    # One entry per question, None until it is answered
+    results = models.JSONField(default=list)
+    completed = models.PositiveIntegerField(default=0)
+
+class DocumentChunk(models.Model):
+    """
+    This model records a chunk of a document stored in the vector database, with fingerprints of the chunk and its page.
+    """
+    document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name="chunks")
+    page = models.PositiveIntegerField()
+    page_fingerprint = models.CharField(max_length=64)
+    fingerprint = models.CharField(max_length=64)
+    vector_id = models.CharField(max_length=64)
+
+    class Meta:
+        indexes = [models.Index(fields=["document", "page"])]
+
+class EmbeddingCache(models.Model):
+    """
+    This model stores an embedding vector keyed by the embedding model and a hash of the normalized text.
+    """
+    model_name = models.CharField(max_length=128)
+    text_hash = models.CharField(max_length=64)
+    vector = models.BinaryField()
+    last_used_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["model_name", "text_hash"], name="unique_embedding_cache_key"),
+        ]
+        indexes = [models.Index(fields=["last_used_at"])]
@@ -0,0 +1,484 @@
+"""
+An in-process vector store that keeps normalized embeddings in memory-mapped NumPy shards.
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+SHARD_SUFFIX = ".npy"
+SIDECAR_SUFFIX = ".jsonl"
+TOMBSTONE_FILE = "deleted.txt"
+LOCK_FILE = ".lock"
+
+
+class _Shard:
+    """
+    One immutable shard: a memory-mapped ``(rows, dimensions)`` float32 array and its sidecar.
+
+    The sidecar holds the ID, text and metadata of each row, one JSON object per line, in row order.
+    Only the IDs, the document IDs and the offset of each line are kept in memory. The text and
+    metadata of a row are read from the sidecar when it is returned by a search.
+    """
+
+    def __init__(self, path):
+        self.name = os.path.basename(path)[: -len(SHARD_SUFFIX)]
+        self.vectors = np.load(path, mmap_mode="r")
+        # Kept open, so that its rows can still be read once a compaction removed the shard
+        self._sidecar = open(path[: -len(SHARD_SUFFIX)] + SIDECAR_SUFFIX, "rb")
+        ids = []
+        document_ids = []
+        offsets = [0]
+        for line in self._sidecar:
+            record = json.loads(line)
+            ids.append(record["id"])
+            document_ids.append(str(record["metadata"].get("document_id")))
+            offsets.append(offsets[-1] + len(line))
+        self.ids = np.array(ids, dtype=str)
+        self._offsets = np.array(offsets, dtype=np.int64)
+        self._columns = {"document_id": np.array(document_ids, dtype=str)}
+        self._live = None
+        self._live_version = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def record(self, row):
+        """
+        Reads the ID, text and metadata of a row from the sidecar.
+
+        Args:
+            row (int): The row.
+
+        Returns:
+            dict: The record of the row.
+        """
+        start, stop = int(self._offsets[row]), int(self._offsets[row + 1])
+        return json.loads(os.pread(self._sidecar.fileno(), stop - start, start))
+
+    def close(self):
+        """
+        Closes the sidecar.
+        """
+        self._sidecar.close()
+
+    def live_mask(self, deleted, version):
+        """
+        Returns which rows are not deleted, computed again only when the tombstones change.
+
+        Args:
+            deleted (set[str]): The IDs of the deleted chunks.
+            version (tuple): Changes whenever ``deleted`` does.
+
+        Returns:
+            numpy.ndarray: A boolean mask, or ``None`` if no row is deleted.
+        """
+        if self._live_version != version:
+            live = ~np.isin(self.ids, list(deleted)) if deleted else None
+            self._live = live if live is not None and not live.all() else None
+            self._live_version = version
+        return self._live
+
+    def filter_mask(self, filter):
+        """
+        Returns which rows match a metadata filter.
+
+        Args:
+            filter (dict): Maps metadata keys to a value or to ``{"in": [values]}``. Values are
+                compared as text, as PGVector compares JSON metadata.
+
+        Returns:
+            numpy.ndarray: A boolean mask.
+
+        Raises:
+            ValueError: If the filter uses an unsupported operator.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for key, condition in filter.items():
+            if isinstance(condition, dict):
+                operator, operand = next(iter(condition.items()))
+                if len(condition) != 1 or operator not in ("in", "$in"):
+                    raise ValueError(f"Unsupported filter on {key}: {condition}")
+                values = [str(value) for value in operand]
+            else:
+                values = [str(condition)]
+            mask &= np.isin(self._column(key), values)
+        return mask
+
+    def _column(self, key):
+        column = self._columns.get(key)
+        if column is None:
+            # Other keys than the document ID are rarely filtered on, so they are read when needed
+            column = np.array([str(self.record(row)["metadata"].get(key)) for row in range(len(self))], dtype=str)
+            self._columns[key] = column
+        return column
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    Stores the chunks of a collection in a directory, searched by brute force in the calling process.
+
+    Every write adds a shard: a ``.npy`` file of unit-length float32 vectors and a ``.jsonl``
+    sidecar with the ID, text and metadata of each row. Shards are never modified, so readers
+    memory-map them and only open the shards that are new since their last search. Deletes are
+    appended to a tombstone file, and once there are more than ``max_shards`` shards, the live
+    rows are compacted into one. Search takes the dot product with the query in blocks of
+    ``block_size`` rows and keeps the top ``k`` of each block, so it never materializes more
+    than one block of scores.
+    """
+
+    def __init__(self, embedding, directory, block_size=65536, max_shards=64):
+        """
+        Args:
+            embedding (Embeddings): Embeds the texts and queries.
+            directory (str): The directory of the collection. It is created if needed.
+            block_size (int): The number of rows scored at once.
+            max_shards (int): The number of shards above which a write compacts the collection.
+        """
+        self.embedding = embedding
+        self.directory = directory
+        self.block_size = block_size
+        self.max_shards = max_shards
+        self._lock = threading.Lock()
+        self._shards = {}
+        self._deleted = set()
+        self._tombstone_inode = None
+        self._tombstone_offset = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def embeddings(self):
+        return self.embedding
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, directory=None, **kwargs):
+        """
+        Creates a store in ``directory`` and adds the texts to it.
+
+        Args:
+            texts (list[str]): The texts to add.
+            embedding (Embeddings): Embeds the texts and queries.
+            metadatas (list[dict], optional): The metadata of each text.
+            ids (list[str], optional): The ID of each text.
+            directory (str): The directory of the collection.
+
+        Returns:
+            NumpyVectorStore: The store.
+        """
+        store = cls(embedding, directory, **kwargs)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        """
+        Embeds texts and writes them as a new shard.
+
+        Args:
+            texts (Iterable[str]): The texts to add.
+            metadatas (list[dict], optional): The metadata of each text.
+            ids (list[str], optional): The ID of each text. Random IDs are used if not given.
+
+        Returns:
+            list[str]: The IDs of the added texts.
+        """
+        texts = list(texts)
+        return self.add_embeddings(texts, self.embedding.embed_documents(texts), metadatas=metadatas, ids=ids)
+
+    def add_embeddings(self, texts, embeddings, metadatas=None, ids=None):
+        """
+        Writes texts with their precomputed vectors as a new shard.
+
+        Args:
+            texts (list[str]): The texts to add.
+            embeddings (list[list[float]]): The vector of each text.
+            metadatas (list[dict], optional): The metadata of each text.
+            ids (list[str], optional): The ID of each text. Random IDs are used if not given.
+
+        Returns:
+            list[str]: The IDs of the added texts.
+        """
+        if not texts:
+            return []
+        ids = list(ids) if ids is not None else [str(uuid.uuid4()) for _ in texts]
+        metadatas = metadatas if metadatas is not None else [{} for _ in texts]
+        records = [
+            {"id": vector_id, "text": text, "metadata": metadata}
+            for vector_id, text, metadata in zip(ids, texts, metadatas)
+        ]
+        with self._write_lock():
+            self._write_shard(_normalize(np.asarray(embeddings, dtype=np.float32)), records)
+            if len(self._list_shards()) > self.max_shards:
+                self._compact()
+        return ids
+
+    def delete(self, ids=None, **kwargs):
+        """
+        Marks chunks as deleted. Their rows are dropped at the next compaction.
+
+        Args:
+            ids (list[str]): The IDs of the chunks to delete.
+
+        Returns:
+            bool: ``True``.
+        """
+        if ids:
+            with self._write_lock():
+                with open(os.path.join(self.directory, TOMBSTONE_FILE), "a", encoding="utf-8") as tombstones:
+                    tombstones.write("".join(f"{vector_id}\n" for vector_id in ids))
+        return True
+
+    def compact(self):
+        """
+        Rewrites the live rows of every shard into one shard and clears the tombstones.
+        """
+        with self._write_lock():
+            self._compact()
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        return [document for document, _ in self.similarity_search_with_score(query, k=k, filter=filter)]
+
+    def similarity_search_with_score(self, query, k=4, filter=None, **kwargs):
+        """
+        Returns the chunks nearest to a query.
+
+        Args:
+            query (str): The query text.
+            k (int): The number of chunks to return.
+            filter (dict, optional): A metadata filter, see ``_Shard.filter_mask``.
+
+        Returns:
+            list[tuple]: ``(document, cosine distance)`` pairs, nearest first.
+        """
+        return self.similarity_search_with_score_by_vector(self.embedding.embed_query(query), k=k, filter=filter)
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        return [document for document, _ in self.similarity_search_with_score_by_vector(embedding, k=k, filter=filter)]
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None):
+        """
+        Returns the chunks nearest to a query vector.
+
+        Args:
+            embedding (list[float]): The query vector.
+            k (int): The number of chunks to return.
+            filter (dict, optional): A metadata filter, see ``_Shard.filter_mask``.
+
+        Returns:
+            list[tuple]: ``(document, cosine distance)`` pairs, nearest first.
+        """
+        return self.similarity_search_with_score_by_vectors([embedding], k=k, filter=filter)[0]
+
+    def similarity_search_with_score_by_vectors(self, embeddings, k=4, filter=None):
+        """
+        Returns the chunks nearest to each of several query vectors.
+
+        Each block of vectors is read once and scored against all queries in one matrix product.
+
+        Args:
+            embeddings (list[list[float]]): The query vectors.
+            k (int): The number of chunks to return for each query.
+            filter (dict, optional): A metadata filter, see ``_Shard.filter_mask``.
+
+        Returns:
+            list[list[tuple]]: For each query, ``(document, cosine distance)`` pairs, nearest first.
+        """
+        if not len(embeddings):
+            return []
+        queries = _normalize(np.asarray(embeddings, dtype=np.float32))
+        shards, deleted, version = self._snapshot()
+
+        candidate_scores = [[] for _ in queries]
+        candidate_rows = [[] for _ in queries]
+        for shard_index, shard in enumerate(shards):
+            mask = shard.live_mask(deleted, version)
+            if filter:
+                filtered = shard.filter_mask(filter)
+                mask = filtered if mask is None else mask & filtered
+            for start in range(0, len(shard), self.block_size):
+                stop = min(start + self.block_size, len(shard))
+                if mask is None:
+                    rows = np.arange(start, stop)
+                    scores = shard.vectors[start:stop] @ queries.T
+                else:
+                    # Only the matching rows are read and scored
+                    rows = start + np.flatnonzero(mask[start:stop])
+                    scores = shard.vectors[rows] @ queries.T
+                if len(rows) > k:
+                    top = np.argpartition(-scores, k, axis=0)[:k]
+                else:
+                    top = np.broadcast_to(np.arange(len(rows))[:, None], scores.shape)
+                for query_index in range(len(queries)):
+                    column = top[:, query_index]
+                    candidate_scores[query_index].append(scores[column, query_index])
+                    candidate_rows[query_index].extend((shard_index, row) for row in rows[column])
+
+        return [
+            self._collect(shards, candidate_scores[query_index], candidate_rows[query_index], k)
+            for query_index in range(len(queries))
+        ]
+
+    def _collect(self, shards, candidate_scores, candidate_rows, k):
+        """
+        Turns the per-block candidates of one query into its top ``k`` chunks.
+
+        Returns:
+            list[tuple]: ``(document, cosine distance)`` pairs, nearest first.
+        """
+        if not candidate_rows:
+            return []
+        scores = np.concatenate(candidate_scores)
+        results = []
+        for position in np.argsort(-scores, kind="stable")[:k]:
+            shard_index, row = candidate_rows[position]
+            record = shards[shard_index].record(row)
+            document = Document(page_content=record["text"], metadata=dict(record["metadata"]), id=record["id"])
+            results.append((document, 1.0 - float(scores[position])))
+        return results
+
+    def _select_relevance_score_fn(self):
+        return self._cosine_relevance_score_fn
+
+    def _snapshot(self):
+        """
+        Opens the shards written since the last search and reads new tombstones.
+
+        The shards and tombstones are read under a shared lock, so that a compaction cannot replace
+        them in between and let deleted rows of the shards it removed be read as live.
+
+        Returns:
+            tuple: The shards in write order, the deleted IDs and their version.
+        """
+        with self._lock, self._file_lock(fcntl.LOCK_SH):
+            names = self._list_shards()
+            for name in names:
+                if name not in self._shards:
+                    self._shards[name] = _Shard(os.path.join(self.directory, name + SHARD_SUFFIX))
+            for name in set(self._shards) - set(names):
+                del self._shards[name]
+            self._read_tombstones()
+            return [self._shards[name] for name in names], self._deleted, self._tombstone_version
+
+    def _read_tombstones(self):
+        """
+        Reads the tombstones appended since the last call.
+
+        A compaction replaces the tombstone file, which is noticed by its inode changing.
+        """
+        try:
+            with open(os.path.join(self.directory, TOMBSTONE_FILE), encoding="utf-8") as tombstones:
+                inode = os.fstat(tombstones.fileno()).st_ino
+                if inode != self._tombstone_inode:
+                    self._deleted = set()
+                    self._tombstone_inode = inode
+                    self._tombstone_offset = 0
+                tombstones.seek(self._tombstone_offset)
+                data = tombstones.read()
+        except FileNotFoundError:
+            self._deleted = set()
+            self._tombstone_inode = None
+            self._tombstone_offset = 0
+            return
+        # Only whole lines, a writer may be halfway through one
+        complete = data[: data.rfind("\n") + 1]
+        if complete:
+            self._deleted = self._deleted | set(complete.split())
+            self._tombstone_offset += len(complete.encode("utf-8"))
+
+    @property
+    def _tombstone_version(self):
+        return self._tombstone_inode, self._tombstone_offset
+
+    def _list_shards(self):
+        return sorted(
+            entry.name[: -len(SHARD_SUFFIX)]
+            for entry in os.scandir(self.directory)
+            if entry.name.endswith(SHARD_SUFFIX)
+        )
+
+    def _write_shard(self, vectors, records):
+        """
+        Writes a shard so that readers see all of it or nothing.
+
+        The sidecar is written first and the vectors last, since readers list shards by their
+        ``.npy`` file. Names start with the time, so shards sort in write order.
+        """
+        name = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        base = os.path.join(self.directory, name)
+        with open(base + SIDECAR_SUFFIX, "w", encoding="utf-8") as sidecar:
+            sidecar.writelines(json.dumps(record) + "\n" for record in records)
+        with open(base + ".tmp", "wb") as shard:
+            np.save(shard, vectors)
+        os.replace(base + ".tmp", base + SHARD_SUFFIX)
+        return name
+
+    def _compact(self):
+        """
+        Merges the shards into one without the deleted rows. Must hold the write lock.
+        """
+        names = self._list_shards()
+        shards = [_Shard(os.path.join(self.directory, name + SHARD_SUFFIX)) for name in names]
+        self._read_tombstones()
+        deleted = self._deleted
+
+        vectors = []
+        records = []
+        for shard in shards:
+            live = ~np.isin(shard.ids, list(deleted)) if deleted else np.ones(len(shard), dtype=bool)
+            vectors.append(np.asarray(shard.vectors)[live])
+            records.extend(shard.record(row) for row in np.flatnonzero(live))
+            shard.close()
+        if records:
+            self._write_shard(np.concatenate(vectors), records)
+
+        for name in names:
+            os.remove(os.path.join(self.directory, name + SHARD_SUFFIX))
+            os.remove(os.path.join(self.directory, name + SIDECAR_SUFFIX))
+        # A new file, so that readers notice the tombstones were cleared
+        path = os.path.join(self.directory, TOMBSTONE_FILE)
+        with open(path + ".tmp", "w", encoding="utf-8"):
+            pass
+        os.replace(path + ".tmp", path)
+
+    @contextmanager
+    def _write_lock(self):
+        """
+        Serializes writes to the collection across threads and processes.
+        """
+        with self._lock, self._file_lock(fcntl.LOCK_EX):
+            yield
+
+    @contextmanager
+    def _file_lock(self, operation):
+        """
+        Holds a lock on the lock file of the collection, shared with other processes.
+
+        Args:
+            operation (int): ``fcntl.LOCK_EX`` to write, ``fcntl.LOCK_SH`` to read.
+        """
+        with open(os.path.join(self.directory, LOCK_FILE), "a") as lock_file:
+            fcntl.flock(lock_file, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _normalize(vectors):
+    """
+    Scales vectors to unit length, so that the dot product is the cosine similarity.
+
+    Args:
+        vectors (numpy.ndarray): One vector or a ``(rows, dimensions)`` array.
+
+    Returns:
+        numpy.ndarray: The normalized vectors.
+    """
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
@@ -0,0 +1,124 @@
+"""
+Answering of the questions asked through the API, shared by the sync and async views.
+
+A question gets the answer already given to it or to a similar question over the same documents,
+attaches to the task of a request answering it, or is claimed for a new ``get_rag_response`` task.
+"""
+import uuid
+
+from django.conf import settings
+from django.utils import timezone
+
+from rag_qa.core.answer_cache import (
+    copy_answer,
+    encode_vector,
+    find_similar_answer,
+    get_candidates,
+    get_claimable,
+    get_question_key,
+    is_being_answered,
+)
+from rag_qa.core.helper import embed_question
+from rag_qa.core.models import Question
+
+
+def ask_question(question, selected):
+    """
+    Looks up the answer to a question over the selected documents, or claims the question.
+
+    Must run in a transaction: the claim holds the row lock until it commits and is rolled back if
+    the lookup fails. The caller sends the task once the transaction committed, so that the task
+    finds the question to store its outcome on.
+
+    Args:
+        question (str): The question.
+        selected (SelectedDocuments): The documents selected for processing.
+
+    Returns:
+        tuple: The question, its answer or ``"thinking..."``, whether the answer was cached, and the
+            options of the ``get_rag_response`` task to send, or ``None``.
+    """
+    documents, document_set = selected.documents, selected.fingerprint
+    question_id = get_question_key(documents, selected.versions, question)
+    model_object, created = Question.objects.get_or_create(question_id=question_id)
+
+    if is_being_answered(model_object, settings.ANSWER_CLAIM_TIMEOUT):
+        # The task stores the answer on the question when it finishes
+        return model_object, "thinking...", False, None
+    if model_object.status == 'success' and model_object.answer:
+        return model_object, model_object.answer, True, None
+    if not get_claimable(question_id, settings.ANSWER_CLAIM_TIMEOUT).update(
+        status='in_progress', claimed_at=timezone.now()
+    ):
+        # A concurrent request is answering the same question, attach to its task
+        model_object.refresh_from_db()
+        cached = model_object.status == 'success'
+        return model_object, model_object.answer if cached else "thinking...", cached, None
+
+    answer = _find_cached_answer(model_object, document_set, question)
+    if answer is not None:
+        return model_object, answer, True, None
+    return model_object, "thinking...", False, _prepare_task(model_object, documents, document_set, question)
+
+
+def _find_cached_answer(model_object, document_set, question):
+    """
+    Reuses the answer of the most similar question asked over the same documents.
+
+    The question is only embedded if there are answered questions to compare it with. A match
+    needs a cosine similarity of at least ``SEMANTIC_CACHE_THRESHOLD``.
+
+    Args:
+        model_object (Question): The claimed question.
+        document_set (str): The key of the selected documents as they are indexed.
+        question (str): The question.
+
+    Returns:
+        str: The cached answer, or None if no question is similar enough.
+    """
+    if settings.SEMANTIC_CACHE_THRESHOLD > 1:
+        return None
+    if not get_candidates(document_set, settings.ANSWER_CACHE_TTL).exists():
+        return None
+    vector = embed_question(question)
+    match = find_similar_answer(
+        document_set,
+        vector,
+        threshold=settings.SEMANTIC_CACHE_THRESHOLD,
+        max_candidates=settings.SEMANTIC_CACHE_MAX_CANDIDATES,
+        ttl=settings.ANSWER_CACHE_TTL,
+    )
+    if match is None:
+        return None
+
+    model_object.question_text = question
+    model_object.document_set = document_set
+    model_object.embedding = encode_vector(vector)
+    copy_answer(model_object, match)
+    model_object.save()
+    return match.answer
+
+
+def _prepare_task(model_object, documents, document_set, question):
+    """
+    Records the task that will answer a claimed question.
+
+    Args:
+        model_object (Question): The claimed question.
+        documents (tuple[int]): The IDs of the selected documents.
+        document_set (str): The key of the selected documents as they are indexed.
+        question (str): The question.
+
+    Returns:
+        dict: The options of the ``get_rag_response`` task.
+    """
+    model_object.answer_id = str(uuid.uuid4())
+    model_object.question_text = question
+    model_object.document_set = document_set
+    model_object.status = 'in_progress'
+    model_object.save(update_fields=["answer_id", "question_text", "document_set"])
+    return {
+        "args": [documents, question],
+        "kwargs": {"question_id": model_object.question_id},
+        "task_id": model_object.answer_id,
+    }
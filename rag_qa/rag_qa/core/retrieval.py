@@ -0,0 +1,148 @@
+"""
+Retrievers that combine the results of several vector store queries.
+"""
+import heapq
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
+
+
+class ScoredMergeRetriever(BaseRetriever):
+    """
+    Queries several vector stores concurrently and keeps the global top ``k`` chunks by relevance score.
+
+    The query is embedded once with ``embeddings`` and every store is searched by that vector. Each
+    store returns up to ``fetch_k`` scored chunks. The results are merged through a heap,
+    best first, skipping the chunks of a document that already has ``per_document_cap`` chunks,
+    until ``k`` chunks are kept. Unlike ``MergerRetriever``, the number of chunks returned does not
+    grow with the number of stores.
+    """
+
+    stores: list[VectorStore]
+    embeddings: Embeddings
+    k: int = 4
+    fetch_k: int = 4
+    per_document_cap: Optional[int] = None
+    search_kwargs: dict = {}
+    max_concurrency: int = 4
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        """
+        Retrieves the global top ``k`` chunks for a query.
+
+        Args:
+            query (str): The query text.
+            run_manager (CallbackManagerForRetrieverRun): The callback manager of the run.
+
+        Returns:
+            list[Document]: The chunks, most relevant first, with their ``relevance_score`` in metadata.
+        """
+        vector = self.embeddings.embed_query(query)
+        if len(self.stores) <= 1 or self.max_concurrency <= 1:
+            results = [self._search(store, vector) for store in self.stores]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(self.stores))) as executor:
+                results = list(executor.map(lambda store: self._search(store, vector), self.stores))
+        return self._merge(results)
+
+    def retrieve_by_vectors(self, vectors):
+        """
+        Retrieves the global top ``k`` chunks for each of several query vectors in one step.
+
+        Stores that can search by many vectors at once, such as ``NumpyVectorStore``, get one call
+        with all of them. Other stores are searched once per vector. The searches run concurrently.
+
+        Args:
+            vectors (list[list[float]]): The query vectors.
+
+        Returns:
+            list[list[Document]]: For each vector, the chunks, most relevant first.
+        """
+        searches = []
+        for store_index, store in enumerate(self.stores):
+            if hasattr(store, "similarity_search_with_score_by_vectors"):
+                searches.append((store_index, range(len(vectors))))
+            else:
+                searches.extend((store_index, range(index, index + 1)) for index in range(len(vectors)))
+
+        def run(search):
+            store_index, indexes = search
+            return self._search_many(self.stores[store_index], [vectors[index] for index in indexes])
+
+        if len(searches) <= 1 or self.max_concurrency <= 1:
+            outputs = [run(search) for search in searches]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(searches))) as executor:
+                outputs = list(executor.map(run, searches))
+
+        results = [[[] for _ in self.stores] for _ in vectors]
+        for (store_index, indexes), output in zip(searches, outputs):
+            for index, scored in zip(indexes, output):
+                results[index][store_index] = scored
+        return [self._merge(scored) for scored in results]
+
+    def _search(self, store, vector):
+        """
+        Searches a store by vector and converts its distances to relevance scores.
+
+        Args:
+            store (VectorStore): The store to search.
+            vector (list[float]): The query vector.
+
+        Returns:
+            list[tuple]: ``(document, relevance score)`` pairs.
+        """
+        scored = store.similarity_search_with_score_by_vector(vector, k=self.fetch_k, **self.search_kwargs)
+        relevance = store._select_relevance_score_fn()
+        return [(document, relevance(distance)) for document, distance in scored]
+
+    def _search_many(self, store, vectors):
+        """
+        Searches a store by several vectors and converts the distances to relevance scores.
+
+        Args:
+            store (VectorStore): The store to search.
+            vectors (list[list[float]]): The query vectors.
+
+        Returns:
+            list[list[tuple]]: For each vector, ``(document, relevance score)`` pairs.
+        """
+        if len(vectors) == 1:
+            return [self._search(store, vectors[0])]
+        scored = store.similarity_search_with_score_by_vectors(vectors, k=self.fetch_k, **self.search_kwargs)
+        relevance = store._select_relevance_score_fn()
+        return [[(document, relevance(distance)) for document, distance in pairs] for pairs in scored]
+
+    def _merge(self, results):
+        """
+        Merges scored results into the top ``k``, respecting the per-document cap.
+
+        Args:
+            results (list[list[tuple]]): The ``(document, relevance score)`` pairs of each store.
+
+        Returns:
+            list[Document]: The kept chunks, most relevant first.
+        """
+        heap = [
+            (-score, store_index, position, document)
+            for store_index, scored in enumerate(results)
+            for position, (document, score) in enumerate(scored)
+        ]
+        heapq.heapify(heap)
+
+        kept = []
+        per_document = Counter()
+        while heap and len(kept) < self.k:
+            negative_score, store_index, _, document = heapq.heappop(heap)
+            # Chunks indexed before they were tagged belong to the document of their collection
+            document_key = document.metadata.get("document_id", ("store", store_index))
+            if self.per_document_cap is not None and per_document[document_key] >= self.per_document_cap:
+                continue
+            per_document[document_key] += 1
+            document.metadata["relevance_score"] = -negative_score
+            kept.append(document)
+        return kept
@@ -0,0 +1,198 @@
+"""
+Listing of documents, updates of their selection in a constant number of queries, and the
+selected documents cached in every process.
+
+Every question needs the selected documents. Each process keeps them in memory under a version
+token stored in Redis, so that looking them up is a single Redis read. Changes to the selection,
+ingestion and indexing replace the token, which makes every process read the documents again.
+"""
+import time
+import uuid
+
+import redis
+from django.conf import settings
+from django.db import transaction
+
+from rag_qa.core.answer_cache import get_document_set_key
+from rag_qa.core.models import Document
+
+VERSION_KEY = "selected-documents:version"
+
+# The lookups of the fields documents can be filtered on, all of which can use an index
+FILTER_LOOKUPS = {
+    "name": "name__startswith",
+    "file_path": "file_path__startswith",
+    "indexed": "indexed",
+    "selected": "selected",
+}
+
+
+def filter_documents(filters):
+    """
+    Retrieves the documents matching a filter.
+
+    Args:
+        filters (dict): Any of ``name`` and ``file_path``, the start of the name and of the file path,
+            ``indexed`` and ``selected``.
+
+    Returns:
+        QuerySet: The matching documents.
+    """
+    return Document.objects.filter(**{FILTER_LOOKUPS[field]: value for field, value in filters.items()})
+
+
+def get_document_page(filters, limit, after=None):
+    """
+    Retrieves a page of the documents matching a filter, in the order of their IDs.
+
+    Pages are found by the ID of the last document of the previous page rather than by an offset,
+    so every page is an index range scan, however deep it is.
+
+    Args:
+        filters (dict): The filter, as for ``filter_documents``.
+        limit (int): The number of documents on a page.
+        after (int, optional): The ID of the last document of the previous page.
+
+    Returns:
+        QuerySet: The ``id`` and ``selected`` of the documents of the page, and of the first document
+            of the next page if there is one.
+    """
+    documents = filter_documents(filters)
+    if after is not None:
+        documents = documents.filter(id__gt=after)
+    return documents.order_by("id").values("id", "selected")[:limit + 1]
+
+
+def get_selection_updates(items):
+    """
+    Groups selection changes into one update per selection value.
+
+    Documents already in the requested state are left out, so that they are not written. When a
+    document is listed more than once, its last entry wins.
+
+    Args:
+        items (list[dict]): The changes, each with the ``id`` of a document and whether it is ``selected``.
+
+    Returns:
+        list[tuple[QuerySet, bool]]: The documents to update and the value of ``selected`` to set.
+    """
+    changes = {item["id"]: item["selected"] for item in items}
+    updates = []
+    for selected in (True, False):
+        ids = [document_id for document_id, value in changes.items() if value == selected]
+        if ids:
+            updates.append((Document.objects.filter(id__in=ids).exclude(selected=selected), selected))
+    return updates
+
+
+def update_selection(client, items):
+    """
+    Applies selection changes and, if any document changed, invalidates the selected documents.
+
+    Args:
+        client (Redis): The Redis client.
+        items (list[dict]): The changes, each with the ``id`` of a document and whether it is ``selected``.
+
+    Returns:
+        int: The number of documents whose selection changed.
+    """
+    updated = sum(documents.update(selected=selected) for documents, selected in get_selection_updates(items))
+    if updated:
+        invalidate_selected_documents(client)
+    return updated
+
+
+def select_matching(client, selected, filters):
+    """
+    Sets the selection of all documents matching filters and, if any changed, invalidates the
+    selected documents.
+
+    Args:
+        client (Redis): The Redis client.
+        selected (bool): Whether the documents are selected.
+        filters (dict): The filters, as for ``filter_documents``.
+
+    Returns:
+        int: The number of documents whose selection changed.
+    """
+    updated = filter_documents(filters).exclude(selected=selected).update(selected=selected)
+    if updated:
+        invalidate_selected_documents(client)
+    return updated
+
+
+class SelectedDocuments:
+    """
+    The documents selected for processing, as they are indexed.
+    """
+
+    def __init__(self, rows):
+        """
+        Args:
+            rows (list[tuple]): The ID, index version and name of every selected document, by ID.
+        """
+        self.documents = tuple(row[0] for row in rows)
+        self.versions = tuple(row[1] for row in rows)
+        self.names = {row[0]: row[2] for row in rows}
+        # The key of the document set, the fingerprint of the selection
+        self.fingerprint = get_document_set_key(self.documents, self.versions)
+
+
+# The selected documents last read by this process: the version token, the documents and when they expire
+_cached = (None, None, 0.0)
+
+
+def _read_selected_documents():
+    rows = Document.objects.filter(selected=True).order_by("id").values_list("id", "index_version", "name")
+    return SelectedDocuments(list(rows))
+
+
+def get_selected_documents(client):
+    """
+    Retrieves the selected documents, from the memory of this process while they are unchanged.
+
+    The documents are read from the database again when their version token in Redis has changed,
+    and at least every ``SELECTED_DOCUMENTS_CACHE_TTL`` seconds, in case a change could not reach
+    Redis. When Redis is unavailable, they are read from the database.
+
+    Args:
+        client (Redis): The Redis client.
+
+    Returns:
+        SelectedDocuments: The selected documents.
+    """
+    global _cached
+    if not settings.SELECTED_DOCUMENTS_CACHE_TTL:
+        return _read_selected_documents()
+    try:
+        version = client.get(VERSION_KEY)
+        if version is None:
+            # A new token, as processes may hold documents under the token of a flushed Redis
+            client.set(VERSION_KEY, uuid.uuid4().hex, nx=True)
+            version = client.get(VERSION_KEY)
+    except redis.RedisError:
+        return _read_selected_documents()
+
+    cached_version, selected, expires_at = _cached
+    if version == cached_version and time.monotonic() < expires_at:
+        return selected
+    selected = _read_selected_documents()
+    _cached = (version, selected, time.monotonic() + settings.SELECTED_DOCUMENTS_CACHE_TTL)
+    return selected
+
+
+def invalidate_selected_documents(client):
+    """
+    Makes every process read the selected documents again, once the current transaction commits.
+
+    Args:
+        client (Redis): The Redis client.
+    """
+
+    def replace_version():
+        try:
+            client.set(VERSION_KEY, uuid.uuid4().hex)
+        except redis.RedisError:
+            pass
+
+    transaction.on_commit(replace_version)
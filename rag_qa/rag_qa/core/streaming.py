@@ -0,0 +1,169 @@
+"""
+Streaming of answer tokens from the Celery worker to Server-Sent Events clients through Redis.
+
+The worker publishes every event of an answer, or of a batch of answers, to a pub/sub channel
+and also appends it to a backlog list, so that a client that connects late first replays what it
+missed. Events are numbered, so the overlap between the backlog and the channel is dropped.
+"""
+import asyncio
+import json
+
+CHANNEL_PREFIX = "answer-stream"
+# The events after which a stream ends
+FINAL_EVENTS = ("done", "error")
+
+
+def get_channel(question_id):
+    """
+    Builds the name of the pub/sub channel of a question.
+
+    Args:
+        question_id (str): The ID of the question.
+
+    Returns:
+        str: The channel name. The backlog list has the same name with a ``:backlog`` suffix.
+    """
+    return f"{CHANNEL_PREFIX}:{question_id}"
+
+
+def get_batch_stream_id(batch_id):
+    """
+    Builds the ID that the events of a question batch are published under, in place of a question ID.
+
+    Args:
+        batch_id (str): The ID of the batch.
+
+    Returns:
+        str: The stream ID, which cannot collide with the hex digest of a question ID.
+    """
+    return f"batch:{batch_id}"
+
+
+class AnswerPublisher:
+    """
+    Publishes the events of one answer: its tokens, then ``done`` with the full answer or ``error``.
+
+    For a question batch, an ``answer`` event is published for every answered question, then ``done``
+    with all results or ``error``.
+    """
+
+    def __init__(self, client, question_id, ttl):
+        """
+        Args:
+            client (Redis): The Redis client.
+            question_id (str): The ID of the question being answered.
+            ttl (int): The number of seconds the backlog is kept after the last event.
+        """
+        self.client = client
+        self.channel = get_channel(question_id)
+        self.backlog = f"{self.channel}:backlog"
+        self.ttl = ttl
+        self.seq = 0
+
+    def reset(self):
+        """
+        Drops the backlog of an earlier attempt at the same question.
+        """
+        self.client.delete(self.backlog)
+
+    def publish_token(self, token):
+        self._publish({"event": "token", "token": token})
+
+    def publish_done(self, answer):
+        self._publish({"event": "done", "answer": answer})
+
+    def publish_answer(self, index, result):
+        self._publish({"event": "answer", "index": index, **result})
+
+    def publish_batch_done(self, results):
+        self._publish({"event": "done", "results": results})
+
+    def publish_error(self, message):
+        self._publish({"event": "error", "message": message})
+
+    def _publish(self, message):
+        self.seq += 1
+        data = json.dumps({"seq": self.seq, **message})
+        pipeline = self.client.pipeline()
+        pipeline.rpush(self.backlog, data)
+        pipeline.expire(self.backlog, self.ttl)
+        pipeline.publish(self.channel, data)
+        pipeline.execute()
+
+
+def format_event(message):
+    """
+    Formats a published event as a Server-Sent Event.
+
+    Args:
+        message (dict): The event, with its ``seq`` and ``event`` type.
+
+    Returns:
+        str: The SSE frame.
+    """
+    data = {key: value for key, value in message.items() if key not in ("seq", "event")}
+    return f"id: {message['seq']}\nevent: {message['event']}\ndata: {json.dumps(data)}\n\n"
+
+
+async def single_event(message):
+    """
+    Yields one event as a Server-Sent Event, for answers that are already known.
+
+    Args:
+        message (dict): The event, with its ``seq`` and ``event`` type.
+
+    Yields:
+        str: The SSE frame.
+    """
+    yield format_event(message)
+
+
+async def stream_events(client, question_id, timeout, keepalive):
+    """
+    Yields the events of an answer as Server-Sent Events until it is done or failed.
+
+    The channel is subscribed to before the backlog is read, so no event falls between the two.
+
+    Args:
+        client (redis.asyncio.Redis): The asyncio Redis client. It is closed at the end.
+        question_id (str): The ID of the question, or the stream ID of a question batch.
+        timeout (float): The number of seconds after which the stream gives up.
+        keepalive (float): The number of idle seconds after which an SSE comment is sent.
+
+    Yields:
+        str: SSE frames.
+    """
+    channel = get_channel(question_id)
+    pubsub = client.pubsub()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    try:
+        await pubsub.subscribe(channel)
+        last_seq = 0
+        for data in await client.lrange(f"{channel}:backlog", 0, -1):
+            message = json.loads(data)
+            last_seq = message["seq"]
+            yield format_event(message)
+            if message["event"] in FINAL_EVENTS:
+                return
+
+        while loop.time() < deadline:
+            received = await pubsub.get_message(
+                ignore_subscribe_messages=True,
+                timeout=min(keepalive, deadline - loop.time()),
+            )
+            if received is None:
+                yield ": keep-alive\n\n"
+                continue
+            message = json.loads(received["data"])
+            if message["seq"] <= last_seq:
+                continue
+            last_seq = message["seq"]
+            yield format_event(message)
+            if message["event"] in FINAL_EVENTS:
+                return
+        yield format_event({"seq": last_seq + 1, "event": "timeout"})
+    finally:
+        await pubsub.unsubscribe(channel)
+        await pubsub.aclose()
+        await client.aclose()
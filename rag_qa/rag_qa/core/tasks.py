@@ -1,53 +1,339 @@
 import time
-from celery import shared_task
-from rag_qa.core.helper import query_vector_db, update_vector_db
+from collections import Counter
+from celery import chord, shared_task
+from celery.signals import worker_process_init
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from rag_qa.core.answer_cache import (
+    encode_vector,
+    get_claimable,
+    get_document_set_key,
+    get_expired,
+    get_index_versions,
+    get_question_key,
+)
+from rag_qa.core.clients import init_clients
+from rag_qa.core.embeddings import evict_embeddings
+from rag_qa.core.helper import (
+    answer_query,
+    backfill_chunks,
+    count_pages,
+    delete_new_chunks,
+    delete_stale_chunks,
+    get_last_chunk_id,
+    embed_question,
+    embed_questions,
+    ensure_vector_index,
+    get_redis_client,
+    query_vector_db,
+    query_vector_db_batch,
+    update_vector_db,
+)
+from rag_qa.core.selection import invalidate_selected_documents
+from rag_qa.core.streaming import AnswerPublisher, get_batch_stream_id
 
-from .models import Document
+from .models import Document, Question, QuestionBatch
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    """
+    Creates the OpenAI clients of a new worker process once, for all the tasks it runs.
+    """
+    init_clients()
 
 @shared_task()
-def build_index(document_id):
+def build_index(document_id, incremental=False):
     """
     Builds an index for a given document ID. This task updates the vector database with the document's embeddings and marks the document as indexed in the database.
 
+    Documents of more than ``INGEST_SHARD_PAGES`` pages are split into page ranges, which
+    ``index_pages`` tasks parse, embed and write in parallel on the free ingest workers, and
+    ``finish_index`` completes the build once all of them succeeded. When a shard fails,
+    ``fail_index`` removes what a full build wrote and the document keeps its previous chunks.
+    Shorter documents are indexed by this task.
+
+    When chunks were added or deleted, the index version of the document is incremented, so that
+    answers over its previous chunks are no longer served, and the cached selected documents are
+    invalidated.
+
     Args:
         document_id (int): The ID of the document for which to build the index.
+        incremental (bool): Only re-embed the chunks that changed since the last build.
 
     Raises:
         Exception: If the index building process fails.
     """
+    shard_pages = settings.INGEST_SHARD_PAGES
+    if shard_pages:
+        document = Document.objects.get(id=document_id)
+        page_count = count_pages(document.file_path)
+        if page_count > shard_pages:
+            backfill_chunks(document)
+            # A full build replaces the chunks up to the last one written before it
+            last_stale_id = None if incremental else get_last_chunk_id(document)
+            # The error callback is linked to the shards, which also runs it with eager tasks
+            on_error = fail_index.s(document_id, incremental, last_stale_id)
+            shards = [
+                index_pages.s(document_id, first_page, min(first_page + shard_pages, page_count), incremental)
+                .on_error(on_error)
+                for first_page in range(0, page_count, shard_pages)
+            ]
+            chord(shards)(finish_index.s(document_id, page_count, last_stale_id))
+            print(f"Building index for document with ID {document_id} in {len(shards)} shards")
+            return
+
     try:
-        update_vector_db(document_id)
+        stats = update_vector_db(document_id, incremental=incremental)
     except Exception as e:
         print(f"Failed to build index for document with ID {document_id}: {e}")
         raise
-    document = Document.objects.get(id=document_id)
-    document.indexed = True
-    document.save()
+    complete_index(document_id, stats)
+
+@shared_task()
+def index_pages(document_id, first_page, last_page, incremental=False):
+    """
+    Parses, embeds and writes a range of pages of a document, as one shard of ``build_index``.
+
+    Args:
+        document_id (int): The ID of the document.
+        first_page (int): The first page of the range.
+        last_page (int): The page after the last page of the range.
+        incremental (bool): Only re-embed the chunks that changed since the last build.
+
+    Returns:
+        dict: The chunk and embedding cache statistics of the pages, as for ``update_vector_db``.
+    """
+    return update_vector_db(document_id, incremental=incremental, pages=range(first_page, last_page))
+
+@shared_task()
+def finish_index(results, document_id, page_count, last_stale_id=None):
+    """
+    Completes a sharded build of a document, once every ``index_pages`` task succeeded.
+
+    The chunks of pages no longer in the file are deleted and, after a full build, the chunks it
+    replaced, before the document is marked as indexed.
+
+    Args:
+        results (list[dict]): The statistics of the shards.
+        document_id (int): The ID of the document.
+        page_count (int): The number of pages of the file.
+        last_stale_id (int, optional): After a full build, the ID of the last chunk written before it.
+    """
+    stats = Counter()
+    for result in results:
+        stats.update(result)
+    stats["deleted"] += delete_stale_chunks(document_id, page_count, last_stale_id)
+    complete_index(document_id, dict(stats))
 
 @shared_task()
-def get_rag_response(documents: tuple[int], query: str):
+def fail_index(request, exc, traceback, document_id, incremental=False, last_stale_id=None):
+    """
+    Cleans up after a shard of a sharded build of a document failed.
+
+    A full build writes its chunks next to the previous ones, so the chunks it wrote are deleted
+    and the document keeps its previous chunks. Chunks that shards still running write later are
+    replaced by the next full build. A failed incremental build already replaced some pages and is
+    left for the next build to complete.
+
+    Args:
+        request (Request): The request of the failed shard.
+        exc (Exception): The exception the shard raised.
+        traceback (str): The traceback of the exception.
+        document_id (int): The ID of the document.
+        incremental (bool): Whether the build was incremental.
+        last_stale_id (int, optional): The ID of the last chunk written before the build.
+    """
+    print(f"Failed to build index for document with ID {document_id} in shard {request.id}: {exc}")
+    if not incremental:
+        deleted = delete_new_chunks(document_id, last_stale_id)
+        print(f"Deleted {deleted} chunks of the failed build of document with ID {document_id}")
+
+def complete_index(document_id, stats):
+    """
+    Marks a document as indexed after its chunks were written, by the indexing tasks and the
+    ``build_index`` command.
+
+    Args:
+        document_id (int): The ID of the document.
+        stats (dict): The chunk and embedding cache statistics of the build.
+    """
+    print(f"Built index for document with ID {document_id}: {stats}")
+    changes = {"index_version": F("index_version") + 1} if stats["added"] or stats["deleted"] else {}
+    Document.objects.filter(id=document_id).update(indexed=True, **changes)
+    if changes:
+        invalidate_selected_documents(get_redis_client())
+
+    if settings.PGVECTOR_INDEX_AFTER_INGEST and settings.VECTOR_DB_BACKEND == "pgvector":
+        build_seconds = ensure_vector_index()
+        if build_seconds is not None:
+            print(f"Created the vector index in {build_seconds:.1f}s")
+
+@shared_task()
+def get_rag_response(documents: tuple[int], query: str, question_id: str = None):
     """
     Retrieves a response from the vector database for a given query across a set of documents.
 
+    When a question ID is given, the tokens of the answer are published as they are generated, for
+    the streaming endpoint. The answer is stored on the question with its sources, timings and
+    prompt size, so that polls read the question instead of the result backend, and with the
+    question embedding, for the semantic answer cache. A failed answer marks the question failed.
+
     Args:
         documents (tuple[int]): A tuple of document IDs for which to retrieve the response.
         query (str): The query string to search for in the vector database.
+        question_id (str, optional): The ID of the question being answered.
 
     Returns:
         str: The result of the query.
     """
-    document_names = _get_document_names(documents)
-    result = query_vector_db(document_names, query)
-    return result
+    if question_id is None:
+        return query_vector_db(documents, query)
+
+    publisher = AnswerPublisher(get_redis_client(), question_id, ttl=settings.ANSWER_STREAM_TTL)
+    try:
+        publisher.reset()
+        result = answer_query(documents, query, on_token=publisher.publish_token)
+        # Served from the query embedding cache, retrieval has just embedded the query
+        embedding = encode_vector(embed_question(query))
+    except Exception as e:
+        Question.objects.filter(question_id=question_id).update(status="failed")
+        publisher.publish_error(str(e))
+        raise
+    Question.objects.filter(question_id=question_id).update(
+        status="success",
+        answer=result["answer"],
+        embedding=embedding,
+        prompt_tokens=result["prompt_tokens"],
+        sources=result["sources"],
+        retrieval_seconds=result["retrieval_seconds"],
+        generation_seconds=result["generation_seconds"],
+        answered_at=timezone.now(),
+    )
+    publisher.publish_done(result["answer"])
+    return result["answer"]
 
-def _get_document_names(documents):
+@shared_task()
+def answer_question_batch(batch_id: str):
     """
-    Retrieves the names of documents based on their IDs.
+    Answers the questions of a batch over the documents selected when it was submitted.
+
+    Questions already answered over the same documents get their stored answer. The others are
+    embedded in one batched call and answered together by ``query_vector_db_batch``. Every answer is
+    published for the batch's stream as it arrives and the results are saved after every group of
+    answers, for polling. New answers are also stored as questions, so that later single questions
+    and the semantic answer cache reuse them.
 
     Args:
-        documents (tuple[int]): A tuple of document IDs.
+        batch_id (str): The ID of the batch.
+
+    Returns:
+        int: The number of questions answered with an error.
+    """
+    batch = QuestionBatch.objects.get(batch_id=batch_id)
+    documents = tuple(batch.documents)
+    versions = get_index_versions(documents)
+    document_set = get_document_set_key(documents, versions)
+    results = [None] * len(batch.questions)
+    publisher = AnswerPublisher(get_redis_client(), get_batch_stream_id(batch_id), ttl=settings.ANSWER_STREAM_TTL)
+    publisher.reset()
+
+    def record(pairs):
+        for index, result in pairs:
+            results[index] = result
+            publisher.publish_answer(index, result)
+        QuestionBatch.objects.filter(batch_id=batch_id).update(
+            results=results, completed=sum(result is not None for result in results)
+        )
+
+    try:
+        # Repeated questions are answered once
+        pending = {}
+        for index, question in enumerate(batch.questions):
+            pending.setdefault(get_question_key(documents, versions, question), []).append(index)
+        known = Question.objects.filter(question_id__in=pending, status="success").exclude(answer="")
+        record([
+            (index, {"question": batch.questions[index], "answer": answer})
+            for question_id, answer in known.values_list("question_id", "answer")
+            for index in pending.pop(question_id)
+        ])
+
+        question_ids = list(pending)
+        questions = [batch.questions[indexes[0]] for indexes in pending.values()]
+        vectors = embed_questions(questions) if questions else []
+        answered = []
+
+        def on_answers(pairs):
+            recorded = []
+            for position, answer in pairs:
+                if isinstance(answer, Exception):
+                    result = {"question": questions[position], "error": str(answer)}
+                else:
+                    result = {"question": questions[position], "answer": answer}
+                    answered.append(position)
+                recorded.extend((index, result) for index in pending[question_ids[position]])
+            record(recorded)
+
+        if questions:
+            query_vector_db_batch(documents, questions, vectors, on_answers=on_answers)
+    except Exception as e:
+        QuestionBatch.objects.filter(batch_id=batch_id).update(status="failed")
+        publisher.publish_error(str(e))
+        raise
+
+    answered_at = timezone.now()
+    answers = {
+        question_ids[position]: {
+            "status": "success",
+            "question_text": questions[position],
+            "document_set": document_set,
+            "answer": results[pending[question_ids[position]][0]]["answer"],
+            "embedding": encode_vector(vectors[position]),
+            "answered_at": answered_at,
+        }
+        for position in answered
+    }
+    existing = set(Question.objects.filter(question_id__in=answers).values_list("question_id", flat=True))
+    # Questions asked on their own meanwhile are only updated if no request holds a live claim on them
+    for question_id in existing:
+        get_claimable(question_id, settings.ANSWER_CLAIM_TIMEOUT).update(**answers[question_id])
+    Question.objects.bulk_create(
+        [Question(question_id=question_id, **fields) for question_id, fields in answers.items() if question_id not in existing],
+        ignore_conflicts=True,
+    )
+    QuestionBatch.objects.filter(batch_id=batch_id).update(status="success")
+    publisher.publish_batch_done(results)
+    return sum("error" in result for result in results)
+
+@shared_task()
+def purge_expired_answers():
+    """
+    Deletes the questions older than ``ANSWER_CACHE_TTL`` seconds, run periodically by Celery beat.
+
+    Questions are deleted in batches of ``ANSWER_PURGE_BATCH_SIZE``, so that no single statement
+    holds locks on many rows or runs into the task time limit.
+
+    Returns:
+        int: The number of deleted questions.
+    """
+    deleted = 0
+    while True:
+        ids = list(get_expired(settings.ANSWER_CACHE_TTL).values_list("id", flat=True)[:settings.ANSWER_PURGE_BATCH_SIZE])
+        if not ids:
+            break
+        deleted += Question.objects.filter(id__in=ids).delete()[0]
+    print(f"Purged {deleted} expired questions")
+    return deleted
+
+@shared_task()
+def evict_embedding_cache():
+    """
+    Evicts the least recently used embedding cache entries beyond ``EMBEDDING_CACHE_MAX_ENTRIES``,
+    run periodically by Celery beat, so that storing vectors while ingesting does not count the table.
 
     Returns:
-        list[str]: A list of document names corresponding to the provided IDs.
+        int: The number of evicted entries.
     """
-    return list(Document.objects.filter(id__in=documents).values_list("name", flat=True))
\ No newline at end of file
+    deleted = evict_embeddings(settings.EMBEDDING_CACHE_MAX_ENTRIES, settings.EMBEDDING_CACHE_EVICT_BATCH_SIZE)
+    print(f"Evicted {deleted} embedding cache entries")
+    return deleted
@@ -1,3 +1,1151 @@
-from django.test import TestCase
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+from unittest.mock import MagicMock, patch
 
-# Create your tests here.
+import redis
+from celery.signals import worker_process_init
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from langchain_core.documents import Document as LangchainDocument
+from langchain_core.embeddings import DeterministicFakeEmbedding, Embeddings
+from langchain_core.language_models import FakeStreamingListLLM
+
+from rag_qa.core.answer_cache import encode_vector, get_question_key
+from rag_qa.core.benchmarks import DiscardingVectorStore
+from rag_qa.core.benchmarks import fake_embeddings
+from rag_qa.core.benchmarks import write_synthetic_pdf
+from rag_qa.core.clients import get_embeddings, get_http_client, get_llm, reset_clients
+from rag_qa.core.context import assemble_context
+from rag_qa.core.embeddings import BatchedEmbeddings, CachedEmbeddings, QueryEmbeddingCache, evict_embeddings, hash_text
+from rag_qa.core.helper import _VectorStoreRegistry, backfill_chunks, _get_retriever_object, _index_document, _ingest_document, _iter_chunk_windows, _registry, _reindex_document, _write_window, update_vector_db
+from rag_qa.core.models import Document, DocumentChunk, EmbeddingCache, Question, QuestionBatch
+from rag_qa.core.numpy_store import NumpyVectorStore
+from rag_qa.core.retrieval import ScoredMergeRetriever
+from rag_qa.core import selection
+from rag_qa.core.selection import VERSION_KEY, get_selected_documents, invalidate_selected_documents
+from rag_qa.core.tasks import answer_question_batch, build_index, get_rag_response, purge_expired_answers
+from rag_qa.core.vector_index import recall
+
+
+class StreamingIngestionTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.directory.name, "synthetic.pdf")
+        write_synthetic_pdf(self.file_path, pages=5)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_windows_are_bounded(self):
+        """Test that no window holds more chunks than the window size"""
+        windows = list(_iter_chunk_windows(self.file_path, window_size=2))
+        self.assertTrue(windows)
+        self.assertTrue(all(len(window) <= 2 for window in windows))
+        pages = {chunk.metadata["page"] for window in windows for _, chunk in window}
+        self.assertEqual(pages, set(range(5)))
+
+    def test_ingest_writes_every_chunk(self):
+        """Test that every chunk reaches the vector store"""
+        store = DiscardingVectorStore(fake_embeddings(size=8))
+        expected = sum(len(window) for window in _iter_chunk_windows(self.file_path, window_size=3))
+        written = _ingest_document(self.file_path, store, window_size=3)
+        self.assertEqual(written, expected)
+        self.assertEqual(store.count, expected)
+
+
+class MemoryVectorStore:
+    """A vector store stand-in that keeps chunks in a dict keyed by ID."""
+
+    def __init__(self):
+        self.chunks = {}
+
+    def add_documents(self, documents, ids=None, **kwargs):
+        self.chunks.update(zip(ids, documents))
+        return ids
+
+    def delete(self, ids=None, **kwargs):
+        for vector_id in ids:
+            del self.chunks[vector_id]
+
+
+class IncrementalIndexingTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.directory.name, "document.pdf")
+        write_synthetic_pdf(self.file_path, pages=6)
+        self.document = Document.objects.create(name="Document", file_path=self.file_path)
+        self.store = MemoryVectorStore()
+        self.chunk_count = _index_document(self.document, self.store)["added"]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_unchanged_document_writes_nothing(self):
+        """Test that re-indexing an unchanged file keeps every chunk"""
+        stats = _reindex_document(self.document, self.store)
+        self.assertEqual(stats, {"added": 0, "deleted": 0, "kept": self.chunk_count})
+        self.assertEqual(len(self.store.chunks), self.chunk_count)
+
+    def test_only_edited_page_is_rewritten(self):
+        """Test that only the chunks of an edited page are replaced"""
+        before = set(self.store.chunks)
+        write_synthetic_pdf(self.file_path, pages=6, edited_pages=(3,))
+        stats = _reindex_document(self.document, self.store)
+
+        self.assertGreater(stats["added"], 0)
+        self.assertEqual(stats["added"], stats["deleted"])
+        self.assertEqual(stats["kept"], self.chunk_count - stats["deleted"])
+        added = set(self.store.chunks) - before
+        self.assertEqual(set(DocumentChunk.objects.filter(vector_id__in=added).values_list("page", flat=True)), {2})
+        self.assertEqual(len(before - set(self.store.chunks)), stats["deleted"])
+        self.assertEqual(self.document.chunks.count(), len(self.store.chunks))
+
+    def test_removed_pages_are_deleted(self):
+        """Test that chunks of pages no longer in the file are deleted"""
+        write_synthetic_pdf(self.file_path, pages=4)
+        stats = _reindex_document(self.document, self.store)
+        self.assertEqual(stats["added"], 0)
+        self.assertEqual(set(self.document.chunks.values_list("page", flat=True)), {0, 1, 2, 3})
+        self.assertEqual(self.document.chunks.count(), len(self.store.chunks))
+
+    def test_chunks_are_tagged_with_document(self):
+        """Test that every chunk carries the ID of its document"""
+        document_ids = {chunk.metadata["document_id"] for chunk in self.store.chunks.values()}
+        self.assertEqual(document_ids, {self.document.id})
+
+    def test_full_index_replaces_previous_chunks(self):
+        """Test that a full rebuild does not leave the previous chunks behind"""
+        stats = _index_document(self.document, self.store)
+        self.assertEqual(stats["deleted"], self.chunk_count)
+        self.assertEqual(len(self.store.chunks), self.chunk_count)
+
+    @override_settings(VECTOR_DB_INGEST_WINDOW_SIZE=2)
+    def test_failed_full_index_keeps_previous_chunks(self):
+        """Test that a full rebuild that fails partway leaves the previous chunks in place"""
+        before = set(self.store.chunks)
+        windows = []
+
+        def write_window(db, window, document=None):
+            if windows:
+                raise RuntimeError("Embedding failed")
+            windows.append(window)
+            _write_window(db, window, document)
+
+        with patch("rag_qa.core.helper._write_window", side_effect=write_window):
+            with self.assertRaises(RuntimeError):
+                _index_document(self.document, self.store)
+        self.assertLessEqual(before, set(self.store.chunks))
+        self.assertLessEqual(before, set(self.document.chunks.values_list("vector_id", flat=True)))
+
+
+@override_settings(VECTOR_DB_COLLECTION_LAYOUT="per_document")
+class UnrecordedIndexTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.directory.name, "document.pdf")
+        write_synthetic_pdf(self.file_path, pages=4)
+        self.document = Document.objects.create(name="Document", file_path=self.file_path, indexed=True)
+        # Indexed before chunks were recorded
+        self.store = MemoryVectorStore()
+        self.chunk_count = _ingest_document(self.file_path, self.store)
+        embeddings = MagicMock()
+        embeddings.stats.return_value = {"hits": 0, "misses": 0}
+        for patcher in (
+            patch("rag_qa.core.helper._create_database_object", return_value=self.store),
+            patch("rag_qa.core.helper._get_embeddings", return_value=embeddings),
+            patch("rag_qa.core.helper._get_backend_engine"),
+            patch(
+                "rag_qa.core.helper._iter_collection_chunks",
+                side_effect=lambda db: [(vector_id, chunk.page_content, chunk.metadata) for vector_id, chunk in db.chunks.items()],
+            ),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_full_rebuild_replaces_unrecorded_chunks(self):
+        """Test that rebuilding a document indexed without records does not duplicate its chunks"""
+        before = set(self.store.chunks)
+        stats = update_vector_db(self.document.id)
+        self.assertEqual((stats["added"], stats["deleted"]), (self.chunk_count, self.chunk_count))
+        self.assertEqual(len(self.store.chunks), self.chunk_count)
+        self.assertFalse(before & set(self.store.chunks))
+        self.assertEqual(set(self.document.chunks.values_list("vector_id", flat=True)), set(self.store.chunks))
+
+    def test_incremental_rebuild_keeps_unrecorded_chunks(self):
+        """Test that re-indexing a document indexed without records matches its stored chunks"""
+        before = set(self.store.chunks)
+        stats = update_vector_db(self.document.id, incremental=True)
+        self.assertEqual((stats["added"], stats["deleted"], stats["kept"]), (0, 0, self.chunk_count))
+        self.assertEqual(set(self.store.chunks), before)
+
+    @override_settings(VECTOR_DB_COLLECTION_LAYOUT="shared")
+    def test_shared_collection_is_not_backfilled(self):
+        """Test that chunks are only backfilled from per-document collections"""
+        self.assertEqual(backfill_chunks(self.document), 0)
+        self.assertFalse(self.document.chunks.exists())
+
+
+@override_settings(INGEST_SHARD_PAGES=2)
+class ShardedIndexingTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.directory.name, "document.pdf")
+        write_synthetic_pdf(self.file_path, pages=6)
+        self.document = Document.objects.create(name="Document", file_path=self.file_path)
+        self.store = MemoryVectorStore()
+        embeddings = MagicMock()
+        embeddings.stats.return_value = {"hits": 0, "misses": 0}
+        for patcher in (
+            patch("rag_qa.core.helper._create_database_object", return_value=self.store),
+            patch("rag_qa.core.helper._get_embeddings", return_value=embeddings),
+            patch("rag_qa.core.helper._get_backend_engine"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # The chord runs in the test, as it would on the workers
+        conf = build_index.app.conf
+        self.addCleanup(setattr, conf, "task_always_eager", conf.task_always_eager)
+        conf.task_always_eager = True
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _pages(self):
+        return sorted(self.document.chunks.values_list("page", flat=True).distinct())
+
+    def test_document_is_indexed_in_shards(self):
+        """Test that every page range is indexed by its own task and the document marked as indexed"""
+        with patch("rag_qa.core.tasks.update_vector_db", wraps=update_vector_db) as mock_update_vector_db:
+            build_index(self.document.id)
+        shards = [call.kwargs["pages"] for call in mock_update_vector_db.call_args_list]
+        self.assertEqual(shards, [range(0, 2), range(2, 4), range(4, 6)])
+
+        self.assertEqual(self._pages(), list(range(6)))
+        self.assertEqual(self.document.chunks.count(), len(self.store.chunks))
+        self.document.refresh_from_db()
+        self.assertEqual((self.document.indexed, self.document.index_version), (True, 1))
+
+    def test_full_build_replaces_previous_chunks(self):
+        """Test that a sharded rebuild deletes the chunks it replaced once every shard is written"""
+        build_index(self.document.id)
+        before = set(self.store.chunks)
+        build_index(self.document.id)
+        self.assertEqual(len(self.store.chunks), len(before))
+        self.assertFalse(before & set(self.store.chunks))
+        self.assertEqual(self.document.chunks.count(), len(self.store.chunks))
+
+    def test_incremental_build_in_shards(self):
+        """Test that a sharded re-index rewrites the edited page and drops the removed ones"""
+        build_index(self.document.id)
+        chunk_count = len(self.store.chunks)
+        write_synthetic_pdf(self.file_path, pages=6, edited_pages=(3,))
+        before = set(self.store.chunks)
+        build_index(self.document.id, incremental=True)
+        added = set(self.store.chunks) - before
+        self.assertEqual(set(DocumentChunk.objects.filter(vector_id__in=added).values_list("page", flat=True)), {2})
+        self.assertEqual(len(self.store.chunks), chunk_count)
+
+        write_synthetic_pdf(self.file_path, pages=3)
+        build_index(self.document.id, incremental=True)
+        self.assertEqual(self._pages(), [0, 1, 2])
+        self.assertEqual(self.document.chunks.count(), len(self.store.chunks))
+
+    def _fail_last_shard(self):
+        def index(document_id, incremental=False, pages=None):
+            if pages.start == 4:
+                raise RuntimeError("Embedding failed")
+            return update_vector_db(document_id, incremental=incremental, pages=pages)
+        return patch("rag_qa.core.tasks.update_vector_db", side_effect=index)
+
+    def test_failed_shard_keeps_previous_chunks(self):
+        """Test that a failed shard of a full rebuild deletes the chunks the build wrote"""
+        build_index(self.document.id)
+        before = set(self.store.chunks)
+        with self._fail_last_shard(), self.assertRaises(RuntimeError):
+            build_index(self.document.id)
+        self.assertEqual(set(self.store.chunks), before)
+        self.assertEqual(set(self.document.chunks.values_list("vector_id", flat=True)), before)
+        self.document.refresh_from_db()
+        self.assertEqual((self.document.indexed, self.document.index_version), (True, 1))
+
+    def test_failed_first_build_leaves_no_chunks(self):
+        """Test that a failed shard of the first build of a document leaves it without chunks"""
+        with self._fail_last_shard(), self.assertRaises(RuntimeError):
+            build_index(self.document.id)
+        self.assertEqual(self.store.chunks, {})
+        self.assertFalse(self.document.chunks.exists())
+        self.document.refresh_from_db()
+        self.assertFalse(self.document.indexed)
+
+    @override_settings(INGEST_SHARD_PAGES=6)
+    def test_short_document_is_indexed_in_one_task(self):
+        """Test that a document of one shard is indexed without a chord"""
+        with patch("rag_qa.core.tasks.chord") as mock_chord:
+            build_index(self.document.id)
+        mock_chord.assert_not_called()
+        self.assertEqual(self._pages(), list(range(6)))
+
+class RetrieverTests(TestCase):
+    def setUp(self):
+        self.doc1 = Document.objects.create(name="Doc 1", file_path="/path/to/doc1.pdf")
+        self.doc2 = Document.objects.create(name="Doc 2", file_path="/path/to/doc2.pdf")
+        query_embeddings = patch("rag_qa.core.helper._get_query_embeddings")
+        query_embeddings.start()
+        self.addCleanup(query_embeddings.stop)
+
+    @override_settings(VECTOR_DB_COLLECTION_LAYOUT="shared", VECTOR_DB_SHARED_COLLECTION="documents", RETRIEVAL_TOP_K=5)
+    @patch("rag_qa.core.helper.ScoredMergeRetriever")
+    @patch("rag_qa.core.helper._get_db_by_name")
+    def test_shared_layout_uses_one_filtered_query(self, mock_get_db_by_name, mock_merger_retriever):
+        """Test that the shared layout queries one collection filtered on the selected documents"""
+        _get_retriever_object([self.doc1.id, self.doc2.id])
+        mock_get_db_by_name.assert_called_once_with("documents")
+        options = mock_merger_retriever.call_args.kwargs
+        self.assertEqual(options["stores"], [mock_get_db_by_name.return_value])
+        self.assertEqual((options["k"], options["fetch_k"]), (5, 5))
+        self.assertEqual(
+            options["search_kwargs"],
+            {"filter": {"document_id": {"in": [str(self.doc1.id), str(self.doc2.id)]}}},
+        )
+
+    @override_settings(VECTOR_DB_COLLECTION_LAYOUT="per_document", RETRIEVAL_TOP_K=5, RETRIEVAL_PER_DOCUMENT_CAP=3)
+    @patch("rag_qa.core.helper.ScoredMergeRetriever")
+    @patch("rag_qa.core.helper._get_db_by_name")
+    def test_per_document_layout_queries_each_collection(self, mock_get_db_by_name, mock_merger_retriever):
+        """Test that the per-document layout opens the collection of every document"""
+        _get_retriever_object([self.doc1.id, self.doc2.id])
+        opened = sorted(call.args[0] for call in mock_get_db_by_name.call_args_list)
+        self.assertEqual(opened, ["Doc 1", "Doc 2"])
+        options = mock_merger_retriever.call_args.kwargs
+        self.assertEqual((options["k"], options["fetch_k"], options["per_document_cap"]), (5, 3, 3))
+
+    @override_settings(VECTOR_DB_COLLECTION_LAYOUT="shared", RETRIEVAL_TOP_K=4, RETRIEVAL_PER_DOCUMENT_CAP=2, RETRIEVAL_FETCH_K=20)
+    @patch("rag_qa.core.helper.ScoredMergeRetriever")
+    @patch("rag_qa.core.helper._get_db_by_name")
+    def test_shared_layout_over_fetches_when_capped(self, mock_get_db_by_name, mock_merger_retriever):
+        """Test that a per-document cap on the shared collection fetches more chunks than it keeps"""
+        _get_retriever_object([self.doc1.id])
+        options = mock_merger_retriever.call_args.kwargs
+        self.assertEqual((options["k"], options["fetch_k"], options["per_document_cap"]), (4, 20, 2))
+        self.assertEqual(options["search_kwargs"], {"filter": {"document_id": {"in": [str(self.doc1.id)]}}})
+
+
+class ScoredMergeRetrieverTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.embedding = DeterministicFakeEmbedding(size=16)
+        self.stores = []
+        for document_id in range(3):
+            store = NumpyVectorStore(self.embedding, os.path.join(self.directory.name, str(document_id)))
+            store.add_texts(
+                [f"document {document_id} chunk {index}" for index in range(5)],
+                metadatas=[{"document_id": document_id} for _ in range(5)],
+            )
+            self.stores.append(store)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_keeps_global_top_k_by_score(self):
+        """Test that k chunks are returned in total, best first, whatever the number of stores"""
+        retriever = ScoredMergeRetriever(stores=self.stores, embeddings=self.embedding, k=4, fetch_k=4)
+        found = retriever.invoke("document 2 chunk 3")
+        self.assertEqual(len(found), 4)
+        self.assertEqual(found[0].page_content, "document 2 chunk 3")
+        scores = [document.metadata["relevance_score"] for document in found]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+        every = [pair for store in self.stores for pair in store.similarity_search_with_relevance_scores("document 2 chunk 3", k=15)]
+        best = sorted(every, key=lambda pair: -pair[1])[:4]
+        self.assertEqual([document.id for document in found], [document.id for document, _ in best])
+
+    def test_retrieval_by_many_vectors_matches_single_queries(self):
+        """Test that multi-query retrieval returns what each query retrieves on its own"""
+        retriever = ScoredMergeRetriever(stores=self.stores, embeddings=self.embedding, k=4, fetch_k=4)
+        queries = ["document 0 chunk 1", "document 2 chunk 3", "document 1 chunk 0"]
+        found = retriever.retrieve_by_vectors([self.embedding.embed_query(query) for query in queries])
+        self.assertEqual(
+            [[document.id for document in documents] for documents in found],
+            [[document.id for document in retriever.invoke(query)] for query in queries],
+        )
+
+    def test_per_document_cap(self):
+        """Test that no document contributes more chunks than the cap"""
+        shared = NumpyVectorStore(self.embedding, os.path.join(self.directory.name, "shared"))
+        shared.add_texts(
+            [f"document {index % 3} chunk {index}" for index in range(15)],
+            metadatas=[{"document_id": index % 3} for index in range(15)],
+        )
+        retriever = ScoredMergeRetriever(stores=[shared], embeddings=self.embedding, k=4, fetch_k=15, per_document_cap=2)
+        found = retriever.invoke("document 1 chunk 4")
+        self.assertEqual(len(found), 4)
+        counts = Counter(document.metadata["document_id"] for document in found)
+        self.assertTrue(all(count <= 2 for count in counts.values()))
+
+
+@patch("rag_qa.core.helper._get_embeddings")
+@patch("rag_qa.core.helper._create_database_object")
+@patch("rag_qa.core.helper.sqlalchemy.create_engine")
+class VectorStoreRegistryTests(SimpleTestCase):
+    def test_engine_and_stores_are_reused(self, mock_create_engine, mock_create_database_object, mock_get_embeddings):
+        """Test that the engine and the store of a collection are created once"""
+        registry = _VectorStoreRegistry()
+        first = registry.get_store("documents")
+        second = registry.get_store("documents")
+        self.assertIs(first, second)
+        self.assertEqual(mock_create_engine.call_count, 1)
+        self.assertEqual(mock_create_database_object.call_count, 1)
+
+    @override_settings(VECTOR_DB_STORE_CACHE_SIZE=2)
+    def test_least_recently_used_store_is_dropped(self, mock_create_engine, mock_create_database_object, mock_get_embeddings):
+        """Test that the registry keeps a bounded number of stores"""
+        mock_create_database_object.side_effect = lambda embeddings, name, engine: name
+        registry = _VectorStoreRegistry()
+        for name in ["a", "b", "a", "c", "a", "b"]:
+            registry.get_store(name)
+        created = [call.args[1] for call in mock_create_database_object.call_args_list]
+        self.assertEqual(created, ["a", "b", "c", "b"])
+
+    def test_forked_process_gets_its_own_engine(self, mock_create_engine, mock_create_database_object, mock_get_embeddings):
+        """Test that a forked child does not reuse the parent's connections"""
+        registry = _VectorStoreRegistry()
+        parent_engine = registry.get_engine()
+        with patch("rag_qa.core.helper.os.getpid", return_value=-1):
+            registry.get_engine()
+        parent_engine.dispose.assert_called_once_with(close=False)
+        self.assertEqual(mock_create_engine.call_count, 2)
+
+
+class NumpyVectorStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.embedding = DeterministicFakeEmbedding(size=16)
+        self.store = NumpyVectorStore(self.embedding, self.directory.name, block_size=3, max_shards=4)
+        self.texts = [f"chunk {index}" for index in range(10)]
+        self.ids = self.store.add_texts(
+            self.texts,
+            metadatas=[{"document_id": index % 2} for index in range(10)],
+            ids=[str(index) for index in range(10)],
+        )
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_nearest_chunk_comes_first(self):
+        """Test that a chunk is its own nearest neighbour, with a distance of zero"""
+        document, distance = self.store.similarity_search_with_score("chunk 7", k=3)[0]
+        self.assertEqual(document.page_content, "chunk 7")
+        self.assertEqual(document.id, "7")
+        self.assertAlmostEqual(distance, 0.0, places=5)
+
+    def test_blocked_search_matches_exact_search(self):
+        """Test that keeping the top k of each block finds the exact top k"""
+        query = self.embedding.embed_query("question")
+        vectors = [self.embedding.embed_query(text) for text in self.texts]
+        exact = sorted(range(10), key=lambda index: -self._cosine(query, vectors[index]))[:4]
+        found = self.store.similarity_search_by_vector(query, k=4)
+        self.assertEqual([document.id for document in found], [str(index) for index in exact])
+
+    def test_search_by_many_vectors_matches_single_searches(self):
+        """Test that scoring a block against all queries at once finds each query's top k"""
+        queries = [self.embedding.embed_query(text) for text in ("chunk 1", "chunk 8", "question")]
+        found = self.store.similarity_search_with_score_by_vectors(queries, k=4, filter={"document_id": {"in": ["0"]}})
+        for query, pairs in zip(queries, found):
+            expected = self.store.similarity_search_with_score_by_vector(query, k=4, filter={"document_id": {"in": ["0"]}})
+            self.assertEqual([document.id for document, _ in pairs], [document.id for document, _ in expected])
+            self.assertEqual([round(distance, 5) for _, distance in pairs], [round(distance, 5) for _, distance in expected])
+
+    def test_filter_on_document(self):
+        """Test that only chunks of the selected documents are returned"""
+        found = self.store.similarity_search("chunk 2", k=10, filter={"document_id": {"in": ["1"]}})
+        self.assertEqual(sorted(document.id for document in found), ["1", "3", "5", "7", "9"])
+
+    def test_rows_are_read_from_the_sidecar(self):
+        """Test that texts and metadata are read when returned, and other keys can still be filtered on"""
+        self.store.add_texts(["chunk 10"], metadatas=[{"document_id": 0, "page": 3}], ids=["10"])
+        found = self.store.similarity_search("chunk 10", k=10, filter={"page": 3})
+        self.assertEqual([(document.id, document.page_content, document.metadata) for document in found], [("10", "chunk 10", {"document_id": 0, "page": 3})])
+        shard = self.store._shards[self.store._list_shards()[0]]
+        self.assertFalse(hasattr(shard, "records"))
+        self.assertEqual(shard.record(9), {"id": "9", "text": "chunk 9", "metadata": {"document_id": 1}})
+
+    def test_deleted_chunks_are_not_returned(self):
+        """Test that deletes are visible to searches and to other store objects"""
+        other = NumpyVectorStore(self.embedding, self.directory.name)
+        other.similarity_search("chunk 4", k=1)
+        self.store.delete(ids=["4"])
+        self.assertNotEqual(other.similarity_search("chunk 4", k=1)[0].id, "4")
+
+    def test_compaction_keeps_live_chunks(self):
+        """Test that compacting into one shard drops deleted chunks and keeps the rest"""
+        for index in range(10, 15):
+            self.store.add_texts([f"chunk {index}"], ids=[str(index)])
+        self.store.delete(ids=["0", "11"])
+        self.store.compact()
+        self.assertEqual(len(self.store._list_shards()), 1)
+        found = self.store.similarity_search("chunk 1", k=20)
+        self.assertEqual(sorted(int(document.id) for document in found), [1, *range(2, 11), 12, 13, 14])
+
+    def test_compaction_waits_for_a_search_snapshot(self):
+        """Test that a compaction cannot replace the tombstones while a search reads the shards"""
+        self.store.add_texts(["chunk 10"], ids=["10"])
+        self.store.delete(ids=["4"])
+        reader = NumpyVectorStore(self.embedding, self.directory.name)
+        compacted = threading.Event()
+        compactor = threading.Thread(target=lambda: (self.store.compact(), compacted.set()))
+        list_shards = reader._list_shards
+
+        def list_then_compact():
+            names = list_shards()
+            compactor.start()
+            self.assertFalse(compacted.wait(timeout=0.2))
+            return names
+
+        with patch.object(reader, "_list_shards", side_effect=list_then_compact):
+            found = reader.similarity_search("chunk 4", k=20)
+        compactor.join()
+        self.assertTrue(compacted.is_set())
+        self.assertEqual(sorted(int(document.id) for document in found), [0, 1, 2, 3, *range(5, 11)])
+        found = reader.similarity_search("chunk 4", k=20)
+        self.assertEqual(sorted(int(document.id) for document in found), [0, 1, 2, 3, *range(5, 11)])
+
+    def _cosine(self, a, b):
+        return sum(x * y for x, y in zip(a, b)) / (sum(x * x for x in a) * sum(y * y for y in b)) ** 0.5
+
+
+class NumpyBackendTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_paths = []
+        for index, pages in enumerate([3, 2]):
+            file_path = os.path.join(self.directory.name, f"document{index}.pdf")
+            write_synthetic_pdf(file_path, pages=pages)
+            self.file_paths.append(file_path)
+        self.doc1 = Document.objects.create(name="Doc 1", file_path=self.file_paths[0])
+        self.doc2 = Document.objects.create(name="Doc/2", file_path=self.file_paths[1])
+        self.embeddings = CachedEmbeddings(DeterministicFakeEmbedding(size=16), model_name="fake")
+        _registry.clear()
+
+    def tearDown(self):
+        _registry.clear()
+        self.directory.cleanup()
+
+    def _run_pipeline(self):
+        with patch("rag_qa.core.helper._get_embeddings", return_value=self.embeddings), \
+                patch("rag_qa.core.helper._get_query_embeddings", return_value=self.embeddings.embeddings):
+            for document in [self.doc1, self.doc2]:
+                update_vector_db(document.id)
+            return _get_retriever_object([self.doc2.id]).invoke("page 1 line 3")
+
+    def test_pipeline_runs_offline_on_shared_collection(self):
+        """Test that documents are indexed and retrieved without a database round trip"""
+        with self.settings(VECTOR_DB_BACKEND="numpy", VECTOR_DB_NUMPY_DIR=self.directory.name, VECTOR_DB_COLLECTION_LAYOUT="shared"):
+            found = self._run_pipeline()
+        self.assertTrue(found)
+        self.assertEqual({chunk.metadata["document_id"] for chunk in found}, {self.doc2.id})
+
+    def test_pipeline_runs_offline_per_document(self):
+        """Test that per-document collections get their own directories"""
+        with self.settings(VECTOR_DB_BACKEND="numpy", VECTOR_DB_NUMPY_DIR=self.directory.name, VECTOR_DB_COLLECTION_LAYOUT="per_document"):
+            found = self._run_pipeline()
+        self.assertTrue(found)
+        self.assertEqual({chunk.metadata["document_id"] for chunk in found}, {self.doc2.id})
+        self.assertTrue(os.path.isdir(os.path.join(self.directory.name, "Doc%2F2")))
+
+
+class RecordingEmbeddings(Embeddings):
+    """A local embedder that returns the number in each text and records every batch it receives."""
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        with self.lock:
+            self.batches.append(list(texts))
+        # Later batches finish first, so ordering bugs show up.
+        time.sleep(self.delay / (len(self.batches) + 1))
+        return [[float(text.split()[-1])] for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class BatchedEmbeddingsTests(SimpleTestCase):
+    def setUp(self):
+        self.texts = [f"chunk {index}" for index in range(10)]
+
+    def _batched(self, embeddings, **kwargs):
+        options = {"max_batch_tokens": 4, "max_batch_size": 100, "max_concurrency": 3}
+        options.update(kwargs)
+        return BatchedEmbeddings(embeddings, length_function=lambda text: len(text.split()), **options)
+
+    def test_batches_are_bounded_by_tokens(self):
+        """Test that no batch holds more tokens than the limit"""
+        embeddings = RecordingEmbeddings()
+        self._batched(embeddings).embed_documents(self.texts)
+        self.assertEqual(len(embeddings.batches), 5)
+        self.assertTrue(all(len(batch) == 2 for batch in embeddings.batches))
+
+    def test_batches_are_bounded_by_size(self):
+        """Test that no batch holds more texts than the limit"""
+        embeddings = RecordingEmbeddings()
+        self._batched(embeddings, max_batch_tokens=1000, max_batch_size=3).embed_documents(self.texts)
+        self.assertEqual([len(batch) for batch in embeddings.batches], [3, 3, 3, 1])
+
+    def test_results_keep_input_order(self):
+        """Test that vectors come back in input order when batches finish out of order"""
+        vectors = self._batched(RecordingEmbeddings(delay=0.05)).embed_documents(self.texts)
+        self.assertEqual(vectors, [[float(index)] for index in range(10)])
+
+    def test_tokens_are_estimated_without_encoding(self):
+        """Test that batching falls back to estimated token counts when the encoding cannot be loaded"""
+        embeddings = RecordingEmbeddings()
+        batched = BatchedEmbeddings(embeddings, max_batch_tokens=4, max_batch_size=100, max_concurrency=1)
+        with patch("rag_qa.core.context._get_encoding", return_value=None):
+            batched.embed_documents([f"text {index:03d}" for index in range(4)])
+        # Two tokens each, by the estimate of one token per four characters
+        self.assertEqual([len(batch) for batch in embeddings.batches], [2, 2])
+
+
+class CachedEmbeddingsTests(TestCase):
+    def setUp(self):
+        self.provider = RecordingEmbeddings()
+        self.embeddings = CachedEmbeddings(self.provider, model_name="test-model")
+
+    def test_repeated_texts_are_served_from_cache(self):
+        """Test that chunks embedded once are not sent to the provider again"""
+        texts = ["chunk 1", "chunk 2"]
+        first = self.embeddings.embed_documents(texts)
+        second = self.embeddings.embed_documents(["chunk  2\n", "chunk 1", "chunk 3"])
+        self.assertEqual(self.provider.batches, [texts, ["chunk 3"]])
+        self.assertEqual(second[:2], [first[1], first[0]])
+        self.assertEqual(self.embeddings.stats(), {"hits": 2, "misses": 3})
+
+    def test_cache_is_keyed_by_model(self):
+        """Test that another embedding model does not reuse cached vectors"""
+        self.embeddings.embed_documents(["chunk 1"])
+        other = CachedEmbeddings(self.provider, model_name="other-model")
+        other.embed_query("chunk 1")
+        self.assertEqual(other.stats(), {"hits": 0, "misses": 1})
+
+    def test_least_recently_used_entries_are_evicted(self):
+        """Test that eviction keeps the most recently used entries, deleting in batches"""
+        self.embeddings.embed_documents(["chunk 1", "chunk 2", "chunk 3", "chunk 4", "chunk 5"])
+        EmbeddingCache.objects.update(last_used_at=timezone.now() - timedelta(hours=1))
+        self.embeddings.embed_documents(["chunk 2", "chunk 5"])
+
+        with self.assertNumQueries(5):
+            self.assertEqual(evict_embeddings(max_entries=2, batch_size=2), 3)
+        self.assertEqual(self.embeddings.embed_documents(["chunk 2", "chunk 5"]), [[2.0], [5.0]])
+        self.assertEqual(self.provider.batches, [["chunk 1", "chunk 2", "chunk 3", "chunk 4", "chunk 5"]])
+
+    def test_recently_used_entries_are_not_written(self):
+        """Test that a hit only marks an entry as used when it was last marked a while ago"""
+        self.embeddings.embed_documents(["chunk 1"])
+        with self.assertNumQueries(1):
+            self.embeddings.embed_documents(["chunk 1"])
+
+        EmbeddingCache.objects.update(last_used_at=timezone.now() - timedelta(hours=1))
+        with self.assertNumQueries(2):
+            self.embeddings.embed_documents(["chunk 1"])
+        self.assertGreater(EmbeddingCache.objects.get().last_used_at, timezone.now() - timedelta(minutes=1))
+
+
+class FakeRedis:
+    """An in-memory stand-in for the few Redis commands used by the caches and the answer stream."""
+
+    def __init__(self):
+        self.values = {}
+        self.sorted_sets = {}
+        self.published = []
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def mget(self, keys):
+        return [self.values.get(key) for key in keys]
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        return True
+
+    def expire(self, key, seconds):
+        pass
+
+    def zadd(self, key, mapping):
+        self.sorted_sets.setdefault(key, {}).update(mapping)
+
+    def zcard(self, key):
+        return len(self.sorted_sets.get(key, {}))
+
+    def zpopmin(self, key, count):
+        members = sorted(self.sorted_sets[key].items(), key=lambda item: item[1])[:count]
+        for member, _ in members:
+            del self.sorted_sets[key][member]
+        return members
+
+    def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+
+    def rpush(self, key, value):
+        self.values.setdefault(key, []).append(value)
+
+    def publish(self, channel, message):
+        self.published.append((channel, message))
+
+    def pipeline(self):
+        return self
+
+    def execute(self):
+        pass
+
+
+class QueryEmbeddingCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.provider = RecordingEmbeddings()
+        self.client = FakeRedis()
+
+    def _cache(self, model_name="test-model", max_entries=100):
+        return QueryEmbeddingCache(self.provider, model_name=model_name, client=self.client, ttl=60, max_entries=max_entries)
+
+    def test_repeated_question_is_not_embedded_again(self):
+        """Test that a question asked again, differently spaced, costs no embedding call"""
+        cache = self._cache()
+        first = cache.embed_query("question 7")
+        second = cache.embed_query("  question\n7 ")
+        self.assertEqual(first, second)
+        self.assertEqual(self.provider.batches, [["question 7"]])
+
+    def test_cache_is_keyed_by_model(self):
+        """Test that another embedding model does not reuse cached vectors"""
+        self._cache().embed_query("question 7")
+        self._cache(model_name="other-model").embed_query("question 7")
+        self.assertEqual(len(self.provider.batches), 2)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        """Test that the cache does not grow past its size and keeps recently used entries"""
+        cache = self._cache(max_entries=2)
+        cache.embed_query("question 1")
+        cache.embed_query("question 2")
+        cache.embed_query("question 1")
+        cache.embed_query("question 3")
+        self.assertEqual(len(self.client.values), 2)
+        cache.embed_query("question 1")
+        self.assertEqual(len(self.provider.batches), 3)
+
+    def test_batch_embeds_misses_in_one_call(self):
+        """Test that a batch embeds its uncached, distinct questions together and keeps their order"""
+        cache = self._cache()
+        cache.embed_query("question 2")
+        vectors = cache.embed_queries(["question 1", "question 2", "question 3", "question  1"])
+        self.assertEqual(vectors, [[1.0], [2.0], [3.0], [1.0]])
+        self.assertEqual(self.provider.batches, [["question 2"], ["question 1", "question 3"]])
+        self.assertEqual(cache.embed_query("question 3"), [3.0])
+        self.assertEqual(len(self.provider.batches), 2)
+
+    def test_unavailable_redis_falls_back_to_embedding(self):
+        """Test that the question is still embedded when Redis cannot be reached"""
+        cache = self._cache()
+        with patch.object(self.client, "get", side_effect=redis.ConnectionError):
+            self.assertEqual(cache.embed_query("question 7"), [7.0])
+
+
+class ClientsTests(SimpleTestCase):
+    def tearDown(self):
+        reset_clients()
+
+    def test_clients_are_shared(self):
+        """Test that the LLM and the embeddings are created once and send requests through one HTTP client"""
+        self.assertIs(get_llm(), get_llm())
+        self.assertIs(get_embeddings(), get_embeddings())
+        self.assertIs(get_llm().http_client, get_http_client())
+        self.assertIs(get_embeddings().http_client, get_http_client())
+
+    def test_worker_process_creates_its_own_clients(self):
+        """Test that a new worker process does not reuse the clients it inherited"""
+        inherited = get_http_client()
+        worker_process_init.send(sender=None)
+        self.assertIsNot(get_http_client(), inherited)
+        self.assertIs(get_llm().http_client, get_http_client())
+
+
+class VectorIndexTests(TestCase):
+    def test_recall_against_exact_results(self):
+        """Test that recall is the mean fraction of exact neighbours found"""
+        self.assertEqual(recall([[1, 2], [3, 5]], [[1, 2], [3, 4]]), 0.75)
+
+    @override_settings(PGVECTOR_INDEX_AFTER_INGEST=True)
+    @patch("rag_qa.core.tasks.ensure_vector_index")
+    @patch("rag_qa.core.tasks.update_vector_db")
+    def test_index_is_ensured_after_ingest(self, mock_update_vector_db, mock_ensure_vector_index):
+        """Test that the post-ingest hook creates the vector index when enabled"""
+        document = Document.objects.create(name="Doc", file_path="/path/to/doc.pdf")
+        mock_update_vector_db.return_value = {"added": 1, "deleted": 0, "kept": 0}
+        mock_ensure_vector_index.return_value = None
+        build_index(document.id)
+        mock_ensure_vector_index.assert_called_once_with()
+        document.refresh_from_db()
+        self.assertTrue(document.indexed)
+
+
+def count_words(text):
+    return len(text.split()) or 1
+
+
+class ContextAssemblyTests(SimpleTestCase):
+    def _chunk(self, text, document_id=1, page=0):
+        return LangchainDocument(page_content=text, metadata={"document_id": document_id, "page": page})
+
+    def test_budget_is_filled_in_score_order(self):
+        """Test that chunks that do not fit are skipped and smaller, less relevant ones still fill the budget"""
+        chunks = [
+            self._chunk("alpha " * 5, page=1),
+            self._chunk("beta " * 8, page=2),
+            self._chunk("gamma " * 3, page=3),
+        ]
+        context, tokens, sources = assemble_context(chunks, budget=10, count=count_words)
+        self.assertEqual(context, ("alpha " * 5).strip() + "\n\n" + ("gamma " * 3).strip())
+        self.assertEqual(tokens, 5 + 1 + 3)
+        self.assertEqual(sources, [chunks[0], chunks[2]])
+
+    def test_duplicates_are_dropped(self):
+        """Test that a chunk contained in one already added, from any document, is dropped"""
+        sentence = "The reactor is cooled by the river that runs along the plant."
+        chunks = [self._chunk(f"Intro. {sentence} More.", document_id=1), self._chunk(sentence, document_id=2)]
+        context, _, _ = assemble_context(chunks, budget=100, count=count_words)
+        self.assertEqual(context, f"Intro. {sentence} More.")
+
+    def test_overlap_of_neighbouring_chunks_is_added_once(self):
+        """Test that the text shared by neighbouring chunks of a page is only added once"""
+        overlap = "the shared sentence at the boundary of the two chunks"
+        first = self._chunk(f"The first chunk ends with {overlap}")
+        second = self._chunk(f"{overlap} and the second chunk goes on")
+        context, tokens, _ = assemble_context([second, first], budget=100, count=count_words)
+        self.assertEqual(context, f"{overlap} and the second chunk goes on\n\nThe first chunk ends with")
+        # The words of both chunks and the separator
+        self.assertEqual(tokens, count_words(context) + 1)
+
+    def test_chunks_of_other_pages_are_not_trimmed(self):
+        """Test that a similar boundary on another page is not taken for an overlap"""
+        overlap = "the shared sentence at the boundary of the two chunks"
+        chunks = [self._chunk(f"First {overlap}", page=1), self._chunk(f"{overlap} second", page=2)]
+        context, _, _ = assemble_context(chunks, budget=100, count=count_words)
+        self.assertEqual(context, f"First {overlap}\n\n{overlap} second")
+
+
+class AnswerTaskTests(TestCase):
+    def setUp(self):
+        Question.objects.create(question_id="question", status="in_progress")
+        self.redis = FakeRedis()
+        retriever = MagicMock()
+        retriever.invoke.return_value = [
+            LangchainDocument(
+                id="vector-1",
+                page_content="The answer is forty two.",
+                metadata={"document_id": "1", "page": 3, "relevance_score": 0.9},
+            )
+        ]
+        self.retriever = retriever
+        for target, value in [
+            ("rag_qa.core.tasks.get_redis_client", self.redis),
+            ("rag_qa.core.tasks.embed_question", [0.5, 0.25]),
+            ("rag_qa.core.helper._get_retriever_object", retriever),
+            ("rag_qa.core.helper._get_llm", FakeStreamingListLLM(responses=["Forty two"])),
+        ]:
+            patcher = patch(target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _events(self):
+        return [json.loads(message) for channel, message in self.redis.published]
+
+    def test_answer_and_embedding_are_stored(self):
+        """Test that the task stores what the semantic answer cache compares"""
+        self.assertEqual(get_rag_response((1,), "What is it?", question_id="question"), "Forty two")
+        question = Question.objects.get(question_id="question")
+        self.assertEqual(question.answer, "Forty two")
+        self.assertEqual(bytes(question.embedding), encode_vector([0.5, 0.25]))
+
+    def test_sources_and_timings_are_stored(self):
+        """Test that polls can read the whole answer from the question"""
+        get_rag_response((1,), "What is it?", question_id="question")
+        question = Question.objects.get(question_id="question")
+        self.assertEqual(question.status, "success")
+        self.assertEqual(
+            question.sources,
+            [{"chunk_id": "vector-1", "document_id": 1, "page": 3, "relevance_score": 0.9}],
+        )
+        self.assertGreaterEqual(question.retrieval_seconds, 0)
+        self.assertGreaterEqual(question.generation_seconds, 0)
+        self.assertIsNotNone(question.answered_at)
+
+    def test_failure_before_answering_marks_question_failed(self):
+        """Test that errors outside the chain, such as in Redis or the embedding, fail the question"""
+        with patch("rag_qa.core.tasks.embed_question", side_effect=RuntimeError("Embedding failed")):
+            with self.assertRaises(RuntimeError):
+                get_rag_response((1,), "What is it?", question_id="question")
+        self.assertEqual(Question.objects.get(question_id="question").status, "failed")
+
+        Question.objects.filter(question_id="question").update(status="in_progress")
+        with patch.object(FakeRedis, "delete", side_effect=redis.ConnectionError):
+            with self.assertRaises(redis.ConnectionError):
+                get_rag_response((1,), "What is it?", question_id="question")
+        self.assertEqual(Question.objects.get(question_id="question").status, "failed")
+
+    def test_chunk_ids_are_looked_up_for_stores_without_ids(self):
+        """Test that chunks returned without an ID, as pgvector does, are identified by their records"""
+        text = "The answer is forty two."
+        document = Document.objects.create(file_path="/path/to/doc.pdf", name="Doc")
+        DocumentChunk.objects.create(
+            document=document, page=3, page_fingerprint="page", fingerprint=hash_text(text), vector_id="vector-2"
+        )
+        self.retriever.invoke.return_value = [
+            LangchainDocument(page_content=text, metadata={"document_id": str(document.id), "page": 3})
+        ]
+        get_rag_response((document.id,), "What is it?", question_id="question")
+        source, = Question.objects.get(question_id="question").sources
+        self.assertEqual(source["chunk_id"], "vector-2")
+
+    def test_prompt_size_is_stored(self):
+        """Test that the task records the size of the assembled prompt"""
+        with patch("rag_qa.core.helper.count_tokens", return_value=123):
+            get_rag_response((1,), "What is it?", question_id="question")
+        self.assertEqual(Question.objects.get(question_id="question").prompt_tokens, 123)
+
+    def test_tokens_are_published_as_generated(self):
+        """Test that every token is published in order, then the full answer"""
+        get_rag_response((1,), "What is it?", question_id="question")
+        events = self._events()
+        self.assertEqual([event["seq"] for event in events], list(range(1, len(events) + 1)))
+        self.assertEqual("".join(event["token"] for event in events[:-1]), "Forty two")
+        self.assertGreater(len(events), 2)
+        self.assertEqual(events[-1], {"seq": len(events), "event": "done", "answer": "Forty two"})
+        self.assertEqual(self.redis.values["answer-stream:question:backlog"], [message for _, message in self.redis.published])
+        self.assertEqual({channel for channel, _ in self.redis.published}, {"answer-stream:question"})
+
+    def test_failure_is_published(self):
+        """Test that a failed answer ends the stream with an error event"""
+        with patch("rag_qa.core.helper._get_llm", side_effect=RuntimeError("LLM unavailable")):
+            with self.assertRaises(RuntimeError):
+                get_rag_response((1,), "What is it?", question_id="question")
+        self.assertEqual(self._events(), [{"seq": 1, "event": "error", "message": "LLM unavailable"}])
+        self.assertEqual(Question.objects.get(question_id="question").status, "failed")
+
+
+class FakeBatchLLM:
+    """An LLM stand-in that answers every prompt with its question and records the groups it receives."""
+
+    def __init__(self):
+        self.groups = []
+        self.lock = threading.Lock()
+
+    def batch(self, prompts, return_exceptions=False):
+        with self.lock:
+            self.groups.append(len(prompts))
+        questions = [prompt.split("Question: ")[1].split("\n")[0] for prompt in prompts]
+        return [RuntimeError("LLM failed") if "fail" in question else f"Answer to {question}" for question in questions]
+
+
+@override_settings(QUESTION_BATCH_PROMPTS_PER_CALL=2, QUESTION_BATCH_LLM_CONCURRENCY=2)
+class QuestionBatchTaskTests(TestCase):
+    def setUp(self):
+        self.document = Document.objects.create(file_path="/path/to/doc.pdf", name="Doc", index_version=2)
+        self.redis = FakeRedis()
+        self.llm = FakeBatchLLM()
+        retriever = MagicMock()
+        retriever.retrieve_by_vectors.side_effect = lambda vectors: [
+            [LangchainDocument(page_content=f"Chunk {vector[0]}")] for vector in vectors
+        ]
+        self.embed_questions = MagicMock(side_effect=lambda questions: [[float(index)] for index, _ in enumerate(questions)])
+        for target, value in [
+            ("rag_qa.core.tasks.get_redis_client", MagicMock(return_value=self.redis)),
+            ("rag_qa.core.tasks.embed_questions", self.embed_questions),
+            ("rag_qa.core.helper._get_retriever_object", MagicMock(return_value=retriever)),
+            ("rag_qa.core.helper._get_llm", MagicMock(return_value=self.llm)),
+        ]:
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _key(self, question):
+        return get_question_key((self.document.id,), (2,), question)
+
+    def _run(self, questions):
+        QuestionBatch.objects.create(batch_id="batch", status="in_progress", documents=[self.document.id], questions=questions)
+        answer_question_batch("batch")
+        return QuestionBatch.objects.get(batch_id="batch")
+
+    def test_questions_are_answered_in_groups(self):
+        """Test that all questions are answered, in order, with one LLM call per group of prompts"""
+        questions = [f"Question {index}?" for index in range(5)]
+        batch = self._run(questions)
+        self.assertEqual(batch.status, "success")
+        self.assertEqual(batch.completed, 5)
+        self.assertEqual([result["answer"] for result in batch.results], [f"Answer to {question}" for question in questions])
+        self.assertEqual(sorted(self.llm.groups), [1, 2, 2])
+        self.embed_questions.assert_called_once_with(questions)
+
+    def test_known_and_repeated_questions_are_not_asked_again(self):
+        """Test that stored answers are reused and a repeated question is answered once"""
+        Question.objects.create(question_id=self._key("Known?"), status="success", answer="Stored")
+        batch = self._run(["Known?", "New?", "New?"])
+        self.assertEqual([result["answer"] for result in batch.results], ["Stored", "Answer to New?", "Answer to New?"])
+        self.embed_questions.assert_called_once_with(["New?"])
+        stored = Question.objects.get(question_id=self._key("New?"))
+        self.assertEqual((stored.status, stored.answer), ("success", "Answer to New?"))
+
+    def test_live_claims_are_not_overwritten(self):
+        """Test that answers only replace questions that no request is answering"""
+        Question.objects.create(question_id=self._key("Claimed?"), status="in_progress", answer_id="task", claimed_at=timezone.now())
+        Question.objects.create(question_id=self._key("Failed?"), status="failed", answer_id="task")
+        batch = self._run(["Claimed?", "Failed?"])
+        self.assertEqual([result["answer"] for result in batch.results], ["Answer to Claimed?", "Answer to Failed?"])
+        claimed = Question.objects.get(question_id=self._key("Claimed?"))
+        self.assertEqual((claimed.status, claimed.answer, claimed.answer_id), ("in_progress", "", "task"))
+        failed = Question.objects.get(question_id=self._key("Failed?"))
+        self.assertEqual((failed.status, failed.answer), ("success", "Answer to Failed?"))
+
+    def test_failed_questions_do_not_fail_the_batch(self):
+        """Test that a failed question gets an error while the others are answered"""
+        batch = self._run(["Will it fail?", "Fine?"])
+        self.assertEqual(batch.status, "success")
+        self.assertEqual(batch.results[0], {"question": "Will it fail?", "error": "LLM failed"})
+        self.assertEqual(batch.results[1]["answer"], "Answer to Fine?")
+        self.assertFalse(Question.objects.filter(question_id=self._key("Will it fail?")).exists())
+
+    def test_answers_are_published(self):
+        """Test that every answer is published for the stream, then all results"""
+        batch = self._run(["A?", "B?", "C?"])
+        events = [json.loads(message) for channel, message in self.redis.published]
+        self.assertEqual({channel for channel, _ in self.redis.published}, {"answer-stream:batch:batch"})
+        self.assertEqual(sorted(event["index"] for event in events if event["event"] == "answer"), [0, 1, 2])
+        self.assertEqual(events[-1], {"seq": 4, "event": "done", "results": batch.results})
+
+
+class AnswerExpiryTests(TestCase):
+    @patch("rag_qa.core.tasks.update_vector_db")
+    def test_index_version_changes_with_the_chunks(self, mock_update_vector_db):
+        """Test that re-indexing a document changes its version only if its chunks changed"""
+        document = Document.objects.create(name="Doc", file_path="/path/to/doc.pdf")
+        mock_update_vector_db.return_value = {"added": 0, "deleted": 0, "kept": 5}
+        build_index(document.id, incremental=True)
+        document.refresh_from_db()
+        self.assertEqual((document.indexed, document.index_version), (True, 0))
+
+        mock_update_vector_db.return_value = {"added": 1, "deleted": 1, "kept": 4}
+        build_index(document.id, incremental=True)
+        document.refresh_from_db()
+        self.assertEqual(document.index_version, 1)
+
+    @patch("rag_qa.core.management.commands.build_index.update_vector_db")
+    def test_index_version_changes_when_built_from_the_command(self, mock_update_vector_db):
+        """Test that the build_index command completes the build as the task does"""
+        document = Document.objects.create(name="Doc", file_path="/path/to/doc.pdf")
+        mock_update_vector_db.return_value = {"added": 1, "deleted": 1, "kept": 4, "hits": 0, "misses": 1}
+        with patch("rag_qa.core.tasks.invalidate_selected_documents") as mock_invalidate:
+            call_command("build_index", document.id, "--incremental", stdout=io.StringIO())
+        mock_update_vector_db.assert_called_once_with(document.id, incremental=True)
+        document.refresh_from_db()
+        self.assertEqual((document.indexed, document.index_version), (True, 1))
+        self.assertTrue(mock_invalidate.called)
+
+    @override_settings(ANSWER_CACHE_TTL=3600, ANSWER_PURGE_BATCH_SIZE=2)
+    def test_expired_questions_are_purged_in_batches(self):
+        """Test that old answers and old unanswered questions are deleted, and recent ones kept"""
+        old = timezone.now() - timedelta(hours=2)
+        for index in range(3):
+            Question.objects.create(question_id=f"old answer {index}", status="success", answer="Old", answered_at=old)
+        Question.objects.create(question_id="old failure", status="failed")
+        Question.objects.create(question_id="recent answer", status="success", answer="New", answered_at=timezone.now())
+        # Answered recently, although first asked long ago
+        Question.objects.create(question_id="retried", status="success", answer="New", answered_at=timezone.now())
+        Question.objects.filter(question_id__in=["old failure", "retried"]).update(created_at=old)
+
+        self.assertEqual(purge_expired_answers(), 4)
+        self.assertEqual(
+            sorted(Question.objects.values_list("question_id", flat=True)), ["recent answer", "retried"]
+        )
+
+
+@override_settings(SELECTED_DOCUMENTS_CACHE_TTL=300)
+class SelectedDocumentsCacheTests(TestCase):
+    def setUp(self):
+        selection._cached = (None, None, 0.0)
+        self.client = FakeRedis()
+        self.document = Document.objects.create(name="Doc", file_path="/path/to/doc.pdf", selected=True)
+
+    def test_unchanged_selection_is_not_read_again(self):
+        """Test that the selected documents are read once while their version token is unchanged"""
+        with self.assertNumQueries(1):
+            selected = get_selected_documents(self.client)
+        self.assertEqual(selected.documents, (self.document.id,))
+        self.assertEqual(selected.names, {self.document.id: "Doc"})
+
+        with self.assertNumQueries(0):
+            self.assertIs(get_selected_documents(self.client), selected)
+
+    def test_invalidation_after_commit(self):
+        """Test that a selection change is seen once its transaction commits"""
+        get_selected_documents(self.client)
+        version = self.client.get(VERSION_KEY)
+        other = Document.objects.create(name="Other", file_path="/path/to/other.pdf", selected=True)
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            invalidate_selected_documents(self.client)
+            # Not before the commit
+            self.assertEqual(self.client.get(VERSION_KEY), version)
+        self.assertEqual(len(callbacks), 1)
+        self.assertNotEqual(self.client.get(VERSION_KEY), version)
+
+        self.assertEqual(get_selected_documents(self.client).documents, (self.document.id, other.id))
+
+    def test_expired_documents_are_read_again(self):
+        """Test that the documents are read again after the TTL, even if the token is unchanged"""
+        get_selected_documents(self.client)
+        Document.objects.filter(id=self.document.id).update(index_version=1)
+        with patch("rag_qa.core.selection.time.monotonic", return_value=time.monotonic() + 301):
+            self.assertEqual(get_selected_documents(self.client).versions, (1,))
+
+    def test_redis_errors_fall_back_to_the_database(self):
+        """Test that the documents are read from the database when Redis is unavailable"""
+        client = MagicMock()
+        client.get.side_effect = redis.ConnectionError
+        client.set.side_effect = redis.ConnectionError
+        with self.assertNumQueries(1):
+            self.assertEqual(get_selected_documents(client).documents, (self.document.id,))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_selected_documents(client)
+
+
+class TaskRoutingTests(SimpleTestCase):
+    def _route(self, task):
+        route = task.app.amqp.router.route({}, task.name, (), {})
+        return route["queue"].name, route.get("priority")
+
+    def test_ingestion_and_questions_use_separate_queues(self):
+        """Test that indexing and answering are sent to the queues of their worker services"""
+        self.assertEqual(self._route(build_index)[0], "ingest")
+        self.assertEqual(self._route(purge_expired_answers)[0], "ingest")
+        self.assertEqual(self._route(get_rag_response)[0], "qa")
+
+    def test_questions_take_priority_over_batches(self):
+        """Test that batches of questions wait for the questions asked interactively"""
+        self.assertEqual(self._route(answer_question_batch), ("qa", 9))
+        # With Redis, lower numbers are served first
+        self.assertLess(self._route(get_rag_response)[1], 9)
@@ -0,0 +1,172 @@
+"""
+Management of the approximate nearest-neighbour index on the pgvector embeddings table.
+"""
+import random
+import statistics
+import time
+
+import sqlalchemy
+
+EMBEDDING_TABLE = "langchain_pg_embedding"
+INDEX_NAME = "langchain_pg_embedding_ann_idx"
+DOCUMENT_INDEX_NAME = "langchain_pg_embedding_document_id_idx"
+# PGVector compares vectors by cosine distance by default
+OPERATOR_CLASS = "vector_cosine_ops"
+
+
+def get_search_options(ef_search, probes):
+    """
+    Builds the libpq connection options that set the per-query search parameters.
+
+    Args:
+        ef_search (int): The size of the HNSW candidate list.
+        probes (int): The number of IVFFlat lists scanned.
+
+    Returns:
+        str: The value of the ``options`` connection argument.
+    """
+    return f"-c hnsw.ef_search={int(ef_search)} -c ivfflat.probes={int(probes)}"
+
+
+def get_index_definition(engine):
+    """
+    Retrieves the definition of the ANN index.
+
+    Args:
+        engine (Engine): The engine of the pgvector database.
+
+    Returns:
+        str: The ``CREATE INDEX`` statement of the index, or ``None`` if there is no index.
+    """
+    with engine.connect() as connection:
+        return connection.execute(
+            sqlalchemy.text("SELECT indexdef FROM pg_indexes WHERE indexname = :name"),
+            {"name": INDEX_NAME},
+        ).scalar()
+
+
+def create_index(engine, method, dimensions, m=16, ef_construction=64, lists=100):
+    """
+    Creates the ANN index, and the ``document_id`` metadata index used by filtered queries.
+
+    The ``embedding`` column is created without dimensions, which pgvector cannot index, so it is
+    first given the fixed number of dimensions of the embedding model.
+
+    Args:
+        engine (Engine): The engine of the pgvector database.
+        method (str): ``"hnsw"`` or ``"ivfflat"``.
+        dimensions (int): The number of dimensions of the stored vectors.
+        m (int): The maximum number of connections per HNSW layer.
+        ef_construction (int): The size of the HNSW candidate list used while building.
+        lists (int): The number of IVFFlat lists.
+
+    Returns:
+        float: The time it took to build the ANN index, in seconds.
+
+    Raises:
+        ValueError: If the method is not supported.
+    """
+    if method == "hnsw":
+        options = f"m = {int(m)}, ef_construction = {int(ef_construction)}"
+    elif method == "ivfflat":
+        options = f"lists = {int(lists)}"
+    else:
+        raise ValueError(f"Unsupported index method: {method}")
+
+    with engine.begin() as connection:
+        column_type = connection.execute(
+            sqlalchemy.text(
+                "SELECT format_type(atttypid, atttypmod) FROM pg_attribute "
+                "WHERE attrelid = CAST(:table AS regclass) AND attname = 'embedding'",
+            ),
+            {"table": EMBEDDING_TABLE},
+        ).scalar()
+        if column_type != f"vector({int(dimensions)})":
+            connection.execute(
+                sqlalchemy.text(f"ALTER TABLE {EMBEDDING_TABLE} ALTER COLUMN embedding TYPE vector({int(dimensions)})"),
+            )
+        connection.execute(
+            sqlalchemy.text(
+                f"CREATE INDEX IF NOT EXISTS {DOCUMENT_INDEX_NAME} "
+                f"ON {EMBEDDING_TABLE} (collection_id, (cmetadata->>'document_id'))",
+            ),
+        )
+
+        started = time.perf_counter()
+        connection.execute(
+            sqlalchemy.text(
+                f"CREATE INDEX IF NOT EXISTS {INDEX_NAME} ON {EMBEDDING_TABLE} "
+                f"USING {method} (embedding {OPERATOR_CLASS}) WITH ({options})",
+            ),
+        )
+        return time.perf_counter() - started
+
+
+def drop_index(engine):
+    """
+    Drops the ANN index.
+
+    Args:
+        engine (Engine): The engine of the pgvector database.
+    """
+    with engine.begin() as connection:
+        connection.execute(sqlalchemy.text(f"DROP INDEX IF EXISTS {INDEX_NAME}"))
+
+
+def measure_latency(engine, dimensions, samples=20, k=4, ef_search=None, probes=None, exact=False, seed=0):
+    """
+    Measures the latency of nearest-neighbour queries with random query vectors.
+
+    Args:
+        engine (Engine): The engine of the pgvector database.
+        dimensions (int): The number of dimensions of the query vectors.
+        samples (int): The number of queries.
+        k (int): The number of neighbours per query.
+        ef_search (int, optional): The HNSW candidate list size used for the queries.
+        probes (int, optional): The number of IVFFlat lists scanned by the queries.
+        exact (bool): Disable index scans, to get the exact neighbours.
+        seed (int): The seed of the query vectors, so runs can be compared.
+
+    Returns:
+        tuple: The median latency in milliseconds and the IDs returned by each query.
+    """
+    generator = random.Random(seed)
+    query = sqlalchemy.text(
+        f"SELECT uuid FROM {EMBEDDING_TABLE} ORDER BY embedding <=> CAST(:vector AS vector) LIMIT :k",
+    )
+    latencies = []
+    results = []
+    with engine.connect() as connection:
+        if ef_search is not None:
+            connection.execute(sqlalchemy.text(f"SET hnsw.ef_search = {int(ef_search)}"))
+        if probes is not None:
+            connection.execute(sqlalchemy.text(f"SET ivfflat.probes = {int(probes)}"))
+        if exact:
+            connection.execute(sqlalchemy.text("SET enable_indexscan = off"))
+        for _ in range(samples):
+            vector = str([generator.uniform(-1, 1) for _ in range(dimensions)])
+            started = time.perf_counter()
+            ids = connection.execute(query, {"vector": vector, "k": k}).scalars().all()
+            latencies.append((time.perf_counter() - started) * 1000)
+            results.append(ids)
+        connection.rollback()
+    return statistics.median(latencies), results
+
+
+def recall(results, exact_results):
+    """
+    Computes the mean recall of approximate results against exact ones.
+
+    Args:
+        results (list[list]): The IDs returned by each approximate query.
+        exact_results (list[list]): The IDs returned by each exact query.
+
+    Returns:
+        float: The mean fraction of exact neighbours found.
+    """
+    fractions = [
+        len(set(found) & set(expected)) / len(expected)
+        for found, expected in zip(results, exact_results)
+        if expected
+    ]
+    return statistics.mean(fractions) if fractions else 1.0